@@ -10,17 +10,32 @@ Thanks to Eugene at Dyacon for full support in the development of this driver.
 This implementation uses the Modbus-RTU interface described in the Dyacon
 reference 57-6032-DOC-Manual-CM-1.pdf (2014).
 
-This driver requires the minimalmodbus python module, which in turn depends on
-the pyserial (pure python) module.
+This driver requires the pyserial (pure python) module for a serial port.
 
-pip install minimalmodbus
+pip install pyserial
+
+The driver has its own Modbus-RTU client for serial ports, which uses pyserial
+directly.  minimalmodbus is used instead if modbus_client = minimalmodbus, or
+if pyserial cannot be imported.  minimalmodbus is imported only when it is
+used.
 
 The CM1 has two communication interfaces: a USB port for configuration, and
-a serial port for reading data (Modbus-RTU slave over RS-485).
+a serial port for reading data (Modbus-RTU slave over RS-485).  The serial
+port can also be reached through an Ethernet-to-RS-485 gateway, using either
+Modbus TCP or raw Modbus-RTU frames over TCP.  pyserial is needed only for a
+local serial port.
 
 The CM1 has a data logger with capacity of 49,152 records, with logging
 intervals of 1, 2, 5, 10, 15, 20, 30, and 60 minutes.
 
+The Modbus access to the logger is not described in the manual, and the
+registers used here are assumed: a status block at 120, a select register at
+125, and a window of records at 1000.  The driver assumes the logger is a
+ring of fixed-size records, read by writing the index of the first record to
+the select register and then reading the window.  With logger_download
+enabled, the driver uses the logger to fill gaps in the weewx database after
+an outage.  It is off by default, because it writes the select register.
+
 The CM1 emits the following Modbus errors:
   01 - illegal function
   02 - illegal address
@@ -28,18 +43,48 @@ The CM1 emits the following Modbus errors:
   04 - device failure
 """
 
-import minimalmodbus
+import Queue
+import bisect
+import calendar
+import collections
+import datetime
+import errno
+import heapq
+import json
+import math
+import mmap
+import os
+import random
+import select
+import socket
 import struct
 import syslog
+import threading
 import time
+import types
 
 import weewx
 import weewx.drivers
+from weeutil.weeutil import to_bool
 from weewx.wxformulas import calculate_rain
 
+try:
+    import serial
+except ImportError:
+    serial = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 DRIVER_NAME = 'CM1'
-DRIVER_VERSION = '0.5'
+DRIVER_VERSION = '0.6'
+
+# raised at the end of a replayed capture.  weewx restarts the driver after
+# any other error, which would replay the capture again from the start.
+StopNow = getattr(weewx, 'StopNow', KeyboardInterrupt)
 
 
 def logmsg(dst, msg):
@@ -81,6 +126,11 @@ class CM1ConfEditor(weewx.drivers.AbstractConfEditor):
     # How often to poll the device, in seconds
     poll_interval = 10
 
+    # Whether to fill gaps in the database from the station data logger at
+    # startup.  Experimental: the logger registers are not in the manual
+    # and the download has not been verified against a station.
+    logger_download = False
+
     # The driver to use
     driver = user.cm1
 """
@@ -126,57 +176,415 @@ class CM1Driver(weewx.drivers.AbstractDevice):
         loginf('driver version is %s' % DRIVER_VERSION)
         self.model = stn_dict.get('model', 'MS-120')
         loginf("model is %s" % self.model)
-        port = stn_dict.get('port', CM1.DEFAULT_PORT)
-        loginf("port is %s" % port)
-        address = int(stn_dict.get('address', CM1.DEFAULT_ADDRESS))
-        loginf("address is %s" % address)
-        baud_rate = int(stn_dict.get('baud_rate', CM1.DEFAULT_BAUD_RATE))
-        timeout = int(stn_dict.get('timeout', CM1.DEFAULT_TIMEOUT))
         self.poll_interval = int(stn_dict.get('poll_interval', 10))
-        loginf("poll interval is %s" % self.poll_interval)
-        self.bucket_size = float(stn_dict.get('bucket_size', 0.2)) # mm
-        loginf("bucket size is %s mm" % self.bucket_size)
-        self.sensor_map = dict(CM1Driver.DEFAULT_MAP)
-        if 'sensor_map' in stn_dict:
-            self.sensor_map.update(stn_dict['sensor_map'])
-        loginf("sensor map: %s" % self.sensor_map)
         self.max_tries = int(stn_dict.get('max_tries', 6))
-        self.retry_wait = int(stn_dict.get('retry_wait', 5))
-        self.last_rain = None
-        self.station = CM1(port, address, baud_rate, timeout)
-        params = self._get_with_retries('get_system_parameters')
-        for x in CM1.SYSTEM_PARAMETERS:
-            loginf("%s: %s" % (x, params[x]))
+        # the wait between tries doubles after each failure, up to the max
+        self.retry_wait = float(stn_dict.get('retry_wait', 5))
+        self.max_retry_wait = float(stn_dict.get('max_retry_wait', 60))
+        # each station inherits the top-level options unless it overrides
+        # them.  with no stations section, the top-level options describe a
+        # single station.
+        stations_dict = stn_dict.get('stations')
+        if not stations_dict:
+            stations_dict = {'station': dict()}
+        self.stations = []
+        transports = dict()
+        for name in stations_dict:
+            cfg = dict(stn_dict)
+            cfg.pop('stations', None)
+            cfg.update(stations_dict[name])
+            sensor_map = dict(CM1Driver.DEFAULT_MAP)
+            if 'sensor_map' in stn_dict:
+                sensor_map.update(stn_dict['sensor_map'])
+            if 'sensor_map' in stations_dict[name]:
+                sensor_map.update(stations_dict[name]['sensor_map'])
+            cfg['sensor_map'] = sensor_map
+            self.stations.append(CM1Station(name, cfg, transports))
+        # set when the driver is closed.  a thread waiting to retry wakes on
+        # it, and a poll stops at the next register block.
+        self.stopped = threading.Event()
+        for stn in self.stations:
+            stn.station.stopped = self.stopped
+        # the first station is the primary: its logger is used to fill gaps,
+        # if the download is enabled
+        self.logger_download = to_bool(stn_dict.get('logger_download', False))
+        self.station = self.stations[0].station
+        self.sensor_map = self.stations[0].sensor_map
+        self.bucket_size = self.stations[0].bucket_size
+        # the loop runs as often as the most frequently polled group
+        self.poll_interval = min(stn.min_interval for stn in self.stations)
+        loginf("poll interval is %s" % self.poll_interval)
+        self.scheduler = PollScheduler(self.poll_interval)
+        # packets are read by a separate thread and queued in a ring buffer,
+        # so serial i/o never blocks the weewx engine and a slow consumer
+        # never delays a poll.
+        buffer_size = int(stn_dict.get('buffer_size', 100))
+        overflow = stn_dict.get('overflow', RingBuffer.DROP_OLDEST)
+        loginf("buffer size is %s, overflow policy is %s" %
+               (buffer_size, overflow))
+        self.buffer = RingBuffer(buffer_size, overflow)
+        self.acquirer = None
+        # set when a replayed capture has been read to the end
+        self.replay_ended = None
+        # transaction statistics can be added to each loop packet, and
+        # served as json on a unix socket or on a local http port
+        self.stats_in_packet = to_bool(stn_dict.get('stats_in_packet', False))
+        self.last_missed = 0
+        self.stats_server = None
+        stats_socket = stn_dict.get('stats_socket')
+        stats_port = stn_dict.get('stats_port')
+        if stats_socket or stats_port:
+            self.stats_server = StatsServer(
+                self.get_stats, stats_socket,
+                int(stats_port) if stats_port else None,
+                stn_dict.get('stats_host', '127.0.0.1'))
+            self.stats_server.start()
+        # with deadbands, a packet is emitted only when a field moves by more
+        # than its deadband, or when no packet has been emitted for
+        # heartbeat seconds.  rain, strikes and gusts are never held back.
+        self.deadband = None
+        if stn_dict.get('deadbands'):
+            deltas = []
+            gusts = []
+            for stn in self.stations:
+                deltas.extend([stn.prefix + 'rain',
+                               stn.prefix + 'lightning_strikes'])
+                gusts.extend(stn.prefix + k for k in stn.sensor_map
+                             if stn.sensor_map[k] in ['wind_gust_speed',
+                                                      'wind_gust_dir'])
+            self.deadband = DeadbandFilter(
+                stn_dict['deadbands'], float(stn_dict.get('heartbeat', 300)),
+                to_bool(stn_dict.get('changed_only', False)), deltas, gusts)
+            loginf("deadbands: %s, heartbeat %s seconds%s" % (
+                self.deadband.deadbands, self.deadband.heartbeat,
+                ', changed fields only' if self.deadband.changed_only
+                else ''))
+        # stations that share a port are polled one after the other.  each
+        # additional port gets a worker thread so ports are polled in
+        # parallel.
+        self.port_groups = []
+        ports = dict()
+        for stn in self.stations:
+            if stn.port not in ports:
+                ports[stn.port] = []
+                self.port_groups.append(ports[stn.port])
+            ports[stn.port].append(stn)
+        self.results = Queue.Queue()
+        self.workers = []
+        # with async_core, a single event loop polls every station and port,
+        # instead of a thread for each port
+        self.loop = None
+        if to_bool(stn_dict.get('async_core', False)):
+            if all(AsyncLink.supports(stn.station.transport)
+                   for stn in self.stations):
+                self.loop = EventLoop()
+                links = dict()
+                for stn in self.stations:
+                    if stn.port not in links:
+                        links[stn.port] = AsyncLink(self.loop,
+                                                    stn.station.transport)
+                    stn.async_station = AsyncCM1(stn.station, links[stn.port])
+                loginf("polling with the event loop")
+            else:
+                loginf("async_core is not available for %s" %
+                       self.stations[0].port)
+        if len(self.port_groups) > 1 and self.loop is None:
+            for group in self.port_groups:
+                w = _PortWorker(self, group, self.results)
+                w.start()
+                self.workers.append(w)
+        # the link can be checked at the configured baud rate.  the station
+        # rate is never changed: the register that would hold it is not in
+        # the published register map.
+        probe = stn_dict.get('baud_probe', 'off')
+        if probe == 'negotiate':
+            logerr("baud rate negotiation is not supported, so the baud rate"
+                   " is only checked")
+            probe = 'check'
+        if probe == 'check':
+            for stn in self.stations:
+                stn.probe_mode = probe
+                stn.probe_args = (
+                    int(stn_dict.get('probe_count', 20)),
+                    float(stn_dict.get('max_probe_error_rate', 0.0)),
+                    stn_dict.get('probe_log'))
+        # startup does not wait for the stations.  the identity from the
+        # last run is reported now, and each station is identified (and its
+        # baud rate probed) on its first poll.
+        self.identity = IdentityCache(
+            stn_dict.get('identity_file', IdentityCache.DEFAULT_FILE),
+            [stn.key for stn in self.stations],
+            float(stn_dict.get('identity_max_age',
+                               IdentityCache.DEFAULT_MAX_AGE)))
+        for stn in self.stations:
+            cached = self.identity.get(stn.key)
+            if cached is not None:
+                loginf("%s: cached identity: %s" % (
+                    stn.name, ', '.join('%s: %s' % (k, cached.get(k))
+                                        for k in IdentityCache.FIELDS)))
 
     @property
     def hardware_name(self):
         return self.model
 
     def closePort(self):
-#        self.station.serial.close()
+        # stop every thread that uses the ports, then close the ports
+        self.stopped.set()
+        if self.acquirer is not None:
+            self.acquirer.stop()
+            self.acquirer = None
+        if self.loop is not None:
+            self.loop.close()
+            self.loop = None
+        if self.stats_server is not None:
+            self.stats_server.stop()
+            self.stats_server = None
+        for w in self.workers:
+            w.requests.put(None)
+        for w in self.workers:
+            w.join(10)
+        self.workers = []
+        closed = set()
+        for stn in self.stations:
+            # stations on one port share a transport
+            transport = stn.station.transport
+            if id(transport) not in closed:
+                closed.add(id(transport))
+                transport.close()
         self.station = None
 
     def genLoopPackets(self):
+        if self.replay_ended is not None:
+            raise StopNow(self.replay_ended)
+        if self.acquirer is None:
+            if self.loop is not None:
+                self.acquirer = _EventLoopThread(self)
+            else:
+                self.acquirer = _AcquisitionThread(self)
+            self.acquirer.start()
         while True:
-            data = self._get_with_retries('get_current')
-            logdbg("raw data: %s" % data)
-            pkt = dict()
-            pkt['dateTime'] = int(time.time() + 0.5)
-            pkt['usUnits'] = weewx.METRICWX
-            for k in self.sensor_map:
-                if self.sensor_map[k] in data:
-                    pkt[k] = data[self.sensor_map[k]]
-            if 'rain_day_total' in data:
-                pkt['rain'] = calculate_rain(
-                    data['rain_day_total'], self.last_rain)
-                if pkt['rain'] is not None:
-                    pkt['rain'] *= self.bucket_size
-                self.last_rain = data['rain_day_total']
-            if 'rainRate' in pkt and pkt['rainRate'] is not None:
-                pkt['rainRate'] *= self.bucket_size
+            pkt = self.buffer.get(1.0)
+            if pkt is None:
+                continue
+            if isinstance(pkt, EOFError):
+                # the end of a replayed capture ends the run
+                self.acquirer = None
+                self.replay_ended = str(pkt)
+                raise StopNow(self.replay_ended)
+            if isinstance(pkt, Exception):
+                # the acquisition thread has given up, so let weewx decide
+                self.acquirer = None
+                raise pkt
             yield pkt
-            if self.poll_interval:
-                time.sleep(self.poll_interval)
+
+    def _acquire(self, slot):
+        span = []
+        pkt = self._poll(slot, span)
+        if not pkt:
+            # no station could be read, or none had a group due
+            return None
+        return self._finish_packet(pkt, span)
+
+    def _finish_packet(self, pkt, span):
+        # timestamp at the middle of the block reads that produced the data,
+        # given their start and end times in span, or at the time the data
+        # were recorded when replaying a capture
+        ts = self.stations[0].station.transport.recorded_time
+        if ts is None:
+            ts = (min(span) + max(span)) / 2 if span else time.time()
+        pkt['dateTime'] = int(ts + 0.5)
+        pkt['usUnits'] = weewx.METRICWX
+        if self.deadband is not None:
+            # a packet that is held back does not take the statistics, so
+            # they are counted in the next packet that is emitted
+            held = self.deadband.held
+            pkt = self.deadband.filter(pkt)
+            if pkt is None:
+                return None
+            if self.stats_in_packet:
+                pkt['cm1_suppressed'] = held
+        if self.stats_in_packet:
+            for stn in self.stations:
+                pkt.update(stn.stats.packet_fields(stn.prefix))
+            pkt['cm1_overruns'] = self.scheduler.missed - self.last_missed
+            self.last_missed = self.scheduler.missed
+            pkt['cm1_buffer_depth'] = self.buffer.depth
+        logdbg("decoded data: %s" % pkt)
+        return pkt
+
+    def get_stats(self):
+        """Return the transaction statistics of every station, and of the
+        scheduler and the packet buffer."""
+        stations = dict()
+        for stn in self.stations:
+            stations[stn.name] = stn.stats.snapshot()
+            stations[stn.name]['breaker'] = stn.breaker.state
+            # the cached identity stands in until the station is identified
+            stations[stn.name]['identified'] = stn.identified
+            stations[stn.name]['identity'] = self.identity.get(stn.key)
+        stats = dict(time=time.time(), stations=stations,
+                     scheduler=dict(interval=self.scheduler.interval,
+                                    overruns=self.scheduler.missed),
+                     buffer=self.buffer.stats())
+        if self.deadband is not None:
+            stats['deadband'] = self.deadband.stats()
+        return stats
+
+    def _poll(self, now=None, span=None):
+        # returns None if no station could be read
+        # poll every station once and merge the results into one packet
+        if self.workers:
+            for w in self.workers:
+                w.requests.put((now, span))
+            results = [self.results.get() for _ in self.workers]
+        else:
+            results = [self._poll_group(self.port_groups[0], now, span)]
+        pkt = dict()
+        failed = 0
+        for r in results:
+            if isinstance(r, Exception):
+                raise r
+            pkt.update(r[0])
+            failed += r[1]
+        if failed == len(self.stations):
+            return None
+        return pkt
+
+    def _poll_group(self, group, now=None, span=None):
+        # poll the stations on one port in sequence.  the bus is idle only
+        # for the modbus inter-frame gap between stations.  the times of the
+        # block reads are added to span.
+        if now is None:
+            now = time.time()
+        # retries must not run into the next slot.  a station that is not
+        # answering is tried again in that slot, and the breaker takes over
+        # if it keeps failing, so it cannot hold up the other stations on
+        # the port for longer than one interval.
+        deadline = now + self.poll_interval if self.poll_interval else None
+        pkt = dict()
+        failed = 0
+        for stn in group:
+            if not stn.breaker.allow(now):
+                # circuit is open: leave the station alone until cooldown
+                failed += 1
+                continue
+            if not stn.is_due(now):
+                continue
+            if stn.identify_due(now):
+                try:
+                    stn.probe_baud_rate()
+                    stn.identify(stn.station.get_system_parameters(),
+                                 self.identity)
+                except (IOError, ValueError, TypeError,
+                        weewx.WeeWxIOError), e:
+                    stn.identify_failed(now, e)
+            try:
+                if stn.breaker.state == CircuitBreaker.HALF_OPEN:
+                    # a single probe, no retries
+                    try:
+                        stn.read(pkt, now, span)
+                    except (IOError, ValueError, TypeError), e:
+                        raise weewx.WeeWxIOError("probe failed: %s" % e)
+                else:
+                    self._call_with_retries(stn, 'read', pkt, now, span,
+                                            deadline=deadline)
+                stn.breaker.success()
+            except weewx.WeeWxIOError, e:
+                logerr("%s: %s" % (stn.name, e))
+                stn.breaker.failure(time.time())
+                failed += 1
+        return pkt, failed
+
+    def genArchiveRecords(self, since_ts):
+        if not self.logger_download:
+            return
+        # weewx calls this at startup, and an exception here stops weewx.  so
+        # if the station does not answer a single quick read, skip the
+        # download; the next startup catches up from the last record saved.
+        stn = self.stations[0]
+        now = time.time()
+        if not stn.breaker.allow(now):
+            loginf("logger: %s is not answering, download skipped" % stn.name)
+            return
+        if stn.station.probe(1)['errors']:
+            stn.breaker.failure(now)
+            loginf("logger: no response from %s, download skipped" % stn.name)
+            return
+        stn.breaker.success()
+        try:
+            status = self._get_with_retries('get_logger_status')
+            loginf("logger: %s records at %s minute interval" %
+                   (status['count'], status['interval']))
+            # the logger registers are assumed, so do not read records
+            # from registers that do not look like a logger
+            CM1.check_logger_status(status)
+            pos = self._get_with_retries('find_logger_record', status,
+                                         since_ts)
+        except ValueError, e:
+            loginf("logger: download skipped, status not plausible: %s" % e)
+            return
+        except weewx.WeeWxIOError, e:
+            stn.breaker.failure(time.time())
+            loginf("logger: download skipped: %s" % e)
+            return
+        n = status['count'] - pos
+        if n <= 0:
+            loginf("logger: no records since %s" % since_ts)
+            return
+        loginf("logger: downloading %s records since %s" % (n, since_ts))
+        t0 = time.time()
+        cnt = 0
+        while pos < status['count']:
+            try:
+                recs = self._get_with_retries(
+                    'get_logger_records', status, pos,
+                    min(CM1.LOGGER_BATCH, status['count'] - pos))
+            except weewx.WeeWxIOError, e:
+                stn.breaker.failure(time.time())
+                loginf("logger: download stopped after %s records: %s" %
+                       (cnt, e))
+                return
+            for rec in recs:
+                pos += 1
+                if rec is None:
+                    continue
+                if since_ts is not None and rec['dateTime'] <= since_ts:
+                    continue
+                cnt += 1
+                yield self._logger_to_packet(rec, status['interval'])
+        elapsed = time.time() - t0
+        loginf("logger: downloaded %s records in %.1f seconds"
+               " (%.1f records/s)" %
+               (cnt, elapsed, cnt / elapsed if elapsed > 0 else 0))
+
+    def _logger_to_packet(self, rec, interval):
+        prefix = self.stations[0].prefix
+        pkt = dict()
+        pkt['dateTime'] = rec['dateTime']
+        pkt['usUnits'] = weewx.METRICWX
+        pkt['interval'] = interval
+        for k in self.sensor_map:
+            if self.sensor_map[k] in rec:
+                pkt[prefix + k] = rec[self.sensor_map[k]]
+        if rec.get('rain_total') is not None:
+            pkt[prefix + 'rain'] = rec['rain_total'] * self.bucket_size
+        if pkt.get(prefix + 'rainRate') is not None:
+            pkt[prefix + 'rainRate'] *= self.bucket_size
+        return pkt
+
+    def _backoff(self, n):
+        # exponential backoff with jitter, so that stations that failed
+        # together do not retry in lockstep
+        wait = min(self.retry_wait * (2 ** n), self.max_retry_wait)
+        return wait * random.uniform(0.5, 1.0)
+
+    def _retry_wait(self, n, deadline=None):
+        # the wait before the next try, or None if the try would start
+        # after the deadline
+        wait = self._backoff(n)
+        if deadline is not None and time.time() + wait > deadline:
+            return None
+        return wait
 
 #    def setTime(self):
 #        self.station.set_clock()
@@ -184,366 +592,3949 @@ class CM1Driver(weewx.drivers.AbstractDevice):
 #    def getTime(self):
 #        return self.station.get_clock()
 
-    def _get_with_retries(self, method):
+    def _get_with_retries(self, method, *args):
+        if self.loop is not None:
+            return self.loop.run_sync(self._call_async(
+                self.stations[0].async_station, method, *args))
+        return self._call_with_retries(self.station, method, *args)
+
+    def _call_async(self, obj, method, *args):
+        # the event loop version of _call_with_retries
+        for n in range(self.max_tries):
+            try:
+                x = yield self.loop.spawn(getattr(obj, method)(*args))
+                raise Return(x)
+            except (IOError, ValueError, TypeError), e:
+                loginf("failed attempt %s of %s: %s" %
+                       (n + 1, self.max_tries, e))
+                if n + 1 < self.max_tries:
+                    obj.stats.retries += 1
+                    yield self.loop.sleep(self._backoff(n))
+        raise weewx.WeeWxIOError("%s: max tries %s exceeded" %
+                                 (method, self.max_tries))
+
+    def _acquire_async(self):
+        # the event loop version of _AcquisitionThread.run: poll every
+        # station at once in each slot, and queue the merged packet
+        while True:
+            slot = self.scheduler.next(time.time())
+            yield self.loop.sleep_until(slot)
+            span = []
+            results = yield self.loop.gather(
+                [self.loop.spawn(self._poll_station_async(stn, slot, span))
+                 for stn in self.stations])
+            pkt = dict()
+            for r in results:
+                if isinstance(r, Exception):
+                    raise r
+                if r is not None:
+                    pkt.update(r)
+            if all(r is None for r in results) or not pkt:
+                continue
+            pkt = self._finish_packet(pkt, span)
+            if pkt is None:
+                continue
+            if not self.buffer.put(pkt):
+                if self.buffer.dropped % 100 == 1:
+                    loginf("buffer full: %s packets dropped" %
+                           self.buffer.dropped)
+
+    def _poll_station_async(self, stn, now, span=None):
+        # the event loop version of _poll_group for one station.  returns
+        # None if the station could not be read.
+        if not stn.breaker.allow(now):
+            raise Return(None)
+        if not stn.is_due(now):
+            raise Return(dict())
+        if stn.identify_due(now):
+            try:
+                # the probe runs on the loop like any other transaction
+                yield self.loop.spawn(stn.async_station._run(
+                    stn.probe_baud_rate_co()))
+                params = yield self.loop.spawn(
+                    stn.async_station.get_system_parameters())
+                stn.identify(params, self.identity)
+            except (IOError, ValueError, TypeError, weewx.WeeWxIOError), e:
+                stn.identify_failed(now, e)
+        # a single probe when the circuit is half open.  as in _poll_group,
+        # no try is started after the next slot.
+        tries = 1
+        if stn.breaker.state != CircuitBreaker.HALF_OPEN:
+            tries = self.max_tries
+        deadline = now + self.poll_interval if self.poll_interval else None
+        for n in range(tries):
+            try:
+                due, plan = stn.begin_read(now)
+                data = dict()
+                failed = yield self.loop.spawn(stn.async_station.read_current(
+                    plan, data, stn.block_tries, span))
+                pkt = stn.end_read(dict(), now, due, plan, data, failed)
+                stn.breaker.success()
+                raise Return(pkt)
+            except (IOError, ValueError, TypeError), e:
+                loginf("failed attempt %s of %s: %s" % (n + 1, tries, e))
+                if n + 1 < tries:
+                    wait = self._retry_wait(n, deadline)
+                    if wait is None:
+                        break
+                    stn.stats.retries += 1
+                    yield self.loop.sleep(wait)
+        logerr("%s: read failed after %s of %s tries" %
+               (stn.name, n + 1, tries))
+        stn.breaker.failure(time.time())
+        raise Return(None)
+
+    def _call_with_retries(self, obj, method, *args, **kwargs):
+        # with a deadline, no try is started after it
+        deadline = kwargs.get('deadline')
         for n in range(self.max_tries):
             try:
-                return getattr(self.station, method)()
+                return getattr(obj, method)(*args)
             except (IOError, ValueError, TypeError), e:
                 loginf("failed attempt %s of %s: %s" %
                        (n + 1, self.max_tries, e))
-                time.sleep(self.retry_wait)
+                if n + 1 < self.max_tries:
+                    wait = self._retry_wait(n, deadline)
+                    if wait is None:
+                        raise weewx.WeeWxIOError(
+                            "%s: no time for another try before the next"
+                            " poll" % method)
+                    # the wait ends early if the driver is closed
+                    if self.stopped.wait(wait):
+                        raise weewx.WeeWxIOError("%s: driver closed" %
+                                                 method)
+                    if hasattr(obj, 'stats'):
+                        obj.stats.retries += 1
         else:
             raise weewx.WeeWxIOError("%s: max tries %s exceeded" %
                                      (method, self.max_tries))
 
 
-class CM1(minimalmodbus.Instrument):
-    DEFAULT_PORT = '/dev/ttyUSB0'
-    DEFAULT_ADDRESS = 1
-    DEFAULT_BAUD_RATE = 19200
-    DEFAULT_TIMEOUT = 6.0 # seconds
+class CM1Station(object):
+    """One CM1 on the bus.  Each station has its own address, port, sensor
+    map and prefix.  The prefix is added to the name of every field from the
+    station, so several stations can be merged into one loop packet.
 
-    SYSTEM_PARAMETERS = ['serial_number', 'product_id', 'firmware_version',
-                         'date', 'time', 'battery_voltage', 'solar_voltage',
-                         'charger_status']
+    Each sensor group is read at its own interval.  A poll reads only the
+    groups that are due, and the packet is filled in with the last known
+    values of the other groups.
 
-    CHARGER_STATUS = {
-        0: 'Off',
-        1: 'Fast', # current-limited
-        2: 'Fast Top', # voltage-limited
-        3: 'Float Charge' } # low voltage charge
+    In wind-fast mode the wind group is read at a high rate.  A poll that
+    reads only wind gives a compact packet with the wind fields alone, and
+    the samples are accumulated so that each full packet reports the mean
+    wind and the highest gust since the previous full packet."""
 
-    def __init__(self, port, address, baud_rate, timeout):
-#        minimalmodbus.BAUDRATE = baud_rate
-#        minimalmodbus.TIMEOUT = timeout
-        minimalmodbus.Instrument.__init__(self, port, address)
-        self.serial.baudrate = baud_rate
-        self.serial.timeout = timeout
-        loginf("port: %s" % self.serial.port)
-        loginf("serial settings: %s:%s:%s:%s" % (
-            self.serial.baudrate, self.serial.bytesize,
-            self.serial.parity, self.serial.stopbits))
-#        self.address = address
+    GROUPS = ['wind', 'tph', 'rain', 'analog', 'calculated', 'lightning',
+              'power']
 
-    def __enter__(self):
-        return self
+    def __init__(self, name, cfg, transports=None):
+        self.name = name
+        self.port = cfg.get('port', CM1.DEFAULT_PORT)
+        self.address = int(cfg.get('address', CM1.DEFAULT_ADDRESS))
+        # a station moved to another port or address is a new entry in the
+        # identity cache
+        self.key = "%s@%s:%s" % (self.name, self.port, self.address)
+        self.identified = False
+        # a station that cannot be identified is tried again only after
+        # identify_retry seconds, so that each poll does not wait for it
+        self.identify_retry = float(cfg.get('identify_retry', 600))
+        self.next_identify = 0
+        self.probe_mode = None
+        self.probe_args = None
+        self.prefix = cfg.get('prefix', '')
+        baud_rate = int(cfg.get('baud_rate', CM1.DEFAULT_BAUD_RATE))
+        timeout = float(cfg.get('timeout', CM1.DEFAULT_TIMEOUT))
+        # with adaptive timeouts, the timeout for each transaction follows
+        # the observed response time, between min_timeout and timeout
+        adaptive = to_bool(cfg.get('adaptive_timeout', True))
+        min_timeout = float(cfg.get('min_timeout', CM1.DEFAULT_MIN_TIMEOUT))
+        # a failed block is tried again immediately, up to block_tries
+        self.block_tries = int(cfg.get('block_tries', 2))
+        self.breaker = CircuitBreaker(
+            name, int(cfg.get('breaker_threshold', 3)),
+            float(cfg.get('breaker_cooldown', 60)),
+            float(cfg.get('max_breaker_cooldown', 600)))
+        loginf("%s: port is %s" % (name, self.port))
+        loginf("%s: address is %s" % (name, self.address))
+        if self.prefix:
+            loginf("%s: prefix is %s" % (name, self.prefix))
+        self.bucket_size = float(cfg.get('bucket_size', 0.2)) # mm
+        loginf("%s: bucket size is %s mm" % (name, self.bucket_size))
+        self.sensor_map = cfg['sensor_map']
+        loginf("%s: sensor map: %s" % (name, self.sensor_map))
+        self.last_rain = None
+        # decode straight into the packet using the database names.  the
+        # daily rain total is always needed to calculate rain.
+        self.rain_key = self.prefix + 'rain_day_total'
+        self.rain_rate_key = self.prefix + 'rainRate'
+        names = dict()
+        for k in self.sensor_map:
+            names.setdefault(self.sensor_map[k], []).append(self.prefix + k)
+        rain_names = names.setdefault('rain_day_total', [])
+        self.pop_rain_total = self.rain_key not in rain_names
+        if self.pop_rain_total:
+            rain_names.append(self.rain_key)
+        # in storm mode the strike count and lightning status are always
+        # needed, to see when a storm starts
+        self.storm = None
+        self.storm_keys = []
+        storm_interval = float(cfg.get('storm_interval', 0))
+        if storm_interval:
+            for x in ['lightning_strike_count', 'lightning_status']:
+                key = self.prefix + x
+                self.storm_keys.append((key, key not in names.get(x, [])))
+                if key not in names.setdefault(x, []):
+                    names[x].append(key)
+        self.register_map = RegisterMap(CM1.REGISTER_MAP, names)
+        self.plans = dict()
+        # read only the registers that are mapped, in the blocks that take
+        # the least bus time: a gap is read through when that is cheaper
+        # than another transaction at this baud rate
+        self.turnaround = float(cfg.get('turnaround', CM1.DEFAULT_TURNAROUND))
+        self.cost = transaction_cost(baud_rate, self.turnaround)
+        blocks = self.register_map.optimize(cost=self.cost)
+        loginf("%s: read plan: %s (%.1f ms per poll)" %
+               (name, ' '.join('%s-%s' % (r, r + n - 1) for r, n in blocks),
+                1000 * plan_cost(blocks, self.cost)))
+        poll_interval = float(cfg.get('poll_interval', 10))
+        intervals = cfg.get('poll_intervals', dict())
+        self.intervals = dict()
+        for g in CM1Station.GROUPS:
+            self.intervals[g] = float(intervals.get(g, poll_interval))
+        # in wind-fast mode, gusts are the highest running mean over
+        # gust_window, as recommended by the WMO for 3 second gusts
+        self.wind = None
+        wind_fast = float(cfg.get('wind_fast_interval', 0))
+        if wind_fast:
+            speed = names.get('wind_speed')
+            direction = names.get('wind_dir')
+            if speed and direction:
+                self.intervals['wind'] = wind_fast
+                self.wind = WindAccumulator(
+                    float(cfg.get('gust_window', 3.0)))
+                self.wind_keys = (speed[0], direction[0],
+                                  names.get('wind_gust_speed', []),
+                                  names.get('wind_gust_dir', []))
+                loginf("%s: wind-fast mode every %s seconds,"
+                       " gust window %s seconds" %
+                       (name, wind_fast, self.wind.gust_window))
+            else:
+                logerr("%s: wind-fast mode needs wind_speed and wind_dir"
+                       " in the sensor map" % name)
+        # in storm mode the lightning group is read at its own interval
+        # until the strike count or status changes, then at storm_interval
+        # until storm_hold seconds pass without a change
+        if storm_interval:
+            self.storm = StormTracker(
+                self.intervals['lightning'], storm_interval,
+                float(cfg.get('storm_hold', 600)))
+            loginf("%s: storm mode every %s seconds, idle every %s seconds,"
+                   " hold %s seconds" % (name, storm_interval,
+                                         self.storm.idle, self.storm.hold))
+        loginf("%s: group poll intervals: %s" % (name, self.intervals))
+        self.next_due = dict((g, 0) for g in CM1Station.GROUPS)
+        # tolerate a little jitter so a group is not pushed back a cycle
+        self.slack = 0.5 * self.min_interval
+        self.last = dict()
+        self.group_outputs = dict(
+            (g, [x for k in self.register_map.outputs([g])
+                 for x in self.register_map.names[k]])
+            for g in CM1Station.GROUPS)
+        # the built-in modbus client is used for serial ports unless
+        # modbus_client is minimalmodbus.  stations on the same port share
+        # its transport.
+        if transports is None:
+            transports = dict()
+        if self.port not in transports:
+            transports[self.port] = Transport.create(
+                self.port, self.address, baud_rate, timeout,
+                to_bool(cfg.get('pipeline', False)),
+                cfg.get('modbus_client', 'native'))
+        transport = transports[self.port]
+        # a block read less than cache_ttl seconds ago is not read again
+        cache_ttl = float(cfg.get('cache_ttl', 0))
+        if cache_ttl >= self.min_interval:
+            logerr("%s: cache_ttl %s is not shorter than the poll interval,"
+                   " so polls may report cached values" % (name, cache_ttl))
+        self.station = CM1(self.port, self.address, baud_rate, timeout,
+                           adaptive, min_timeout, transport,
+                           cache_ttl=cache_ttl)
+        # raw register blocks can be captured for replay
+        if cfg.get('record_file'):
+            self.station.recorder = RawRecorder.get(cfg['record_file'])
+        # the config registers are not in the published register map, so
+        # the driver does not write them
+        if cfg.get('station_config'):
+            logerr("%s: station_config is ignored: the configuration"
+                   " registers are not confirmed, so they are not written" %
+                   name)
 
-    def __exit__(self, _, value, traceback):
-        pass
+    @property
+    def min_interval(self):
+        if self.storm is not None:
+            return min(min(self.intervals.values()), self.storm.burst)
+        return min(self.intervals.values())
 
-    @staticmethod
-    def _to_signed(x, bits=16):
-        # assumes two's complement enoding of signed integer
-        if (x & (1 << (bits - 1))) != 0:
-            x = x - (1 << bits)
-        return x
+    def is_due(self, now):
+        return any(now + self.slack >= self.next_due[g]
+                   for g in CM1Station.GROUPS)
 
-    @staticmethod
-    def _to_long(a, b):
-        return (a << 16) + b
+    @property
+    def stats(self):
+        return self.station.stats
 
-    @staticmethod
-    def _to_float(a, b):
-        f = struct.unpack('f', struct.pack('>HH', a, b))[0]
-#        loginf("to_float: a=%04x b=%04x f=%s" % (a, b, f))
-        return f
+    def get_system_parameters(self):
+        return self.station.get_system_parameters()
 
-    @staticmethod
-    def _to_calculated(x):
-        x = CM1._to_signed(x)
-        if x == -9990:
-            return None
-        return x * 0.1
+    def identify(self, params, cache):
+        """Log the system parameters read from the station, report any
+        difference from the cached identity, and update the cache."""
+        for x in CM1.SYSTEM_PARAMETERS:
+            loginf("%s: %s: %s" % (self.name, x, params.get(x)))
+        live = dict((k, params.get(k)) for k in IdentityCache.FIELDS)
+        cached = cache.get(self.key)
+        if cached is not None:
+            changed = [k for k in IdentityCache.FIELDS
+                       if cached.get(k) != live[k]]
+            if changed:
+                logerr("%s: station identity changed: %s" % (
+                    self.name, ', '.join('%s was %s, is %s' %
+                                         (k, cached.get(k), live[k])
+                                         for k in changed)))
+        cache.put(self.key, live)
+        self.identified = True
 
-    def _read_registers(self, reg, cnt):
-        return self.read_registers(reg, cnt)
+    def identify_due(self, now):
+        return not self.identified and now >= self.next_identify
 
-    def _read_register(self, reg, places=0):
-        return self.read_register(reg, places)
+    def identify_failed(self, now, e):
+        self.next_identify = now + self.identify_retry
+        loginf("%s: not identified: %s; next try in %s seconds" %
+               (self.name, e, self.identify_retry))
 
-    def _read_long(self, reg):
-        return self.read_long(reg)
+    def probe_baud_rate(self, mode=None, count=20, max_error_rate=0.0,
+                        log_path=None):
+        """Check the link at the configured baud rate, finding the rate of
+        the station if it does not answer.  The measurements are logged, and
+        appended as a line of json to log_path.  With no mode, do the probe
+        that was configured, once."""
+        return self.station._run(self.probe_baud_rate_co(
+            mode, count, max_error_rate, log_path))
 
-    def get_system_parameters(self):
-        data = dict()
-        x = self._read_registers(100, 11)
-        data['product_id'] = CM1._to_signed(x[0])
-        data['firmware_version'] = x[1]
-        data['serial_number'] = CM1._to_long(x[2], x[3])
-        data['time'] = CM1._to_long(x[4], x[5])
-        data['date'] = CM1._to_long(x[6], x[7])
-        data['battery_voltage'] = x[8] * 0.001
-        data['solar_voltage'] = x[9] * 0.001
-        data['charger_status'] = x[10]
-        return data
+    def probe_baud_rate_co(self, mode=None, count=20, max_error_rate=0.0,
+                           log_path=None):
+        """The probe, as a protocol coroutine of the CM1, so that it can
+        also be run on the event loop."""
+        if mode is None:
+            if self.probe_mode is None:
+                return
+            mode = self.probe_mode
+            count, max_error_rate, log_path = self.probe_args
+            self.probe_mode = None
+        if self.station.transport.baud_rate is None:
+            loginf("%s: no baud rate to probe on %s" % (self.name, self.port))
+            return
+        t0 = time.time()
+        result = yield self.station._probe_co(count)
+        results = [result]
+        if result['errors'] == count:
+            rate = yield self.station._find_baud_rate_co()
+            if rate is None:
+                raise weewx.WeeWxIOError("%s: no response at any baud rate" %
+                                         self.name)
+            logerr("%s: station is at %s baud, not %s" %
+                   (self.name, rate, result['baud_rate']))
+            result = yield self.station._probe_co(count)
+            results.append(result)
+        best = CM1.recommend_baud_rate(results, max_error_rate)
+        for r in results:
+            loginf("%s: %s baud: %s errors in %s reads, latency %s" %
+                   (self.name, r['baud_rate'], r['errors'],
+                    r['transactions'],
+                    '%.1f ms' % (1000 * r['latency'])
+                    if r['latency'] is not None else 'none'))
+        baud_rate = self.station.transport.baud_rate
+        loginf("%s: using %s baud, recommended %s" %
+               (self.name, baud_rate, best))
+        # the bus time of each transaction depends on the rate
+        self.cost = transaction_cost(baud_rate, self.turnaround)
+        self.plans = dict()
+        if log_path:
+            try:
+                with open(log_path, 'a') as f:
+                    f.write(json.dumps(dict(
+                        time=t0, station=self.name, port=self.port,
+                        address=self.address, mode=mode, results=results,
+                        recommended=best, baud_rate=baud_rate),
+                                       sort_keys=True) + "\n")
+            except (IOError, OSError), e:
+                logerr("%s: cannot write %s: %s" % (self.name, log_path, e))
 
-    def get_current(self):
+    def _get_plan(self, due):
+        if due not in self.plans:
+            blocks = self.register_map.optimize(
+                self.register_map.outputs(due), self.cost)
+            logdbg("%s: read plan for %s: %s" %
+                   (self.name, sorted(due), blocks))
+            self.plans[due] = self.register_map.compile(blocks)
+        return self.plans[due]
+
+    def read(self, pkt, now=None, span=None):
+        if now is None:
+            now = time.time()
+        due, plan = self.begin_read(now)
         data = dict()
-        x = self._read_registers(108, 3)
-        data.update(CM1._decode_power(x))
-        x = self._read_registers(200, 92)
-        data.update(CM1._decode_wind(x[0:9]))
-        data.update(CM1._decode_tph(x[20:26]))
-        data.update(CM1._decode_rain(x[42:44]))
-        data.update(CM1._decode_analog(x[44:46], 1))
-        data.update(CM1._decode_analog(x[46:48], 2))
-        data.update(CM1._decode_calculated(x[40:42]+x[48:50]))
-        data.update(CM1._decode_lightning(x[80:92]))
-        return data
+        failed = self.station.read_current(plan, data, self.block_tries,
+                                           span)
+        return self.end_read(pkt, now, due, plan, data, failed)
 
-    def get_clock(self):
-        # station is in local time, so convert from local time to epoch
-        x = self._read_registers(104, 4)
-        ds = (x[2] << 16) + x[3]
-        ts = (x[0] << 16) + x[1]
-        x = time.mktime(time.strptime("20%06d.%06d" % (ds, ts),
-                                      "%Y%m%d.%H%M%S"))
-        logdbg("get_clock: date.time: %s.%s (%s)" % (ds, ts, x))
-        return x
+    def begin_read(self, now):
+        """Return the groups that are due at now, and the plan that reads
+        them."""
+        due = frozenset(g for g in CM1Station.GROUPS
+                        if now + self.slack >= self.next_due[g])
+        return due, self._get_plan(due)
 
-    def set_clock(self, epoch=None):
-        # station is in local time, so convert from epoch to local time
-        if epoch is None:
-            epoch = int(time.time() + 0.5)
-        tstr = time.localtime(epoch)
-        ds = (tstr.tm_year - 2000) * 10000 + tstr.tm_mon * 100 + tstr.tm_mday
-        dlo = ds % 0x10000
-        dhi = (ds - dlo) >> 16
-        ts = tstr.tm_hour * 10000 + tstr.tm_min * 100 + tstr.tm_sec
-        tlo = ts % 0x10000
-        thi = (ts - tlo) >> 16
-        buf = [thi, tlo, dhi, dlo]
-        logdbg("set_clock: date.time: %06d.%06d (%s)" % (ds, ts, epoch))
-        self.write_registers(104, buf)
+    def end_read(self, pkt, now, due, plan, data, failed):
+        """Add the data decoded by plan to the packet, given the indices of
+        the blocks that failed."""
+        lost = set()
+        if failed:
+            # a failed block loses only its own groups.  do not report stale
+            # values for them, and try them again on the next poll.
+            for b in failed:
+                lost.update(plan.groups[b])
+            logerr("%s: failed to read %s" % (self.name, sorted(lost)))
+            for g in lost:
+                for x in self.group_outputs[g]:
+                    self.last.pop(x, None)
+            due = due - lost
+        # the groups with fields that were decoded.  a group with no fields
+        # in the sensor map reads no block, so it does not count.
+        decoded = set()
+        for b in range(len(plan.blocks)):
+            if b not in failed:
+                decoded.update(plan.groups[b])
+        decoded -= lost
+        if not decoded:
+            # nothing was read, so this station adds nothing to the packet
+            return pkt
+        rain = None
+        if self.rain_key in data:
+            if self.pop_rain_total:
+                total = data.pop(self.rain_key)
+            else:
+                total = data[self.rain_key]
+            rain = calculate_rain(total, self.last_rain)
+            if rain is not None:
+                rain *= self.bucket_size
+            self.last_rain = total
+        if data.get(self.rain_rate_key) is not None:
+            data[self.rain_rate_key] *= self.bucket_size
+        strikes = None
+        if self.storm is not None and 'lightning' in due:
+            strikes = self._storm_update(data, now)
+        for g in due:
+            self.next_due[g] = now + self.intervals[g]
+        # a poll that decodes only the groups in a fast mode gives a compact
+        # packet with the fields of those groups alone
+        fast = set()
+        if self.wind is not None:
+            fast.add('wind')
+        if self.storm is not None and self.storm.active:
+            fast.add('lightning')
+        compact = decoded <= fast
+        if self.wind is not None and 'wind' in due:
+            if compact:
+                self._wind_sample(data, now)
+            else:
+                self._wind_summary(data, now)
+        self.last.update(data)
+        pkt.update(data if compact else self.last)
+        # rain and strikes are deltas, so they are reported only when they
+        # were read
+        if 'rain' in due:
+            pkt[self.prefix + 'rain'] = rain
+        if self.storm is not None and 'lightning' in due:
+            pkt[self.prefix + 'lightning_strikes'] = strikes
+        return pkt
 
-    def get_time(self):
-        # 32-bits
-        # HHMMSS - bcd encoded
-        return "%06d" % self._read_long(104)
+    def _storm_update(self, data, now):
+        # returns the strikes since the last read of the lightning group
+        (count_key, pop_count), (status_key, pop_status) = self.storm_keys
+        count = data.pop(count_key) if pop_count else data.get(count_key)
+        status = data.pop(status_key) if pop_status else data.get(status_key)
+        active = self.storm.active
+        strikes = self.storm.update(now, count, status)
+        if self.storm.active != active:
+            loginf("%s: storm mode %s" % (
+                self.name, 'started' if self.storm.active else 'ended'))
+        self.intervals['lightning'] = self.storm.interval
+        return strikes
 
-    def get_date(self):
-        # 32-bits
-        # YYMMDD - bcd encoded
-        return "%06d" % self._read_long(106)
+    def _wind_sample(self, data, now):
+        # compact packet: the latest sample, and the running gust
+        speed, direction, gust, gust_dir = self.wind_keys
+        current = self.wind.add(now, data.get(speed), data.get(direction))
+        for k in gust:
+            data[k] = current[0]
+        for k in gust_dir:
+            data[k] = current[1]
 
-    def get_battery_voltage(self):
-        # 16-bits
-        # 0-50000 * 0.001
-        return self._read_register(108, 3)
+    def _wind_summary(self, data, now):
+        # full packet: the scalar mean speed, the vector mean direction, and
+        # the highest gust since the previous full packet
+        speed, direction, gust, gust_dir = self.wind_keys
+        self.wind.add(now, data.get(speed), data.get(direction))
+        summary = self.wind.summary()
+        self.wind.reset()
+        if summary is None:
+            return
+        data[speed] = summary['speed']
+        data[direction] = summary['dir']
+        for k in gust:
+            data[k] = summary['gust']
+        for k in gust_dir:
+            data[k] = summary['gust_dir']
 
-    def get_solar_charge_voltage(self):
-        # 16-bits
-        # 0-50000 * 0.001
-        return self._read_register(109, 3)
 
-    def get_charger_status(self):
-        # 16-bits
-        # 0=off, 1=fast, 2=fasttop, 3=floatcharge
-        return self._read_register(110)
+class IdentityCache(object):
+    """Product id, firmware version and serial number of each station, as
+    last read, kept in a json file so that startup need not wait for the
+    stations.  Stations are keyed by name, port and address.
 
-    @staticmethod
-    def _decode_power(x):
-        data = dict()
-        data['battery_voltage'] = x[0] * 0.001
-        data['solar_voltage'] = x[1] * 0.001
-        data['charger_status'] = x[2]
-        return data
+    An entry older than max_age seconds is not used.  When the file is
+    written, entries for keys other than the given keys are dropped, so a
+    station that was removed or moved does not linger."""
 
-    def get_wind(self):
-        # all values are 16-bit signed integers with 0.1 multiplier
-        x = self._read_registers(200, 9)
-        return CM1._decode_wind(x)
+    DEFAULT_FILE = '/var/tmp/cm1-identity.json'
+    DEFAULT_MAX_AGE = 30 * 86400 # seconds
+    FIELDS = ['product_id', 'firmware_version', 'serial_number']
+
+    def __init__(self, path, keys=None, max_age=DEFAULT_MAX_AGE):
+        self.path = path
+        self.keys = keys
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.data = dict()
+        try:
+            with open(path) as f:
+                self.data = json.load(f)
+        except (IOError, OSError, ValueError), e:
+            logdbg("no identity cache at %s: %s" % (path, e))
+
+    def _expired(self, entry, now):
+        return now - entry.get('time', 0) > self.max_age
+
+    def get(self, key, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or self._expired(entry, now):
+                return None
+            return entry
+
+    def put(self, key, identity, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.data[key] = dict(identity, time=int(now))
+            for k in self.data.keys():
+                if self.keys is not None and k not in self.keys or \
+                        self._expired(self.data[k], now):
+                    del self.data[k]
+            # write a new file then rename, so a crash cannot leave a
+            # partial cache
+            tmp = self.path + '.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(self.data, f, sort_keys=True)
+                os.rename(tmp, self.path)
+            except (IOError, OSError), e:
+                logerr("cannot write identity cache %s: %s" % (self.path, e))
+
+
+class WindAccumulator(object):
+    """Streaming wind statistics for one report period: the scalar mean
+    speed, the vector mean, and the highest gust with its direction.  A gust
+    is the mean speed over the last gust_window seconds, so it does not
+    depend on how often the wind is sampled."""
+
+    def __init__(self, gust_window=3.0):
+        self.gust_window = gust_window
+        self.window = collections.deque() # (ts, speed, u, v)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.speed_sum = 0.0
+        self.u_sum = 0.0
+        self.v_sum = 0.0
+        self.gust = None
+        self.gust_dir = None
 
     @staticmethod
-    def _decode_wind(x):
-        data = dict()
-        data['wind_status'] = x[0]
-        if data['wind_status'] == -1:
-            pass # no sensor attached
-        elif data['wind_status'] == 0:
-            data['wind_speed'] = x[1] * 0.1 # m/s
-            data['wind_dir'] = x[2] * 0.1 # compass degree
-            data['wind_speed_2m'] = x[3] * 0.1
-            data['wind_dir_2m'] = x[4] * 0.1
-            data['wind_speed_10m'] = x[5] * 0.1
-            data['wind_dir_10m'] = x[6] * 0.1
-            data['wind_gust_speed'] = x[7] * 0.1
-            data['wind_gust_dir'] = x[8] * 0.1
+    def _direction(u, v):
+        if u == 0 and v == 0:
+            return None
+        return math.degrees(math.atan2(u, v)) % 360
+
+    def add(self, ts, speed, direction):
+        """Add one sample, and return the current gust and its direction."""
+        if speed is None or direction is None:
+            return None, None
+        u = speed * math.sin(math.radians(direction))
+        v = speed * math.cos(math.radians(direction))
+        self.count += 1
+        self.speed_sum += speed
+        self.u_sum += u
+        self.v_sum += v
+        self.window.append((ts, speed, u, v))
+        while ts - self.window[0][0] >= self.gust_window:
+            self.window.popleft()
+        n = len(self.window)
+        mean = sum(x[1] for x in self.window) / n
+        mean_dir = self._direction(sum(x[2] for x in self.window),
+                                   sum(x[3] for x in self.window))
+        if self.gust is None or mean > self.gust:
+            self.gust = mean
+            self.gust_dir = mean_dir
+        return mean, mean_dir
+
+    def summary(self):
+        if not self.count:
+            return None
+        return dict(speed=self.speed_sum / self.count,
+                    vec_speed=math.hypot(self.u_sum, self.v_sum) / self.count,
+                    dir=self._direction(self.u_sum, self.v_sum),
+                    gust=self.gust, gust_dir=self.gust_dir,
+                    samples=self.count)
+
+
+class DeadbandFilter(object):
+    """Passes a packet on only when a field has moved by more than its
+    deadband since the field was last passed on, or when no packet has been
+    passed on for heartbeat seconds.  Only the fields with a deadband are
+    watched.  A delta that is not zero, or a gust that changed, is always
+    passed on.  With changed_only, a packet has only the fields that
+    changed, except for a heartbeat packet, which is complete.  A heartbeat
+    that falls on a compact packet is completed with the latest value of
+    each other field read within the last heartbeat seconds."""
+
+    def __init__(self, deadbands, heartbeat=300, changed_only=False,
+                 deltas=None, gusts=None):
+        self.deadbands = dict((k, float(deadbands[k])) for k in deadbands)
+        self.heartbeat = heartbeat
+        self.changed_only = changed_only
+        self.deltas = deltas or []
+        self.gusts = gusts or []
+        self.last = dict()
+        self.last_ts = None
+        # the latest value and time of every field other than the deltas
+        self.latest = dict()
+        self.emitted = 0
+        self.suppressed = 0
+        # packets held back since the last one passed on
+        self.held = 0
+
+    def _changed(self, pkt):
+        changed = [k for k in self.deltas if pkt.get(k)]
+        changed.extend(k for k in self.gusts
+                       if k in pkt and (k not in self.last or
+                                        pkt[k] != self.last[k]))
+        for k, band in self.deadbands.iteritems():
+            if k not in pkt:
+                continue
+            x = pkt[k]
+            y = self.last.get(k)
+            if k not in self.last or (x is None) != (y is None) or \
+                    (x is not None and (abs(x - y) > band if band
+                                        else x != y)):
+                changed.append(k)
+        return changed
+
+    def filter(self, pkt):
+        """Returns the packet to pass on, or None to hold it back."""
+        changed = self._changed(pkt)
+        ts = pkt['dateTime']
+        for k in pkt:
+            if k not in self.deltas:
+                self.latest[k] = (pkt[k], ts)
+        if self.last_ts is None or ts - self.last_ts >= self.heartbeat:
+            # deltas are not carried forward, or they would be counted twice
+            out = dict((k, x) for k, (x, t) in self.latest.iteritems()
+                       if ts - t < self.heartbeat)
+            out.update(pkt)
+            changed = [k for k in out if k in self.deadbands or
+                       k in self.gusts]
+        elif not changed:
+            self.suppressed += 1
+            self.held += 1
+            return None
+        elif self.changed_only:
+            out = dict((k, pkt[k]) for k in changed)
+            out['dateTime'] = pkt['dateTime']
+            out['usUnits'] = pkt['usUnits']
         else:
-            data['wind_speed'] = None
-            data['wind_dir'] = None
-            data['wind_speed_2m'] = None
-            data['wind_dir_2m'] = None
-            data['wind_speed_10m'] = None
-            data['wind_dir_10m'] = None
-            data['wind_gust_speed'] = None
-            data['wind_gust_dir'] = None
-        return data
+            out = pkt
+            changed = [k for k in pkt if k in self.deadbands or
+                       k in self.gusts]
+        for k in changed:
+            if k in self.deadbands or k in self.gusts:
+                self.last[k] = out[k]
+        self.last_ts = ts
+        self.emitted += 1
+        self.held = 0
+        return out
 
-    def get_tph(self):
-        # all values are 16-bit signed integers with 0.1 multiplier
-        x = self._read_registers(220, 6)
-        return CM1._decode_tph(x)
+    def stats(self):
+        return dict(emitted=self.emitted, suppressed=self.suppressed,
+                    heartbeat=self.heartbeat)
 
-    @staticmethod
-    def _decode_tph(x):
-        data = dict()
-        data['tph_status'] = x[0]
-        if data['tph_status'] == -1:
-            pass # no sensor attached
+
+class StormTracker(object):
+    """Follows the lightning strike count of a station.  The lightning
+    group is read every idle seconds until the strike count or the lightning
+    status changes, then every burst seconds until hold seconds pass with no
+    change."""
+
+    def __init__(self, idle, burst, hold=600):
+        self.idle = idle
+        self.burst = burst
+        self.hold = hold
+        self.count = None
+        self.status = None
+        self.last_change = None
+        self.active = False
+
+    @property
+    def interval(self):
+        return self.burst if self.active else self.idle
+
+    def update(self, now, count, status):
+        """Returns the strikes since the previous count, or None if either
+        count is unknown."""
+        strikes = None
+        if count is not None and self.count is not None:
+            # the count starts again from zero when the station resets it
+            strikes = count - self.count if count >= self.count else count
+        changed = bool(strikes) or (status is not None and
+                                    self.status is not None and
+                                    status != self.status)
+        if count is not None:
+            self.count = count
+        if status is not None:
+            self.status = status
+        if changed:
+            self.last_change = now
+            self.active = True
+        elif self.active and now - self.last_change >= self.hold:
+            self.active = False
+        return strikes
+
+
+class CircuitBreaker(object):
+    """Stops polling a station that keeps failing.
+
+    After threshold consecutive failed polls the circuit opens, and the
+    station is not polled until the cooldown has passed.  Then a single
+    probe is allowed (half open).  If the probe succeeds the circuit
+    closes; if it fails the circuit opens again with twice the cooldown, up
+    to max_cooldown."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, threshold=3, cooldown=60, max_cooldown=600):
+        self.name = name
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self, now):
+        if self.state == CircuitBreaker.OPEN:
+            if now - self.opened_at < self.cooldown:
+                return False
+            self.state = CircuitBreaker.HALF_OPEN
+        return True
+
+    def success(self):
+        if self.state != CircuitBreaker.CLOSED:
+            loginf("%s: circuit closed" % self.name)
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.cooldown = self.base_cooldown
+
+    def failure(self, now):
+        self.failures += 1
+        if self.state == CircuitBreaker.HALF_OPEN:
+            self.cooldown = min(2 * self.cooldown, self.max_cooldown)
+        elif self.failures < self.threshold:
+            return
+        self.state = CircuitBreaker.OPEN
+        self.opened_at = now
+        logerr("%s: circuit open after %s failures, next try in %s s" %
+               (self.name, self.failures, self.cooldown))
+
+
+class RTTEstimator(object):
+    """Estimate the response time of a transaction and derive a timeout
+    from it, using the smoothed mean and deviation as tcp does.  After a
+    failure the timeout is doubled, up to the maximum, until a response
+    is seen again."""
+
+    def __init__(self, min_timeout, max_timeout):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.srtt = None
+        self.rttvar = None
+        self.timeout = max_timeout
+
+    def update(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
         else:
-            if data['tph_status'] & 0x01 == 0x01:
-                data['temperature'] = None
-                data['humidity'] = None
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4
+            self.srtt += (rtt - self.srtt) / 8
+        self.timeout = max(self.min_timeout,
+                           min(self.max_timeout, self.srtt + 4 * self.rttvar))
+
+    def backoff(self):
+        self.timeout = min(2 * self.timeout, self.max_timeout)
+
+
+class LatencyHistogram(object):
+    """Counts of transaction latencies in fixed buckets.  Percentiles are
+    reported as the upper bound of the bucket that holds them."""
+
+    BOUNDS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+              1.0, 2.0, 5.0] # seconds
+
+    def __init__(self):
+        self.counts = [0] * (len(LatencyHistogram.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, x):
+        self.counts[bisect.bisect_left(LatencyHistogram.BOUNDS, x)] += 1
+        self.count += 1
+        self.total += x
+        if x > self.max:
+            self.max = x
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n >= p * self.count:
+                break
+        if i < len(LatencyHistogram.BOUNDS):
+            return LatencyHistogram.BOUNDS[i]
+        return self.max
+
+    def to_dict(self):
+        return dict(count=self.count, max=self.max,
+                    mean=self.total / self.count if self.count else None,
+                    p50=self.percentile(0.50), p90=self.percentile(0.90),
+                    p99=self.percentile(0.99),
+                    buckets=dict(zip(['%g' % b for b in
+                                      LatencyHistogram.BOUNDS] + ['inf'],
+                                     self.counts)))
+
+
+class TransactionStats(object):
+    """Counters for the transactions with one station: latency and bytes
+    for each register block, failures by kind and by modbus exception code,
+    and retries."""
+
+    def __init__(self, overhead=(8, 5)):
+        self.overhead = overhead
+        self.lock = threading.Lock()
+        self.blocks = dict()
+        self.timeouts = 0
+        self.crc_errors = 0
+        self.exceptions = dict((c, 0) for c in MODBUS_EXCEPTIONS)
+        self.other_errors = 0
+        self.retries = 0 # polls tried again
+        self.block_retries = 0 # blocks tried again within a poll
+        self.last = dict(transactions=0, errors=0, retries=0, latency=0.0)
+
+    def record(self, reg, cnt, write, elapsed, error=None):
+        key = "%s%s-%s" % ('write ' if write else '', reg, reg + cnt - 1)
+        with self.lock:
+            b = self.blocks.get(key)
+            if b is None:
+                b = dict(transactions=0, errors=0, bytes_sent=0,
+                         bytes_received=0, latency=LatencyHistogram())
+                self.blocks[key] = b
+            b['transactions'] += 1
+            if write:
+                b['bytes_sent'] += self.overhead[0] + 1 + 2 * cnt
             else:
-                data['temperature'] = x[1] * 0.1
-                data['humidity'] = x[2] * 0.1
-            if data['tph_status'] & 0x02 == 0x02:
-                data['pressure'] = None
-                data['pressure_trend'] = None
-                data['temperature_p'] = None
+                b['bytes_sent'] += self.overhead[0]
+            if error is None:
+                b['latency'].add(elapsed)
+                if write:
+                    b['bytes_received'] += self.overhead[0]
+                else:
+                    b['bytes_received'] += self.overhead[1] + 2 * cnt
+                return
+            b['errors'] += 1
+            kind, code = classify_error(error)
+            if kind == 'timeout':
+                self.timeouts += 1
+            elif kind == 'crc':
+                self.crc_errors += 1
+            elif kind == 'exception':
+                self.exceptions[code] = self.exceptions.get(code, 0) + 1
             else:
-                data['pressure'] = x[3] * 0.1
-                data['pressure_trend'] = x[4]
-                data['temperature_p'] = x[5] * 0.1
-        return data
+                self.other_errors += 1
 
-    def get_rain(self):
-        x = self._read_registers(242, 2)
-        return CM1._decode_rain(x)
+    def _totals(self):
+        n = sum(b['transactions'] for b in self.blocks.values())
+        e = sum(b['errors'] for b in self.blocks.values())
+        t = sum(b['latency'].total for b in self.blocks.values())
+        return n, e, t
 
-    @staticmethod
-    def _decode_rain(x):
-        # multiplier converts to mm
-        data = dict()
-        data['rain_day_total'] = x[0]
-        data['rain_rate'] = x[1]
-        return data
+    def snapshot(self):
+        with self.lock:
+            blocks = dict()
+            for key, b in self.blocks.iteritems():
+                blocks[key] = dict(b)
+                blocks[key]['latency'] = b['latency'].to_dict()
+            n, e, _ = self._totals()
+            return dict(blocks=blocks, transactions=n, errors=e,
+                        timeouts=self.timeouts, crc_errors=self.crc_errors,
+                        exceptions=dict(('%02d' % c, self.exceptions[c])
+                                        for c in self.exceptions),
+                        other_errors=self.other_errors,
+                        retries=self.retries,
+                        block_retries=self.block_retries)
 
-    def get_analog_1(self):
-        x = self._read_registers(244, 2)
-        return CM1._decode_analog(x, 1)
+    def packet_fields(self, prefix=''):
+        """Counts since the previous call, for use as loop packet fields.
+        The latency is the mean of the successful transactions, in ms."""
+        with self.lock:
+            n, e, t = self._totals()
+            r = self.retries + self.block_retries
+            ok = (n - e) - (self.last['transactions'] - self.last['errors'])
+            pkt = {
+                prefix + 'cm1_transactions': n - self.last['transactions'],
+                prefix + 'cm1_errors': e - self.last['errors'],
+                prefix + 'cm1_retries': r - self.last['retries'],
+                prefix + 'cm1_latency':
+                    1000.0 * (t - self.last['latency']) / ok if ok else None}
+            self.last = dict(transactions=n, errors=e, retries=r, latency=t)
+            return pkt
 
-    def get_analog_2(self):
-        x = self._read_registers(246, 2)
-        return CM1._decode_analog(x, 2)
 
-    @staticmethod
-    def _decode_analog(x, label=1):
-        data = dict()
-        data['analog_%s' % label] = CM1._to_float(x[0], x[1])
-        return data
+class StatsServer(threading.Thread):
+    """Serve statistics as json, to any client that connects to the unix
+    socket at path, or to an http request on the tcp port."""
 
-    def get_calculated(self):
-        x = self._read_registers(240, 2)
-        y = self._read_registers(248, 2)
-        return CM1._decode_calculated(x+y)
+    def __init__(self, get_stats, path=None, port=None, host='127.0.0.1'):
+        threading.Thread.__init__(self, name='cm1-stats')
+        self.setDaemon(True)
+        self.get_stats = get_stats
+        self.listeners = dict()
+        self.running = True
+        if path:
+            if os.path.exists(path):
+                os.unlink(path)
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.bind(path)
+            s.listen(5)
+            self.listeners[s] = False
+            self.path = path
+            loginf("statistics on unix socket %s" % path)
+        if port:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((host, port))
+            s.listen(5)
+            self.listeners[s] = True
+            loginf("statistics on http://%s:%s/" % (host, port))
 
-    @staticmethod
-    def _decode_calculated(x):
-        data = dict()
-        data['heatindex'] = CM1._to_calculated(x[0])
-        data['windchill'] = CM1._to_calculated(x[1])
-        data['dewpoint'] = CM1._to_calculated(x[2])
-        data['wetbulb'] = CM1._to_calculated(x[3])
-        return data
+    def stop(self):
+        self.running = False
+        self.join(5)
 
-    def get_lightning(self):
-        x = self._read_registers(280, 12)
-        return CM1._decode_lightning(x)
+    def run(self):
+        while self.running:
+            r, _, _ = select.select(self.listeners.keys(), [], [], 0.5)
+            for s in r:
+                try:
+                    self._answer(s.accept()[0], self.listeners[s])
+                except (socket.error, IOError), e:
+                    logdbg("statistics request failed: %s" % e)
+        for s in self.listeners:
+            s.close()
+        if hasattr(self, 'path') and os.path.exists(self.path):
+            os.unlink(self.path)
 
-    @staticmethod
-    def _decode_lightning(x):
-        data = dict()
-        data['lightning_status'] = x[0] # 0-3
-        if data['lightning_status'] == 0x0080:
-            data['lightning_strike_count'] = None
-            data['lightning_noise_count'] = None
-            data['lightning_disturber_count'] = None
-            data['lightning_distance'] = None
-            data['lightning_energy'] = None
-            data['lightning_strike_count_10m'] = None
-            data['lightning_strike_count_30m'] = None
-            data['lightning_strike_count_60m'] = None
-            data['lightning_noise_count_60m'] = None
-            data['lightning_disturber_count_60m'] = None
-        else:
-            data['lightning_strike_count'] = x[1]
-            data['lightning_noise_count'] = x[2]
-            data['lightning_disturber_count'] = x[3]
-            data['lightning_distance'] = x[4] # 0-40 km; 63=out-of-range
-            data['lightning_energy'] = CM1._to_long(x[5], x[6])
-            data['lightning_strike_count_10m'] = x[7]
-            data['lightning_strike_count_30m'] = x[8]
-            data['lightning_strike_count_60m'] = x[9]
-            data['lightning_noise_count_60m'] = x[10]
-            data['lightning_disturber_count_60m'] = x[11]
-        return data
+    def _answer(self, conn, http):
+        try:
+            conn.settimeout(2)
+            body = json.dumps(self.get_stats(), sort_keys=True)
+            if http:
+                # read the request; the answer is the same for any path
+                req = ''
+                while '\r\n\r\n' not in req and '\n\n' not in req:
+                    x = conn.recv(1024)
+                    if not x:
+                        break
+                    req += x
+                conn.sendall("HTTP/1.0 200 OK\r\n"
+                             "Content-Type: application/json\r\n"
+                             "Content-Length: %d\r\n\r\n" % len(body))
+            conn.sendall(body)
+        finally:
+            conn.close()
 
 
-if __name__ == '__main__':
-    import optparse
+class _PortWorker(threading.Thread):
+    # polls the stations on one port each time a request is queued
 
-    usage = """%prog [options] [--debug] [--help]"""
+    def __init__(self, driver, stations, results):
+        threading.Thread.__init__(self, name='cm1-%s' % stations[0].port)
+        self.setDaemon(True)
+        self.driver = driver
+        self.stations = stations
+        self.requests = Queue.Queue()
+        self.results = results
 
-    def main():
-        syslog.openlog('wee_cm1', syslog.LOG_PID | syslog.LOG_CONS)
-        parser = optparse.OptionParser(usage=usage)
-        parser.add_option('--version', dest='version', action='store_true',
-                          help='display driver version')
-        parser.add_option('--debug', dest='debug', action='store_true',
-                          help='display diagnostic information while running')
-        parser.add_option('--port', dest='port', metavar='PORT',
-                          help='serial port to which the station is connected',
-                          default=CM1.DEFAULT_PORT)
-        parser.add_option('--address', dest='address', metavar='ADDRESS',
-                          help='modbus slave address', type=int,
-                          default=CM1.DEFAULT_ADDRESS)
-        parser.add_option('--baud-rate', dest='baud_rate', metavar='BAUD_RATE',
-                          help='modbus slave baud rate', type=int,
-                          default=CM1.DEFAULT_BAUD_RATE)
-        parser.add_option('--timeout', dest='timeout', metavar='TIMEOUT',
-                          help='modbus timeout, in seconds', type=int,
-                          default=CM1.DEFAULT_TIMEOUT)
-        parser.add_option('--get-time', dest='gettime', action='store_true',
-                          help='get station time')
-        parser.add_option('--set-time', dest='settime', action='store_true',
-                          help='set station time to computer time')
-        (options, _) = parser.parse_args()
+    def run(self):
+        while True:
+            req = self.requests.get()
+            if req is None:
+                break
+            now, span = req
+            try:
+                self.results.put(self.driver._poll_group(self.stations, now,
+                                                         span))
+            except Exception, e:
+                self.results.put(e)
 
-        if options.version:
-            print "cm1 driver version %s" % DRIVER_VERSION
-            exit(1)
 
-        if options.debug is not None:
-            syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_DEBUG))
-        else:
-            syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_INFO))
+class _AcquisitionThread(threading.Thread):
+    # owns the stations once the loop starts: polls on schedule and queues
+    # each packet in the driver's ring buffer
 
-        if False:
-            test_mmb(options.port, options.address, options.baud_rate,
-                     options.timeout, options.debug)
-        if False:
-            test_mbtk(options.port, options.address, options.baud_rate,
-                      options.timeout, options.debug)
-        if True:
-            test_CM1(options.port, options.address, options.baud_rate,
-                     options.timeout, options.debug,
-                     options.gettime, options.settime)
+    def __init__(self, driver):
+        threading.Thread.__init__(self, name='cm1-acquisition')
+        self.setDaemon(True)
+        self.driver = driver
+        self.stopped = driver.stopped
 
-    def test_CM1(port, address, baud_rate, timeout, debug, gettime, settime):
-        station = CM1(port, address, baud_rate, timeout)
-        station.debug = debug
-        if gettime:
-            print "epoch:", station.get_clock()
-            print "date:", station.get_date()
-            print "time:", station.get_time()
-            exit(0)
-        if settime:
-            print "epoch before:", station.get_clock()
-            station.set_clock()
-            print "epoch after:", station.get_clock()
-            print "date:", station.get_date()
+    def stop(self):
+        self.stopped.set()
+        self.join(10)
+
+    def run(self):
+        buf = self.driver.buffer
+        try:
+            while not self.stopped.isSet():
+                slot = self.driver.scheduler.wait(self.stopped)
+                if slot is None:
+                    break
+                pkt = self.driver._acquire(slot)
+                if pkt is None:
+                    continue
+                if not buf.put(pkt):
+                    if buf.dropped % 100 == 1:
+                        loginf("buffer full: %s packets dropped" %
+                               buf.dropped)
+        except EOFError, e:
+            # a replay has no more blocks.  the error is queued after the
+            # last packet, so the loop ends when it is reached.
+            loginf("replay finished: %s" % e)
+            buf.put(e, force=True)
+        except Exception, e:
+            logerr("acquisition failed: %s" % e)
+            buf.put(e, force=True)
+
+
+class _EventLoopThread(threading.Thread):
+    # runs the event loop that polls every station, when async_core is set
+
+    def __init__(self, driver):
+        threading.Thread.__init__(self, name='cm1-loop')
+        self.setDaemon(True)
+        self.driver = driver
+        self.loop = driver.loop
+
+    def stop(self):
+        self.loop.stop()
+        self.join(10)
+
+    def run(self):
+        f = self.loop.spawn(self.driver._acquire_async())
+        f.add_callback(self._failed)
+        self.loop.run_forever()
+
+    def _failed(self, f):
+        logerr("acquisition failed: %s" % f.error)
+        self.driver.buffer.put(f.error, force=True)
+        self.loop.running = False
+
+
+class RingBuffer(object):
+    """Bounded queue of packets with a preallocated ring of slots.
+
+    When the ring is full, the overflow policy decides which packet is lost:
+    drop_oldest replaces the oldest queued packet, drop_newest discards the
+    packet being added.  The depth, high water mark, and counts of queued
+    and dropped packets can be read at any time."""
+
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+
+    def __init__(self, size, overflow=DROP_OLDEST):
+        if overflow not in [RingBuffer.DROP_OLDEST, RingBuffer.DROP_NEWEST]:
+            raise ValueError("unknown overflow policy '%s'" % overflow)
+        self.size = max(1, size)
+        self.overflow = overflow
+        self.slots = [None] * self.size
+        self.head = 0 # next slot to read
+        self.depth = 0
+        self.high_water = 0
+        self.queued = 0
+        self.dropped = 0
+        self.cond = threading.Condition()
+
+    def put(self, item, force=False):
+        """Add an item.  Returns False if a packet was dropped.  If force is
+        set, the item is queued regardless of the overflow policy."""
+        with self.cond:
+            ok = True
+            if self.depth == self.size:
+                ok = False
+                self.dropped += 1
+                if self.overflow == RingBuffer.DROP_NEWEST and not force:
+                    return ok
+                self.head = (self.head + 1) % self.size
+                self.depth -= 1
+            self.slots[(self.head + self.depth) % self.size] = item
+            self.depth += 1
+            self.queued += 1
+            self.high_water = max(self.high_water, self.depth)
+            self.cond.notify()
+            return ok
+
+    def get(self, timeout=None):
+        """Remove and return the oldest item, or None on timeout."""
+        with self.cond:
+            if self.depth == 0:
+                self.cond.wait(timeout)
+                if self.depth == 0:
+                    return None
+            item = self.slots[self.head]
+            self.slots[self.head] = None
+            self.head = (self.head + 1) % self.size
+            self.depth -= 1
+            return item
+
+    def stats(self):
+        with self.cond:
+            return dict(depth=self.depth, size=self.size,
+                        high_water=self.high_water, queued=self.queued,
+                        dropped=self.dropped, overflow=self.overflow)
+
+
+class PollScheduler(object):
+    """Deadline scheduler for polling.  Polls are aligned to wall-clock
+    multiples of the interval, so the time spent in transactions and
+    retries does not accumulate as drift.  If a poll overruns, the slots
+    that were missed are skipped and counted instead of being run late."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_slot = None
+        self.missed = 0
+
+    def next(self, now):
+        """Return the time of the next slot, which may be now.  Slots that
+        have already passed are skipped and counted."""
+        if not self.interval:
+            return now
+        if self.next_slot is None:
+            # poll immediately, then align to the interval
+            self.next_slot = (now // self.interval + 1) * self.interval
+            return now
+        if now >= self.next_slot + self.interval:
+            skipped = int((now - self.next_slot) // self.interval)
+            self.missed += skipped
+            self.next_slot += skipped * self.interval
+            loginf("poll overran: skipped %s slots (%s total)" %
+                   (skipped, self.missed))
+        slot = self.next_slot
+        self.next_slot += self.interval
+        return slot
+
+    def wait(self, stopped=None):
+        """Sleep until the next slot, then return the time of the slot.  If
+        the event stopped is set while waiting, return None."""
+        now = time.time()
+        slot = self.next(now)
+        if slot > now:
+            if stopped is None:
+                time.sleep(slot - now)
+            elif stopped.wait(slot - now) or stopped.isSet():
+                return None
+        elif stopped is not None and stopped.isSet():
+            return None
+        return slot
+
+
+class RegisterMap(object):
+    """Decoder for a table of register fields.
+
+    names maps each hardware name to the list of names to use in the output
+    packet.  If names is None, every field is output using its hardware name.
+    A set of register blocks is compiled once into a plan that holds one
+    struct per block, so decoding a block is a single unpack followed by a
+    pass over the fields that have an output name."""
+
+    def __init__(self, fields, names=None):
+        self.fields = dict()
+        self.groups = dict()
+        for f in fields:
+            self.fields[f[0]] = f
+            self.groups.setdefault(f[1], []).append(f[0])
+        self.order = sorted(fields, key=lambda f: f[2])
+        if names is None:
+            names = dict((f[0], [f[0]]) for f in fields)
+        self.names = dict()
+        for k in names:
+            if k in self.fields:
+                self.names[k] = tuple(names[k])
+        self.plans = dict()
+
+    @staticmethod
+    def size(f):
+        return 2 if f[3] in 'If' else 1
+
+    def _needed(self, names):
+        # fields with output plus the status fields that gate them
+        needed = set()
+        for k in names:
+            needed.add(k)
+            gate = self.fields[k][6]
+            if gate is not None:
+                needed.add(gate[0])
+        return needed
+
+    def outputs(self, groups):
+        """Return the fields with an output name in any of the groups."""
+        return [k for k in self.names if self.fields[k][1] in groups]
+
+    def ranges(self, names=None, max_gap=0):
+        """Return the register ranges that hold the named fields, or every
+        field with an output name if names is None.  Ranges separated by no
+        more than max_gap registers are merged into a single range."""
+        if names is None:
+            names = self.names.keys()
+        regs = set()
+        for k in self._needed(names):
+            f = self.fields[k]
+            regs.update(range(f[2], f[2] + RegisterMap.size(f)))
+        blocks = []
+        for r in sorted(regs):
+            if blocks and r - (blocks[-1][0] + blocks[-1][1]) <= max_gap:
+                blocks[-1][1] = r - blocks[-1][0] + 1
+            else:
+                blocks.append([r, 1])
+        return [(r, n) for r, n in blocks]
+
+    def optimize(self, names=None, cost=None, max_count=None):
+        """Return the register blocks that hold the named fields, or every
+        field with an output name, in the least time.  cost is the time of a
+        transaction and the time of each register read, so a gap is read
+        through when that is cheaper than another transaction.  No block is
+        longer than max_count registers."""
+        if cost is None:
+            cost = transaction_cost(CM1.DEFAULT_BAUD_RATE)
+        if max_count is None:
+            max_count = CM1.MAX_READ_REGISTERS
+        segs = self.ranges(names)
+        # best[j] is the least cost of reading the first j segments, with
+        # the last block ending at segment j - 1
+        best = [0.0] + [None] * len(segs)
+        first = [0] * (len(segs) + 1)
+        for j in range(1, len(segs) + 1):
+            end = segs[j - 1][0] + segs[j - 1][1]
+            for i in range(j, 0, -1):
+                span = end - segs[i - 1][0]
+                if span > max_count and i < j:
+                    break
+                c = best[i - 1] + cost[0] + span * cost[1]
+                if best[j] is None or c < best[j]:
+                    best[j] = c
+                    first[j] = i
+        blocks = []
+        j = len(segs)
+        while j > 0:
+            i = first[j]
+            start = segs[i - 1][0]
+            blocks.append((start, segs[j - 1][0] + segs[j - 1][1] - start))
+            j = i - 1
+        blocks.reverse()
+        return blocks
+
+    def compile(self, blocks):
+        key = tuple(blocks)
+        if key not in self.plans:
+            self.plans[key] = _DecodePlan(self, key)
+        return self.plans[key]
+
+
+def transaction_cost(baud_rate, turnaround=0.005):
+    """Return the fixed time of one read transaction and the time of each
+    register it reads, in seconds, for modbus-rtu at baud_rate.  The fixed
+    time is the request, the response header and crc, the silent interval
+    before each frame, and the time the station takes to answer."""
+    char = 11.0 / baud_rate
+    return (8 + 5 + 7) * char + turnaround, 2 * char
+
+def plan_cost(blocks, cost):
+    return sum(cost[0] + n * cost[1] for _, n in blocks)
+
+
+class _DecodePlan(object):
+    # compiled decoder for a fixed set of register blocks
+
+    def __init__(self, regmap, blocks):
+        self.blocks = blocks
+        self.structs = []
+        needed = regmap._needed(regmap.names.keys())
+        index = dict()
+        for b, (start, cnt) in enumerate(blocks):
+            fmt = ['>']
+            reg = start
+            i = 0
+            for f in regmap.order:
+                sz = RegisterMap.size(f)
+                if f[0] not in needed or f[2] < start or f[2] + sz > start + cnt:
+                    continue
+                if f[2] > reg:
+                    fmt.append('%dx' % (2 * (f[2] - reg)))
+                fmt.append('4s' if f[3] == 'f' else f[3])
+                index[f[0]] = (b, i)
+                i += 1
+                reg = f[2] + sz
+            if reg < start + cnt:
+                fmt.append('%dx' % (2 * (start + cnt - reg)))
+            self.structs.append(struct.Struct(''.join(fmt)))
+        self.fields = []
+        self.groups = [set() for _ in blocks]
+        for f in regmap.order:
+            if f[0] not in regmap.names or f[0] not in index:
+                continue
+            self.groups[index[f[0]][0]].add(f[1])
+            gate = f[6]
+            if gate is not None:
+                if gate[0] not in index:
+                    continue
+                gate = index[gate[0]] + gate[1:]
+            b, i = index[f[0]]
+            self.fields.append((regmap.names[f[0]], b, i, f[4], f[5], gate,
+                                f[3] == 'f'))
+
+    def decode(self, raws, pkt):
+        # a block that could not be read is None, and its fields are skipped
+        vals = [s.unpack(raw) if raw is not None else None
+                for s, raw in zip(self.structs, raws)]
+        for names, b, i, scale, sentinel, gate, is_float in self.fields:
+            v = vals[b]
+            if v is None:
+                continue
+            x = v[i]
+            if gate is not None:
+                g = vals[gate[0]]
+                if g is None:
+                    continue
+                if ((g[gate[1]] & gate[2]) == gate[3]) != gate[4]:
+                    x = None
+            if x is None:
+                pass
+            elif x == sentinel:
+                x = None
+            elif is_float:
+                x = _FLOAT.unpack(x)[0]
+            elif scale is not None:
+                x *= scale
+            for name in names:
+                pkt[name] = x
+        return pkt
+
+
+# the station sends floats as two registers in native byte order
+_FLOAT = struct.Struct('f')
+
+
+def _make_crc_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
+
+_CRC_TABLE = _make_crc_table()
+
+def crc16(data):
+    """Modbus CRC16 of a bytearray, table-driven."""
+    crc = 0xFFFF
+    for c in data:
+        crc = (crc >> 8) ^ _CRC_TABLE[(crc ^ c) & 0xFF]
+    return crc
+
+
+MODBUS_EXCEPTIONS = {
+    1: 'illegal function',
+    2: 'illegal address',
+    3: 'illegal data value',
+    4: 'device failure'}
+
+
+class ModbusException(IOError):
+    """The station answered a request with a Modbus exception."""
+
+    def __init__(self, code):
+        IOError.__init__(self, "modbus exception %02d: %s" %
+                         (code, MODBUS_EXCEPTIONS.get(code, 'unknown')))
+        self.code = code
+
+
+class NoResponseError(IOError):
+    """The station did not answer before the timeout."""
+
+
+class CRCError(IOError):
+    """The response from the station failed the CRC check."""
+
+
+def classify_error(e):
+    """Return the kind of a transaction failure, one of timeout, crc,
+    exception or other, and the modbus exception code if there is one.
+    minimalmodbus reports failures by message, so match the text too."""
+    if isinstance(e, ModbusException):
+        return 'exception', e.code
+    if isinstance(e, NoResponseError):
+        return 'timeout', None
+    if isinstance(e, CRCError):
+        return 'crc', None
+    msg = str(e).lower()
+    if 'no communication' in msg or 'no answer' in msg:
+        return 'timeout', None
+    if 'checksum' in msg or 'crc' in msg:
+        return 'crc', None
+    if 'slave reported' in msg:
+        for code in MODBUS_EXCEPTIONS:
+            if MODBUS_EXCEPTIONS[code] in msg.replace('data address',
+                                                       'address'):
+                return 'exception', code
+    return 'other', None
+
+
+def _rtu_frame(address, pdu):
+    frame = bytearray([address]) + pdu
+    crc = crc16(frame)
+    frame.append(crc & 0xff)
+    frame.append(crc >> 8)
+    return frame
+
+def _check_pdu(fn, pdu):
+    # raise if the response pdu is an exception or does not match fn
+    if pdu[0] == fn | 0x80:
+        raise ModbusException(pdu[1])
+    if pdu[0] != fn:
+        raise IOError("unexpected function code %s in response to %s" %
+                      (pdu[0], fn))
+
+def _read_pdu(reg, cnt):
+    return bytearray(struct.pack('>BHH', 3, reg, cnt))
+
+def _write_pdu(reg, values):
+    n = len(values)
+    return bytearray(struct.pack('>BHHB%dH' % n, 16, reg, n, 2 * n, *values))
+
+
+class Transport(object):
+    """The link to the stations on one port.
+
+    A transport moves register reads and writes between the driver and a
+    station, whether the station is on a local serial port or behind a
+    network gateway.  Each transport implements read_block, which returns
+    the raw big-endian register payload that the decoder works on, and
+    write_registers.  read_registers and read_blocks are built on read_block.
+
+    Stations on the same port share one transport, so the port is opened
+    once and the gap between frames is kept across stations.  Each request
+    goes to the station at address, which is set before the request."""
+
+    # true if the transport can have several requests in flight at once
+    pipelined = False
+
+    # when the data are not live, the time at which they were read
+    recorded_time = None
+
+    # the baud rate of a serial link, or None if it has no baud rate
+    baud_rate = None
+
+    # bytes in a read request, and bytes other than the registers in the
+    # response to a read.  these are for modbus-rtu framing.
+    overhead = (8, 5)
+
+    @staticmethod
+    def create(port, address, baud_rate, timeout, pipeline=False,
+               client='native'):
+        """Choose the transport from the form of the port:
+          /dev/ttyUSB0 or COM1       - serial port
+          tcp://host:port            - modbus tcp gateway
+          rtu+tcp://host:port        - raw modbus rtu over tcp
+          replay:///path/to/file     - blocks from a capture file
+          cm1d:///path/to/socket     - through a CM1Daemon
+        A serial port uses the built-in modbus client unless client is
+        minimalmodbus, or pyserial is not available."""
+        if port.startswith('tcp://'):
+            host, tcp_port = Transport._parse(port[6:], 502)
+            return ModbusTCPTransport(host, tcp_port, address, timeout,
+                                      pipeline)
+        if port.startswith('rtu+tcp://'):
+            host, tcp_port = Transport._parse(port[10:], 4001)
+            return RTUOverTCPTransport(host, tcp_port, address, timeout)
+        if port.startswith('replay://'):
+            return ReplayTransport(port[9:], address)
+        if port.startswith('cm1d://'):
+            return DaemonTransport(port[7:], address, timeout)
+        if client == 'native' and serial is not None:
+            return RTUSerialTransport(port, address, baud_rate, timeout)
+        return SerialTransport(port, address, baud_rate, timeout)
+
+    @staticmethod
+    def _parse(netloc, default_port):
+        if ':' in netloc:
+            host, port = netloc.rsplit(':', 1)
+            return host, int(port)
+        return netloc, default_port
+
+    def read_block(self, reg, cnt):
+        raise NotImplementedError("read_block")
+
+    def read_registers(self, reg, cnt):
+        return list(struct.unpack('>%dH' % cnt, self.read_block(reg, cnt)))
+
+    def read_blocks(self, blocks):
+        """Read several blocks.  Returns the payload for each block, or the
+        exception raised while reading it."""
+        results = []
+        for reg, cnt in blocks:
+            try:
+                results.append(self.read_block(reg, cnt))
+            except (IOError, ValueError, TypeError), e:
+                results.append(e)
+        return results
+
+    def write_registers(self, reg, values):
+        raise NotImplementedError("write_registers")
+
+    def open(self):
+        """Open the port.  Ports are opened on first use, so creating a
+        transport does no i/o."""
+        pass
+
+    def close(self):
+        pass
+
+    @property
+    def settings(self):
+        return ''
+
+
+class RTUSerialTransport(Transport):
+    """Modbus-RTU on a local serial port, using pyserial directly.
+
+    Request frames are built once for each register block.  Responses are
+    read by exact length, so a transaction ends as soon as the last byte
+    arrives instead of when the port goes quiet, and the register payload is
+    handed to the decoder without a copy.  The 3.5 character silence between
+    frames is kept from the end of the previous response."""
+
+    def __init__(self, port, address, baud_rate, timeout):
+        self.serial = serial.Serial(None, baud_rate, bytesize=8, parity='N',
+                                    stopbits=1, timeout=timeout)
+        self.serial.port = port
+        self.address = address
+        self.debug = False
+        self.frames = dict()
+        self._set_baud_rate(baud_rate)
+        self.last_io = 0
+
+    def _get_timeout(self):
+        return self.serial.timeout
+
+    def _set_timeout(self, timeout):
+        self.serial.timeout = timeout
+
+    timeout = property(_get_timeout, _set_timeout)
+
+    def _get_baud_rate(self):
+        return self.serial.baudrate
+
+    def _set_baud_rate(self, baud_rate):
+        self.serial.baudrate = baud_rate
+        # 11 bits per character.  above 19200 baud the gap is fixed.
+        if baud_rate > 19200:
+            self.gap = 0.00175
+        else:
+            self.gap = 3.5 * 11.0 / baud_rate
+
+    baud_rate = property(_get_baud_rate, _set_baud_rate)
+
+    def open(self):
+        if not self.serial.is_open:
+            self.serial.open()
+
+    def _transact(self, frame, n):
+        # send a request and read a response of n bytes, or the 5 bytes of
+        # an exception response
+        self.open()
+        wait = self.last_io + self.gap - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        if self.serial.in_waiting:
+            # the rest of a response to an earlier request that timed out
+            self.serial.reset_input_buffer()
+        self.serial.write(frame)
+        resp = bytearray(self.serial.read(5))
+        if len(resp) == 5 and not resp[1] & 0x80 and n > 5:
+            resp += self.serial.read(n - 5)
+        self.last_io = time.time()
+        if self.debug:
+            print "request: %s response: %s" % (
+                ' '.join('%02x' % ord(c) for c in frame),
+                ' '.join('%02x' % c for c in resp))
+        if len(resp) < 5:
+            raise NoResponseError("no response from address %s" %
+                                  self.address)
+        if resp[1] & 0x80:
+            resp = resp[:5]
+        elif len(resp) < n:
+            raise NoResponseError("short response from address %s: %s of"
+                                  " %s bytes" % (self.address, len(resp), n))
+        if crc16(resp[:-2]) != resp[-2] + (resp[-1] << 8):
+            raise CRCError("bad crc in response")
+        if resp[0] != self.address:
+            raise IOError("response from address %s" % resp[0])
+        return resp
+
+    def read_block(self, reg, cnt):
+        frame = self.frames.get((self.address, reg, cnt))
+        if frame is None:
+            frame = bytes(_rtu_frame(self.address, _read_pdu(reg, cnt)))
+            self.frames[(self.address, reg, cnt)] = frame
+        resp = self._transact(frame, 5 + 2 * cnt)
+        _check_pdu(3, resp[1:-2])
+        if resp[2] != 2 * cnt:
+            raise IOError("expected %s registers, got %s bytes" %
+                          (cnt, resp[2]))
+        return buffer(resp, 3, 2 * cnt)
+
+    def write_registers(self, reg, values):
+        frame = bytes(_rtu_frame(self.address, _write_pdu(reg, values)))
+        _check_pdu(16, self._transact(frame, 8)[1:-2])
+
+    def close(self):
+        self.serial.close()
+
+    @property
+    def settings(self):
+        return "serial settings: %s:%s:%s:%s (built-in client)" % (
+            self.serial.baudrate, self.serial.bytesize,
+            self.serial.parity, self.serial.stopbits)
+
+
+class SerialTransport(Transport):
+    """Modbus-RTU on a local serial port, using minimalmodbus.  The module
+    is imported when the port is first used."""
+
+    def __init__(self, port, address, baud_rate, timeout):
+        self.port = port
+        self._address = address
+        self.instrument = None
+        self.serial = None
+        self._baud_rate = baud_rate
+        self._timeout = timeout
+        self._debug = False
+
+    def open(self):
+        if self.instrument is None:
+            import minimalmodbus
+            self.instrument = minimalmodbus.Instrument(self.port,
+                                                       self._address)
+            self.serial = self.instrument.serial
+            self.serial.baudrate = self._baud_rate
+            self.serial.timeout = self._timeout
+            self.instrument.debug = self._debug
+        return self.instrument
+
+    def _get_address(self):
+        return self._address
+
+    def _set_address(self, address):
+        self._address = address
+        if self.instrument is not None:
+            # minimalmodbus before 1.0 calls it slaveaddress
+            if hasattr(self.instrument, 'slaveaddress'):
+                self.instrument.slaveaddress = address
+            self.instrument.address = address
+
+    address = property(_get_address, _set_address)
+
+    def _get_timeout(self):
+        return self._timeout
+
+    def _set_timeout(self, timeout):
+        self._timeout = timeout
+        if self.serial is not None:
+            self.serial.timeout = timeout
+
+    timeout = property(_get_timeout, _set_timeout)
+
+    def _get_baud_rate(self):
+        return self._baud_rate
+
+    def _set_baud_rate(self, baud_rate):
+        self._baud_rate = baud_rate
+        if self.serial is not None:
+            self.serial.baudrate = baud_rate
+
+    baud_rate = property(_get_baud_rate, _set_baud_rate)
+
+    def _get_debug(self):
+        return self._debug
+
+    def _set_debug(self, debug):
+        self._debug = debug
+        if self.instrument is not None:
+            self.instrument.debug = debug
+
+    debug = property(_get_debug, _set_debug)
+
+    def read_block(self, reg, cnt):
+        values = self.open().read_registers(reg, cnt)
+        return struct.pack('>%dH' % cnt, *values)
+
+    def write_registers(self, reg, values):
+        self.open().write_registers(reg, values)
+
+    def close(self):
+        if self.serial is not None:
+            self.serial.close()
+
+    @property
+    def settings(self):
+        return "serial settings: %s:8:N:1 (minimalmodbus)" % self._baud_rate
+
+
+class _TCPConnection(object):
+    # persistent connection to a gateway, shared by every station that is
+    # reached through that gateway.  the connection is opened on first use
+    # and opened again after any error.
+
+    pool = dict()
+    pool_lock = threading.Lock()
+
+    KEEPALIVE_IDLE = 60 # seconds
+
+    @staticmethod
+    def get(host, port):
+        with _TCPConnection.pool_lock:
+            key = (host, port)
+            if key not in _TCPConnection.pool:
+                _TCPConnection.pool[key] = _TCPConnection(host, port)
+            return _TCPConnection.pool[key]
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.sock = None
+        self.lock = threading.RLock()
+        self.tid = 0
+        self.connects = 0
+
+    def next_tid(self):
+        self.tid = (self.tid + 1) & 0xffff
+        return self.tid
+
+    def connect(self, timeout):
+        if self.sock is not None:
+            return
+        try:
+            self.sock = socket.create_connection((self.host, self.port),
+                                                 timeout)
+        except socket.error, e:
+            raise IOError("cannot connect to %s:%s: %s" %
+                          (self.host, self.port, e))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+                                 _TCPConnection.KEEPALIVE_IDLE)
+        self.connects += 1
+        if self.connects > 1:
+            loginf("reconnected to %s:%s" % (self.host, self.port))
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+    def send(self, data, timeout):
+        self.connect(timeout)
+        try:
+            self.sock.settimeout(timeout)
+            self.sock.sendall(bytes(data))
+        except socket.error, e:
+            self.close()
+            raise IOError("send to %s:%s failed: %s" %
+                          (self.host, self.port, e))
+
+    def recv(self, n, timeout):
+        """Read exactly n bytes."""
+        buf = bytearray()
+        try:
+            self.sock.settimeout(timeout)
+            while len(buf) < n:
+                x = self.sock.recv(n - len(buf))
+                if not x:
+                    raise socket.error("connection closed")
+                buf += x
+        except socket.timeout:
+            # a late response would be taken for the next one
+            self.close()
+            raise NoResponseError("no response from %s:%s" %
+                                  (self.host, self.port))
+        except socket.error, e:
+            self.close()
+            raise IOError("receive from %s:%s failed: %s" %
+                          (self.host, self.port, e))
+        return buf
+
+
+class ModbusTCPTransport(Transport):
+    """Modbus TCP to a gateway, with the station address as the unit id.
+    Responses are matched to requests by transaction id, so with pipeline
+    enabled all the blocks of a poll are requested before any response is
+    read.  Some gateways accept only one request at a time, so pipelining
+    is off unless requested."""
+
+    overhead = (12, 9)
+
+    def __init__(self, host, port, address, timeout, pipeline=False):
+        self.conn = _TCPConnection.get(host, port)
+        self.address = address
+        self.timeout = timeout
+        self.pipelined = pipeline
+
+    def _send(self, pdu):
+        tid = self.conn.next_tid()
+        self.conn.send(struct.pack('>HHHB', tid, 0, len(pdu) + 1,
+                                   self.address) + bytes(pdu), self.timeout)
+        return tid
+
+    def _recv(self):
+        hdr = self.conn.recv(7, self.timeout)
+        tid, _, length, _ = struct.unpack('>HHHB', bytes(hdr))
+        if length < 2:
+            self.conn.close()
+            raise IOError("bad response length %s" % length)
+        return tid, self.conn.recv(length - 1, self.timeout)
+
+    def _transact(self, pdu):
+        with self.conn.lock:
+            tid = self._send(pdu)
+            while True:
+                rtid, resp = self._recv()
+                if rtid == tid:
+                    return resp
+                logdbg("discarded response with transaction id %s" % rtid)
+
+    def read_block(self, reg, cnt):
+        resp = self._transact(_read_pdu(reg, cnt))
+        _check_pdu(3, resp)
+        if resp[1] != 2 * cnt or len(resp) != 2 + 2 * cnt:
+            raise IOError("expected %s registers, got %s bytes" %
+                          (cnt, len(resp) - 2))
+        return bytes(resp[2:])
+
+    def read_blocks(self, blocks):
+        if not self.pipelined:
+            return Transport.read_blocks(self, blocks)
+        results = [None] * len(blocks)
+        with self.conn.lock:
+            try:
+                pending = dict()
+                for i, (reg, cnt) in enumerate(blocks):
+                    pending[self._send(_read_pdu(reg, cnt))] = i
+                while pending:
+                    tid, resp = self._recv()
+                    if tid not in pending:
+                        continue
+                    i = pending.pop(tid)
+                    try:
+                        _check_pdu(3, resp)
+                        if resp[1] != 2 * blocks[i][1]:
+                            raise IOError("short response")
+                        results[i] = bytes(resp[2:])
+                    except IOError, e:
+                        results[i] = e
+            except IOError, e:
+                for i in range(len(results)):
+                    if results[i] is None:
+                        results[i] = e
+        return results
+
+    def write_registers(self, reg, values):
+        _check_pdu(16, self._transact(_write_pdu(reg, values)))
+
+    @property
+    def settings(self):
+        return "modbus tcp: %s:%s unit %s%s" % (
+            self.conn.host, self.conn.port, self.address,
+            " (pipelined)" if self.pipelined else "")
+
+
+class RTUOverTCPTransport(Transport):
+    """Modbus-RTU frames, with CRC, carried over a tcp connection to a
+    transparent serial gateway.  RTU frames have no transaction id, so
+    requests are never pipelined."""
+
+    def __init__(self, host, port, address, timeout):
+        self.conn = _TCPConnection.get(host, port)
+        self.address = address
+        self.timeout = timeout
+
+    def _transact(self, pdu):
+        with self.conn.lock:
+            self.conn.send(_rtu_frame(self.address, pdu), self.timeout)
+            resp = self.conn.recv(3, self.timeout)
+            fn = resp[1]
+            if fn & 0x80:
+                n = 2
+            elif fn in [3, 4]:
+                n = resp[2] + 2
+            else:
+                n = 5 # echo of address and count, plus crc
+            resp += self.conn.recv(n, self.timeout)
+        if crc16(resp[:-2]) != resp[-2] + (resp[-1] << 8):
+            raise CRCError("bad crc in response")
+        if resp[0] != self.address:
+            raise IOError("response from address %s" % resp[0])
+        return resp[1:-2]
+
+    def read_block(self, reg, cnt):
+        resp = self._transact(_read_pdu(reg, cnt))
+        _check_pdu(3, resp)
+        if resp[1] != 2 * cnt:
+            raise IOError("expected %s registers, got %s bytes" %
+                          (cnt, resp[1]))
+        return bytes(resp[2:])
+
+    def write_registers(self, reg, values):
+        _check_pdu(16, self._transact(_write_pdu(reg, values)))
+
+    @property
+    def settings(self):
+        return "rtu over tcp: %s:%s address %s" % (
+            self.conn.host, self.conn.port, self.address)
+
+
+class RawRecorder(object):
+    """Append raw register blocks to a capture file.
+
+    The file is a header followed by fixed-size records, so it can be
+    memory-mapped and indexed directly.  Each record holds the time, the
+    station address, the first register and the register count, then the
+    payload as it came from the station, padded to the largest read.
+    Stations that share a file share one recorder."""
+
+    MAGIC = 'CM1R'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHH') # magic, version, payload registers
+    RECORD = struct.Struct('<dBxHH') # time, address, register, count
+    CAPACITY = 125 # registers, the most in one modbus read
+
+    _recorders = dict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get(path):
+        with RawRecorder._lock:
+            if path not in RawRecorder._recorders:
+                RawRecorder._recorders[path] = RawRecorder(path)
+            return RawRecorder._recorders[path]
+
+    def __init__(self, path, capacity=CAPACITY):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(RawRecorder.HEADER.pack(
+                RawRecorder.MAGIC, RawRecorder.VERSION, capacity))
+            self.file.flush()
+        else:
+            capacity = _read_capture_header(path)
+        self.capacity = capacity
+        self.record_size = RawRecorder.RECORD.size + 2 * capacity
+        self.count = 0
+        loginf("recording raw registers to %s" % path)
+
+    def write(self, ts, address, reg, payload):
+        payload = str(payload)
+        pad = '\0' * (2 * self.capacity - len(payload))
+        with self.lock:
+            if self.file is None:
+                return
+            try:
+                self.file.write(RawRecorder.RECORD.pack(
+                    ts, address, reg, len(payload) // 2) + payload + pad)
+                self.file.flush()
+                self.count += 1
+            except (IOError, OSError), e:
+                # losing the capture must not stop the driver
+                logerr("recording to %s failed: %s" % (self.path, e))
+                self.file = None
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def _read_capture_header(path):
+    # returns the payload capacity of a capture file, in registers
+    with open(path, 'rb') as f:
+        header = f.read(RawRecorder.HEADER.size)
+    if len(header) < RawRecorder.HEADER.size:
+        raise IOError("%s is not a capture file" % path)
+    magic, version, capacity = RawRecorder.HEADER.unpack(header)
+    if magic != RawRecorder.MAGIC or version != RawRecorder.VERSION:
+        raise IOError("%s is not a version %s capture file" %
+                      (path, RawRecorder.VERSION))
+    return capacity
+
+
+class ReplayTransport(Transport):
+    """Register blocks from a capture file, memory-mapped.  Each read is
+    answered with the next recorded block from the station that covers the
+    requested registers, so a plan with different blocks from the one that
+    was recorded can still be replayed.  The payload is a buffer into the
+    map, so records are decoded without a copy.  The end of the capture
+    raises EOFError."""
+
+    # how many records to look ahead for a block before giving up
+    MAX_SKIP = 64
+
+    def __init__(self, path, address=None):
+        self.path = path
+        self.address = address
+        self.timeout = 0
+        capacity = _read_capture_header(path)
+        self.record_size = RawRecorder.RECORD.size + 2 * capacity
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size - RawRecorder.HEADER.size
+        # a partial record at the end was being written when copied
+        self.count = size // self.record_size
+        self.map = None
+        if self.count:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        self.pos = 0
+
+    def __len__(self):
+        return self.count
+
+    def record(self, i):
+        off = RawRecorder.HEADER.size + i * self.record_size
+        ts, address, reg, cnt = RawRecorder.RECORD.unpack_from(self.map, off)
+        return ts, address, reg, cnt, buffer(
+            self.map, off + RawRecorder.RECORD.size, 2 * cnt)
+
+    def records(self):
+        """Generate (time, address, register, count, payload) for every
+        record in the file."""
+        for i in xrange(self.count):
+            yield self.record(i)
+
+    def read_block(self, reg, cnt):
+        for i in xrange(self.pos, min(self.pos + ReplayTransport.MAX_SKIP,
+                                      self.count)):
+            ts, address, r, c, payload = self.record(i)
+            if self.address is not None and address != self.address:
+                continue
+            if r <= reg and reg + cnt <= r + c:
+                self.pos = i + 1
+                self.recorded_time = ts
+                return buffer(payload, 2 * (reg - r), 2 * cnt)
+        if self.pos >= self.count:
+            raise EOFError("end of capture %s" % self.path)
+        raise IOError("no recorded block for %s registers at %s" %
+                      (cnt, reg))
+
+    def write_registers(self, reg, values):
+        raise IOError("cannot write to a capture")
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    @property
+    def settings(self):
+        return "replay of %s: %s records" % (self.path, self.count)
+
+
+class DaemonTransport(Transport):
+    """Register reads and writes through a CM1Daemon on a unix socket, so
+    that a process can use a station whose port is owned by the daemon.
+    The daemon times the transactions on the bus, so the socket timeout is
+    fixed when the transport is created, and allows for the daemon being
+    busy with other clients."""
+
+    def __init__(self, path, address, timeout):
+        self.path = path
+        self.address = address
+        self.timeout = timeout
+        self.socket_timeout = 2 * timeout + 1
+        self.sock = None
+        self.rfile = None
+
+    def open(self):
+        if self.sock is None:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.settimeout(self.socket_timeout)
+            try:
+                s.connect(self.path)
+            except socket.error, e:
+                s.close()
+                raise IOError("cannot connect to cm1 daemon at %s: %s" %
+                              (self.path, e))
+            self.sock = s
+            self.rfile = s.makefile('rb')
+
+    def request(self, **req):
+        """Send a request to the daemon and return its response.  A failure
+        reported by the daemon is raised as the same kind of error."""
+        self.open()
+        try:
+            self.sock.sendall(json.dumps(req) + "\n")
+            line = self.rfile.readline()
+        except socket.timeout:
+            self.close()
+            raise NoResponseError("no response from cm1 daemon")
+        except socket.error, e:
+            self.close()
+            raise IOError("cm1 daemon connection failed: %s" % e)
+        if not line:
+            self.close()
+            raise IOError("cm1 daemon closed the connection")
+        resp = json.loads(line)
+        if 'error' in resp:
+            kind = resp.get('kind')
+            if kind == 'exception':
+                raise ModbusException(resp['code'])
+            if kind == 'timeout':
+                raise NoResponseError(resp['error'])
+            if kind == 'crc':
+                raise CRCError(resp['error'])
+            raise IOError(resp['error'])
+        return resp
+
+    def read_block(self, reg, cnt):
+        resp = self.request(op='read', address=self.address, register=reg,
+                            count=cnt)
+        return resp['data'].decode('hex')
+
+    def read_logger(self, status, pos, n):
+        """Return the raw logger records at pos.  The daemon selects and reads
+        each page in one request, so other clients cannot move the logger
+        window between the two."""
+        pages = []
+        while n > 0:
+            cnt = min(n, CM1.LOGGER_RECORDS_PER_READ)
+            resp = self.request(op='logger_read', address=self.address,
+                                count=status['count'],
+                                newest=status['newest'], position=pos,
+                                records=cnt)
+            pages.append(resp['data'].decode('hex'))
+            pos += cnt
+            n -= cnt
+        return ''.join(pages)
+
+    def write_registers(self, reg, values):
+        self.request(op='write', address=self.address, register=reg,
+                     values=list(values))
+
+    def close(self):
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+            self.sock = None
+            self.rfile = None
+
+    @property
+    def settings(self):
+        return "cm1 daemon at %s" % self.path
+
+
+class RegisterCache(object):
+    """Register blocks read from a station, with the time each was read.  A
+    read is answered from the newest block that covers it, if that block is
+    less than ttl seconds old.  At most max_blocks are kept, and the oldest
+    is dropped first."""
+
+    DEFAULT_BLOCKS = 32
+
+    def __init__(self, ttl, max_blocks=DEFAULT_BLOCKS):
+        self.ttl = ttl
+        self.max_blocks = max_blocks
+        # (time, register, count, payload), oldest first
+        self.blocks = []
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, reg, cnt, now=None):
+        """Return (time, payload) for cnt registers at reg, or None."""
+        if now is None:
+            now = time.time()
+        self.blocks = [b for b in self.blocks if now - b[0] <= self.ttl]
+        for ts, r, c, payload in reversed(self.blocks):
+            if r <= reg and reg + cnt <= r + c:
+                self.hits += 1
+                return ts, buffer(payload, 2 * (reg - r), 2 * cnt)
+        self.misses += 1
+        return None
+
+    def put(self, reg, cnt, payload, now=None):
+        if now is None:
+            now = time.time()
+        self.blocks = [b for b in self.blocks if (b[1], b[2]) != (reg, cnt)]
+        self.blocks.append((now, reg, cnt, str(payload)))
+        if len(self.blocks) > self.max_blocks:
+            del self.blocks[0]
+
+    def invalidate(self, reg=None, cnt=1):
+        """Drop the blocks that overlap cnt registers at reg, or every block
+        if reg is None."""
+        self.blocks = [b for b in self.blocks if reg is not None and
+                       (b[1] + b[2] <= reg or reg + cnt <= b[1])]
+
+    def to_dict(self):
+        return dict(ttl=self.ttl, blocks=len(self.blocks), hits=self.hits,
+                    misses=self.misses)
+
+
+class CM1(object):
+    DEFAULT_PORT = '/dev/ttyUSB0'
+    DEFAULT_ADDRESS = 1
+    DEFAULT_BAUD_RATE = 19200
+    DEFAULT_TIMEOUT = 6.0 # seconds
+    DEFAULT_MIN_TIMEOUT = 0.2 # seconds
+    DEFAULT_TURNAROUND = 0.005 # seconds from request to response
+
+    SYSTEM_PARAMETERS = ['serial_number', 'product_id', 'firmware_version',
+                         'date', 'time', 'battery_voltage', 'solar_voltage',
+                         'charger_status']
+
+    CHARGER_STATUS = {
+        0: 'Off',
+        1: 'Fast', # current-limited
+        2: 'Fast Top', # voltage-limited
+        3: 'Float Charge' } # low voltage charge
+
+    # Register map.  Each field is
+    #   (name, group, register, type, scale, sentinel, gate)
+    # type is a struct code: H is unsigned 16-bit, h is signed 16-bit, I is
+    # unsigned 32-bit, f is 32-bit float.  A raw value equal to the sentinel
+    # is reported as None.  The gate (status, mask, value, equal) marks the
+    # field as valid only when ((status & mask) == value) == equal, otherwise
+    # the field is reported as None.
+    WIND_OK = ('wind_status', 0xffff, 0, True)
+    TH_OK = ('tph_status', 0x01, 0, True)
+    P_OK = ('tph_status', 0x02, 0, True)
+    LIGHTNING_OK = ('lightning_status', 0xffff, 0x0080, False)
+    REGISTER_MAP = [
+        ('product_id', 'system', 100, 'h', None, None, None),
+        ('firmware_version', 'system', 101, 'H', None, None, None),
+        ('serial_number', 'system', 102, 'I', None, None, None),
+        ('time', 'system', 104, 'I', None, None, None), # HHMMSS
+        ('date', 'system', 106, 'I', None, None, None), # YYMMDD
+        ('battery_voltage', 'power', 108, 'H', 0.001, None, None),
+        ('solar_voltage', 'power', 109, 'H', 0.001, None, None),
+        ('charger_status', 'power', 110, 'H', None, None, None),
+        # wind and tph values are 16-bit signed integers with 0.1 multiplier
+        ('wind_status', 'wind', 200, 'H', None, None, None),
+        ('wind_speed', 'wind', 201, 'h', 0.1, None, WIND_OK), # m/s
+        ('wind_dir', 'wind', 202, 'h', 0.1, None, WIND_OK), # compass degree
+        ('wind_speed_2m', 'wind', 203, 'h', 0.1, None, WIND_OK),
+        ('wind_dir_2m', 'wind', 204, 'h', 0.1, None, WIND_OK),
+        ('wind_speed_10m', 'wind', 205, 'h', 0.1, None, WIND_OK),
+        ('wind_dir_10m', 'wind', 206, 'h', 0.1, None, WIND_OK),
+        ('wind_gust_speed', 'wind', 207, 'h', 0.1, None, WIND_OK),
+        ('wind_gust_dir', 'wind', 208, 'h', 0.1, None, WIND_OK),
+        ('tph_status', 'tph', 220, 'H', None, None, None),
+        ('temperature', 'tph', 221, 'h', 0.1, None, TH_OK),
+        ('humidity', 'tph', 222, 'h', 0.1, None, TH_OK),
+        ('pressure', 'tph', 223, 'h', 0.1, None, P_OK),
+        ('pressure_trend', 'tph', 224, 'h', None, None, P_OK),
+        ('temperature_p', 'tph', 225, 'h', 0.1, None, P_OK),
+        ('heatindex', 'calculated', 240, 'h', 0.1, -9990, None),
+        ('windchill', 'calculated', 241, 'h', 0.1, -9990, None),
+        # rain values are bucket tips; the driver converts to mm
+        ('rain_day_total', 'rain', 242, 'H', None, None, None),
+        ('rain_rate', 'rain', 243, 'H', None, None, None),
+        ('analog_1', 'analog', 244, 'f', None, None, None),
+        ('analog_2', 'analog', 246, 'f', None, None, None),
+        ('dewpoint', 'calculated', 248, 'h', 0.1, -9990, None),
+        ('wetbulb', 'calculated', 249, 'h', 0.1, -9990, None),
+        ('lightning_status', 'lightning', 280, 'H', None, None, None),
+        ('lightning_strike_count', 'lightning', 281, 'H', None, None,
+         LIGHTNING_OK),
+        ('lightning_noise_count', 'lightning', 282, 'H', None, None,
+         LIGHTNING_OK),
+        ('lightning_disturber_count', 'lightning', 283, 'H', None, None,
+         LIGHTNING_OK),
+        # 0-40 km; 63=out-of-range
+        ('lightning_distance', 'lightning', 284, 'H', None, None,
+         LIGHTNING_OK),
+        ('lightning_energy', 'lightning', 285, 'I', None, None,
+         LIGHTNING_OK),
+        ('lightning_strike_count_10m', 'lightning', 287, 'H', None, None,
+         LIGHTNING_OK),
+        ('lightning_strike_count_30m', 'lightning', 288, 'H', None, None,
+         LIGHTNING_OK),
+        ('lightning_strike_count_60m', 'lightning', 289, 'H', None, None,
+         LIGHTNING_OK),
+        ('lightning_noise_count_60m', 'lightning', 290, 'H', None, None,
+         LIGHTNING_OK),
+        ('lightning_disturber_count_60m', 'lightning', 291, 'H', None, None,
+         LIGHTNING_OK),
+    ]
+
+    # logger status: interval (minutes), record count (32-bit), index of the
+    # newest record (32-bit).  the select register holds the 32-bit index of
+    # the first record in the logger window.  none of this is in the
+    # published register map, so the status is checked against the values
+    # it can have before the logger is read.
+    LOGGER_INTERVALS = [1, 2, 5, 10, 15, 20, 30, 60] # minutes
+    LOGGER_STATUS_REGISTER = 120
+    LOGGER_SELECT_REGISTER = 125
+    LOGGER_WINDOW_REGISTER = 1000
+    LOGGER_CAPACITY = 49152 # records
+    LOGGER_RECORD_SIZE = 20 # registers per record
+    MAX_READ_REGISTERS = 125 # modbus limit for a single read
+    LOGGER_RECORDS_PER_READ = MAX_READ_REGISTERS // LOGGER_RECORD_SIZE
+    # records downloaded and decoded together
+    LOGGER_BATCH = 300
+
+    # logger record layout, after the time and date registers (0-3).  each
+    # field is (name, offset, type, scale, sentinel), as in REGISTER_MAP.
+    LOGGER_RECORD_MAP = [
+        ('wind_speed', 4, 'h', 0.1, None),
+        ('wind_dir', 5, 'h', 0.1, None),
+        ('wind_gust_speed', 6, 'h', 0.1, None),
+        ('wind_gust_dir', 7, 'h', 0.1, None),
+        ('temperature', 8, 'h', 0.1, None),
+        ('humidity', 9, 'h', 0.1, None),
+        ('pressure', 10, 'h', 0.1, None),
+        ('rain_total', 11, 'H', None, None), # bucket tips in the interval
+        ('heatindex', 12, 'h', 0.1, -9990),
+        ('windchill', 13, 'h', 0.1, -9990),
+        ('dewpoint', 14, 'h', 0.1, -9990),
+        ('wetbulb', 15, 'h', 0.1, -9990),
+        ('analog_1', 16, 'f', None, None),
+        ('analog_2', 18, 'f', None, None),
+    ]
+    LOGGER_FORMAT = 'HHHH' + ''.join('4s' if f[2] == 'f' else f[2]
+                                     for f in LOGGER_RECORD_MAP)
+
+    # the rates at which the station is looked for.  the rate of the station
+    # is set with the configuration utility; the published register map has
+    # no register for it, so the driver only changes the rate of the port.
+    SUPPORTED_BAUD_RATES = [9600, 19200, 38400, 57600, 115200]
+    PROBE_TIMEOUT = 1.0 # seconds
+
+    # configuration registers.  they appear to hold the station settings,
+    # but they are not in the published CM1 register map and what each one
+    # holds is not known, so they are only read, as raw registers.
+    CONFIG_REGISTER = 132
+    CONFIG_COUNT = 7
+
+    def __init__(self, port, address, baud_rate, timeout,
+                 adaptive_timeout=False, min_timeout=DEFAULT_MIN_TIMEOUT,
+                 transport=None, client='native', cache_ttl=0,
+                 cache_blocks=RegisterCache.DEFAULT_BLOCKS):
+        if transport is None:
+            transport = Transport.create(port, address, baud_rate, timeout,
+                                         client=client)
+        self.transport = transport
+        self.port = port
+        self.address = address
+        self.timeout = timeout
+        self.min_timeout = min_timeout
+        # one response time estimate per register block
+        self.rtt = dict() if adaptive_timeout else None
+        self.stats = TransactionStats(transport.overhead)
+        # a RawRecorder, if the raw blocks are to be captured
+        self.recorder = None
+        # an event that is set when the station is no longer to be read
+        self.stopped = None
+        self.register_map = RegisterMap(CM1.REGISTER_MAP)
+        self.current_plan = None
+        # with a cache, the accessors are answered from a snapshot of the
+        # registers read at most cache_ttl seconds ago
+        self.cache = None
+        if cache_ttl:
+            self.cache = RegisterCache(cache_ttl, cache_blocks)
+            self.snapshot_blocks = self.register_map.optimize()
+        loginf("port: %s" % port)
+        loginf(transport.settings)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _, value, traceback):
+        pass
+
+    @staticmethod
+    def _to_signed(x, bits=16):
+        # assumes two's complement enoding of signed integer
+        if (x & (1 << (bits - 1))) != 0:
+            x = x - (1 << bits)
+        return x
+
+    @staticmethod
+    def _to_long(a, b):
+        return (a << 16) + b
+
+    @staticmethod
+    def _to_float(a, b):
+        f = struct.unpack('f', struct.pack('>HH', a, b))[0]
+#        loginf("to_float: a=%04x b=%04x f=%s" % (a, b, f))
+        return f
+
+    @staticmethod
+    def _to_calculated(x):
+        x = CM1._to_signed(x)
+        if x == -9990:
+            return None
+        return x * 0.1
+
+    def _select(self):
+        # the transport may be shared with other stations on the port
+        if self.transport.address != self.address:
+            self.transport.address = self.address
+
+    def read_registers(self, reg, cnt):
+        self._select()
+        return self.transport.read_registers(reg, cnt)
+
+    def write_registers(self, reg, values):
+        self._run(self._write_registers_co(reg, values))
+
+    def _write_registers_co(self, reg, values):
+        if self.cache is not None:
+            self.cache.invalidate(reg, len(values))
+            if reg == CM1.LOGGER_SELECT_REGISTER:
+                # the window shows the selected records
+                self.cache.invalidate(CM1.LOGGER_WINDOW_REGISTER,
+                                      CM1.MAX_READ_REGISTERS)
+        yield ('write', reg, values)
+
+    def _estimator(self, reg, cnt, write):
+        # the response time estimate for a read of a block, or None
+        if self.rtt is None or write:
+            return None
+        est = self.rtt.get((reg, cnt))
+        if est is None:
+            est = RTTEstimator(self.min_timeout, self.timeout)
+            self.rtt[(reg, cnt)] = est
+        return est
+
+    def _record(self, reg, cnt, write, est, elapsed, error=None):
+        # record the latency and outcome of a transaction
+        self.stats.record(reg, cnt, write, elapsed, error)
+        if est is None:
+            return
+        if error is not None:
+            est.backoff()
+        else:
+            est.update(elapsed)
+
+    def _timed(self, reg, cnt, write, func, *args):
+        # run a transaction with a timeout based on its response time
+        self._select()
+        est = self._estimator(reg, cnt, write)
+        # avoid reconfiguring the port for insignificant changes
+        if est is not None and \
+                abs(self.transport.timeout - est.timeout) > 0.01:
+            self.transport.timeout = est.timeout
+        t0 = time.time()
+        try:
+            x = func(*args)
+        except (IOError, ValueError, TypeError), e:
+            self._record(reg, cnt, write, est, time.time() - t0, e)
+            raise
+        self._record(reg, cnt, write, est, time.time() - t0)
+        return x
+
+    def _read_block(self, reg, cnt):
+        # the decoder works on the raw big-endian register payload
+        return self._timed(reg, cnt, False, self.transport.read_block,
+                           reg, cnt)
+
+    # The protocol is written once, as coroutines that are shared by this
+    # class and AsyncCM1.  A protocol coroutine yields the transactions it
+    # needs, or another protocol coroutine to run, is resumed with the result
+    # or has the error raised in it, and returns its value by raising Return.
+    # The transactions are
+    #   ('read', reg, cnt) - a timed read of a block, returns the payload
+    #   ('read_many', blocks) - a read of each block, returns the payload or
+    #       the error for each block
+    #   ('write', reg, values) - a timed write
+    #   ('probe', reg, cnt, timeout) - an untimed read, returns the payload
+    #   ('logger', status, pos, n) - a logger read through the daemon
+    # Here they are done with the blocking transport.
+
+    def _run(self, coro):
+        """Run a protocol coroutine to the end, and return its value."""
+        value = error = None
+        while True:
+            try:
+                if error is not None:
+                    step = coro.throw(error)
+                else:
+                    step = coro.send(value)
+            except Return, r:
+                return r.value
+            except StopIteration:
+                return None
+            value = error = None
+            try:
+                if isinstance(step, types.GeneratorType):
+                    value = self._run(step)
+                else:
+                    value = self._transact(*step)
+            except Exception, e:
+                error = e
+
+    def _transact(self, kind, *args):
+        if kind == 'read':
+            return self._read_block(*args)
+        if kind == 'read_many':
+            return self._read_pipelined(*args)
+        if kind == 'write':
+            reg, values = args
+            return self._timed(reg, len(values), True,
+                               self.transport.write_registers, reg, values)
+        if kind == 'probe':
+            reg, cnt, timeout = args
+            self._select()
+            old = self.transport.timeout
+            self.transport.timeout = timeout
+            try:
+                return self.transport.read_block(reg, cnt)
+            finally:
+                self.transport.timeout = old
+        if kind == 'logger':
+            return self.transport.read_logger(*args)
+        raise ValueError("unknown transaction %s" % kind)
+
+    def _read_pipelined(self, blocks):
+        # request every block at once
+        self._select()
+        self.transport.timeout = self.timeout
+        t0 = time.time()
+        results = self.transport.read_blocks(blocks)
+        elapsed = time.time() - t0
+        for (reg, cnt), x in zip(blocks, results):
+            self.stats.record(reg, cnt, False, elapsed,
+                              x if isinstance(x, Exception) else None)
+        return results
+
+    def read_blocks(self, blocks, tries=None):
+        """Read each block.  If tries is None, any failure is raised.
+        Otherwise each block is tried up to tries times, and a block that
+        cannot be read is None in the result.  If every block fails, the
+        last error is raised.  Blocks in the cache are not read."""
+        return self._run(self._read_blocks_co(blocks, tries))
+
+    def _read_blocks_co(self, blocks, tries=None, span=None):
+        # the start and end of each read that gives a block, or the time a
+        # cached block was read, are added to span
+        if span is None:
+            span = []
+        raws = [None] * len(blocks)
+        if self.cache is not None:
+            now = time.time()
+            for i, (reg, cnt) in enumerate(blocks):
+                hit = self.cache.get(reg, cnt, now)
+                if hit is not None:
+                    raws[i] = hit[1]
+                    span.append(hit[0])
+        cached = [raw is not None for raw in raws]
+        missing = [i for i, raw in enumerate(raws) if raw is None]
+        if self.transport.pipelined and len(missing) > 1:
+            # request every block at once, then fall back to single reads
+            # for any block that failed
+            t0 = time.time()
+            results = yield ('read_many', [blocks[i] for i in missing])
+            for i, x in zip(missing, results):
+                if not isinstance(x, Exception):
+                    raws[i] = x
+                    span.extend([t0, time.time()])
+        error = None
+        for i, (reg, cnt) in enumerate(blocks):
+            if raws[i] is not None:
+                continue
+            if self.stopped is not None and self.stopped.isSet():
+                raise weewx.WeeWxIOError("stopped before register %s" % reg)
+            if tries is None:
+                t0 = time.time()
+                raws[i] = yield ('read', reg, cnt)
+                span.extend([t0, time.time()])
+                continue
+            for n in range(tries):
+                if n > 0:
+                    self.stats.block_retries += 1
+                try:
+                    t0 = time.time()
+                    raws[i] = yield ('read', reg, cnt)
+                    span.extend([t0, time.time()])
+                    break
+                except (IOError, ValueError, TypeError), e:
+                    logdbg("read %s registers at %s failed (%s of %s): %s" %
+                           (cnt, reg, n + 1, tries, e))
+                    error = e
+        if error is not None and all(raw is None for raw in raws):
+            raise error
+        if self.recorder is not None or self.cache is not None:
+            now = time.time()
+            for (reg, cnt), raw, hit in zip(blocks, raws, cached):
+                if raw is None or hit:
+                    continue
+                if self.recorder is not None:
+                    self.recorder.write(now, self.address, reg, raw)
+                if self.cache is not None:
+                    self.cache.put(reg, cnt, raw, now)
+        raise Return(raws)
+
+    def read_current(self, plan, pkt, tries=None, span=None):
+        """Read the register blocks in a compiled plan and decode them into
+        the packet pkt.  Returns the indices of the blocks that could not be
+        read; their fields are left out of the packet.  The start and end
+        times of the reads that gave the blocks are added to span."""
+        return self._run(self._read_current_co(plan, pkt, tries, span))
+
+    def _read_current_co(self, plan, pkt, tries=None, span=None):
+        raws = yield self._read_blocks_co(plan.blocks, tries, span)
+        plan.decode(raws, pkt)
+        raise Return([i for i, raw in enumerate(raws) if raw is None])
+
+    def _get_fields(self, names):
+        return self._run(self._get_fields_co(names))
+
+    def _get_fields_co(self, names):
+        if self.cache is not None:
+            # refresh the whole snapshot, so the accessors that follow are
+            # answered without a transaction
+            yield self._read_blocks_co(self.snapshot_blocks)
+        plan = self.register_map.compile(self.register_map.optimize(names))
+        data = dict()
+        yield self._read_current_co(plan, data)
+        raise Return(data)
+
+    def _get_group(self, group):
+        return self._get_fields(self.register_map.groups[group])
+
+    def _get_field(self, name):
+        return self._get_fields([name])[name]
+
+    def get_system_parameters(self):
+        return self._run(self._system_parameters_co())
+
+    def _system_parameters_co(self):
+        return self._get_fields_co(self.register_map.groups['system'] +
+                                   self.register_map.groups['power'])
+
+    def get_current(self):
+        return self._run(self._current_co())
+
+    def _current_co(self):
+        # every field other than the system parameters
+        if self.current_plan is None:
+            names = [k for k in self.register_map.fields
+                     if self.register_map.fields[k][1] != 'system']
+            self.current_plan = self.register_map.compile(
+                self.register_map.optimize(names))
+        data = dict()
+        yield self._read_current_co(self.current_plan, data)
+        raise Return(data)
+
+    @staticmethod
+    def _to_epoch(ds, ts):
+        # station is in local time, so convert from local time to epoch
+        return time.mktime(time.strptime("20%06d.%06d" % (ds, ts),
+                                         "%Y%m%d.%H%M%S"))
+
+    def _read_cached_co(self, reg, cnt):
+        # a single block through the cache, as a list of registers
+        raws = yield self._read_blocks_co([(reg, cnt)])
+        raise Return(list(struct.unpack('>%dH' % cnt, str(raws[0]))))
+
+    def get_clock(self):
+        return self._run(self._clock_co())
+
+    def _clock_co(self):
+        x = yield self._read_cached_co(104, 4)
+        ds = (x[2] << 16) + x[3]
+        ts = (x[0] << 16) + x[1]
+        x = CM1._to_epoch(ds, ts)
+        logdbg("get_clock: date.time: %s.%s (%s)" % (ds, ts, x))
+        raise Return(x)
+
+    def set_clock(self, epoch=None):
+        # station is in local time, so convert from epoch to local time
+        if epoch is None:
+            epoch = int(time.time() + 0.5)
+        tstr = time.localtime(epoch)
+        ds = (tstr.tm_year - 2000) * 10000 + tstr.tm_mon * 100 + tstr.tm_mday
+        dlo = ds % 0x10000
+        dhi = (ds - dlo) >> 16
+        ts = tstr.tm_hour * 10000 + tstr.tm_min * 100 + tstr.tm_sec
+        tlo = ts % 0x10000
+        thi = (ts - tlo) >> 16
+        buf = [thi, tlo, dhi, dlo]
+        logdbg("set_clock: date.time: %06d.%06d (%s)" % (ds, ts, epoch))
+        # the write drops the cached clock, so get_clock reads it again
+        self.write_registers(104, buf)
+
+    def get_config(self):
+        """Read the configuration registers in one transaction, and return
+        them as a list of raw register values."""
+        n = CM1.CONFIG_COUNT
+        raw = self.read_blocks([(CM1.CONFIG_REGISTER, n)])[0]
+        return list(struct.unpack('>%dH' % n, str(raw)))
+
+    def get_time(self):
+        # 32-bits
+        # HHMMSS - bcd encoded
+        return "%06d" % self._get_field('time')
+
+    def get_date(self):
+        # 32-bits
+        # YYMMDD - bcd encoded
+        return "%06d" % self._get_field('date')
+
+    def get_battery_voltage(self):
+        # 16-bits
+        # 0-50000 * 0.001
+        return self._get_field('battery_voltage')
+
+    def get_solar_charge_voltage(self):
+        # 16-bits
+        # 0-50000 * 0.001
+        return self._get_field('solar_voltage')
+
+    def get_charger_status(self):
+        # 16-bits
+        # 0=off, 1=fast, 2=fasttop, 3=floatcharge
+        return self._get_field('charger_status')
+
+    def get_wind(self):
+        return self._get_group('wind')
+
+    def get_tph(self):
+        return self._get_group('tph')
+
+    def get_rain(self):
+        return self._get_group('rain')
+
+    def get_analog_1(self):
+        return self._get_fields(['analog_1'])
+
+    def get_analog_2(self):
+        return self._get_fields(['analog_2'])
+
+    def get_calculated(self):
+        return self._get_group('calculated')
+
+    def get_lightning(self):
+        return self._get_group('lightning')
+
+    def find_baud_rate(self, rates=None):
+        """Find the rate at which the station answers, and set the port to
+        it.  Returns the rate, or None if the station does not answer."""
+        return self._run(self._find_baud_rate_co(rates))
+
+    def _find_baud_rate_co(self, rates=None):
+        for rate in rates or CM1.SUPPORTED_BAUD_RATES:
+            self.transport.baud_rate = rate
+            result = yield self._probe_co(2)
+            if result['errors'] < 2:
+                raise Return(rate)
+        raise Return(None)
+
+    def probe(self, count=20):
+        """Read the system registers count times at the current baud rate.
+        Returns the error rate and the latency of the reads."""
+        return self._run(self._probe_co(count))
+
+    def _probe_co(self, count=20):
+        samples = []
+        errors = 0
+        # at the wrong rate every read times out, so do not wait long
+        timeout = min(self.timeout, CM1.PROBE_TIMEOUT)
+        for _ in range(count):
+            t0 = time.time()
+            try:
+                yield ('probe', 100, 11, timeout)
+                samples.append(time.time() - t0)
+            except (IOError, ValueError, TypeError):
+                errors += 1
+        samples.sort()
+        n = len(samples)
+        raise Return(dict(
+            baud_rate=self.transport.baud_rate, transactions=count,
+            errors=errors, error_rate=float(errors) / count,
+            latency=sum(samples) / n if n else None,
+            latency_p90=samples[int(0.9 * n)] if n else None,
+            latency_max=samples[-1] if n else None))
+
+    @staticmethod
+    def recommend_baud_rate(results, max_error_rate=0.0):
+        ok = [r['baud_rate'] for r in results
+              if r['error_rate'] is not None and
+              r['error_rate'] <= max_error_rate]
+        return max(ok) if ok else None
+
+    def get_logger_status(self):
+        return self._run(self._logger_status_co())
+
+    def _logger_status_co(self):
+        x = yield self._read_cached_co(CM1.LOGGER_STATUS_REGISTER, 5)
+        raise Return(CM1._logger_status(x))
+
+    @staticmethod
+    def _logger_status(x):
+        data = dict()
+        data['interval'] = x[0] # minutes
+        data['count'] = CM1._to_long(x[1], x[2])
+        data['newest'] = CM1._to_long(x[3], x[4])
+        return data
+
+    @staticmethod
+    def check_logger_status(status):
+        """Raise ValueError if the logger status has a value that the
+        logger cannot have, which means the registers are not where they
+        are assumed to be."""
+        if status['interval'] not in CM1.LOGGER_INTERVALS:
+            raise ValueError("logger interval %s is not one of %s" %
+                             (status['interval'], CM1.LOGGER_INTERVALS))
+        if status['count'] > CM1.LOGGER_CAPACITY:
+            raise ValueError("logger count %s is more than the capacity %s" %
+                             (status['count'], CM1.LOGGER_CAPACITY))
+        if status['newest'] >= CM1.LOGGER_CAPACITY:
+            raise ValueError("newest logger record %s is past the capacity"
+                             " %s" % (status['newest'], CM1.LOGGER_CAPACITY))
+
+    @staticmethod
+    def _logger_index(status, pos):
+        # convert position relative to the oldest record to a ring index
+        oldest = status['newest'] - status['count'] + 1
+        return (oldest + pos) % CM1.LOGGER_CAPACITY
+
+    def get_logger_records(self, status, pos, n):
+        """Read n records starting at position pos, where position 0 is the
+        oldest record in the logger.  Returns a list of decoded records, with
+        None for any record that has no valid timestamp.  The pages are
+        decoded together once they have all been read."""
+        return self._run(self._logger_records_co(status, pos, n))
+
+    def _logger_records_co(self, status, pos, n):
+        if isinstance(self.transport, DaemonTransport):
+            raw = yield ('logger', status, pos, n)
+        else:
+            raw = yield self._read_logger_co(status, pos, n)
+        raise Return(CM1.decode_logger_records(raw, n))
+
+    def read_logger(self, status, pos, n):
+        """Return the raw data of n records starting at position pos."""
+        return self._run(self._read_logger_co(status, pos, n))
+
+    def check_logger_registers(self):
+        """Read the logger status and select registers and raise IOError
+        unless they look like a logger.  The select register is not in the
+        published register map, so it is only written once the registers
+        around it read back as a logger status and a record index."""
+        self._run(self._check_logger_co())
+
+    def _check_logger_co(self):
+        cnt = CM1.LOGGER_SELECT_REGISTER + 2 - CM1.LOGGER_STATUS_REGISTER
+        raw = yield ('read', CM1.LOGGER_STATUS_REGISTER, cnt)
+        x = struct.unpack('>%dH' % cnt, str(raw))
+        try:
+            CM1.check_logger_status(CM1._logger_status(x))
+            select = CM1._to_long(x[-2], x[-1])
+            if select >= CM1.LOGGER_CAPACITY:
+                raise ValueError("logger select %s is past the capacity %s" %
+                                 (select, CM1.LOGGER_CAPACITY))
+        except ValueError, e:
+            raise IOError("registers %s-%s are not a logger, so the select"
+                          " register will not be written: %s" %
+                          (CM1.LOGGER_STATUS_REGISTER,
+                           CM1.LOGGER_SELECT_REGISTER + 1, e))
+
+    def _read_logger_co(self, status, pos, n):
+        yield self._check_logger_co()
+        pages = []
+        while n > 0:
+            idx = CM1._logger_index(status, pos)
+            # a single read cannot wrap around the end of the ring
+            cnt = min(n, CM1.LOGGER_RECORDS_PER_READ,
+                      CM1.LOGGER_CAPACITY - idx)
+            yield self._write_registers_co(CM1.LOGGER_SELECT_REGISTER,
+                                           [idx >> 16, idx & 0xffff])
+            raw = yield ('read', CM1.LOGGER_WINDOW_REGISTER,
+                         cnt * CM1.LOGGER_RECORD_SIZE)
+            pages.append(str(raw))
+            pos += cnt
+            n -= cnt
+        raise Return(''.join(pages))
+
+    def find_logger_record(self, status, since_ts):
+        """Return the position of the oldest record newer than since_ts.
+        Records are in time order from the oldest, so do a binary search
+        instead of reading every record."""
+        return self._run(self._find_logger_record_co(status, since_ts))
+
+    def _find_logger_record_co(self, status, since_ts):
+        if since_ts is None:
+            raise Return(0)
+        lo = 0
+        hi = status['count']
+        while lo < hi:
+            mid = (lo + hi) // 2
+            recs = yield self._logger_records_co(status, mid, 1)
+            if recs[0] is not None and recs[0]['dateTime'] > since_ts:
+                hi = mid
+            else:
+                lo = mid + 1
+        logdbg("find_logger_record: since %s is position %s of %s" %
+               (since_ts, lo, status['count']))
+        raise Return(lo)
+
+    @staticmethod
+    def decode_logger_records(raw, n):
+        """Decode n logger records from their raw register payload.  The
+        fields are converted a column at a time, with numpy if it is
+        available.  Returns a dict for each record, or None for a slot with
+        no valid timestamp."""
+        if numpy is not None:
+            cols = CM1._logger_columns_numpy(raw, n)
+        else:
+            cols = CM1._logger_columns(raw, n)
+        names = ['dateTime'] + [f[0] for f in CM1.LOGGER_RECORD_MAP]
+        return [dict(zip(names, row)) if row[0] is not None else None
+                for row in zip(*[cols[k] for k in names])]
+
+    @staticmethod
+    def _logger_columns(raw, n):
+        x = struct.unpack('>' + CM1.LOGGER_FORMAT * n,
+                          raw[:2 * n * CM1.LOGGER_RECORD_SIZE])
+        k = 4 + len(CM1.LOGGER_RECORD_MAP)
+        cols = dict()
+        cols['dateTime'] = CM1._logger_epochs(
+            [(a << 16) + b for a, b in zip(x[2::k], x[3::k])],
+            [(a << 16) + b for a, b in zip(x[0::k], x[1::k])])
+        for i, (name, _, fmt, scale, sentinel) in enumerate(
+                CM1.LOGGER_RECORD_MAP):
+            col = x[4 + i::k]
+            if fmt == 'f':
+                col = struct.unpack('=%df' % n, ''.join(col))
+            elif scale is not None:
+                col = [v * scale if v != sentinel else None for v in col]
+            cols[name] = col
+        return cols
+
+    @staticmethod
+    def _logger_columns_numpy(raw, n):
+        size = CM1.LOGGER_RECORD_SIZE
+        a = numpy.frombuffer(raw, dtype='>u2', count=n * size).reshape(
+            n, size)
+        ds = (a[:, 2].astype(numpy.int64) << 16) | a[:, 3]
+        ts = (a[:, 0].astype(numpy.int64) << 16) | a[:, 1]
+        cols = dict()
+        cols['dateTime'] = CM1._logger_epochs_numpy(ds, ts)
+        signed = a.view('>i2')
+        octets = numpy.frombuffer(raw, dtype=numpy.uint8,
+                                  count=2 * n * size).reshape(n, 2 * size)
+        for name, off, fmt, scale, sentinel in CM1.LOGGER_RECORD_MAP:
+            if fmt == 'f':
+                cols[name] = octets[:, 2 * off:2 * off + 4].copy().view(
+                    '=f4')[:, 0].tolist()
+                continue
+            col = signed[:, off] if fmt == 'h' else a[:, off]
+            vals = (col * scale).tolist() if scale is not None \
+                else col.tolist()
+            if sentinel is not None:
+                for i in numpy.flatnonzero(col == sentinel):
+                    vals[i] = None
+            cols[name] = vals
+        return cols
+
+    @staticmethod
+    def _utc_offset(hour):
+        # station time is local.  the offset from utc can change only on the
+        # hour, so it is found once for each hour of naive local time.
+        t = time.gmtime(hour * 3600)
+        return int(time.mktime(t[:4] + (0, 0, 0, 0, -1))) - hour * 3600
+
+    @staticmethod
+    def _logger_time_valid(ds, ts):
+        # whether the date and time words of a record are a time.  the
+        # operators work on ints and on numpy arrays, so both decoders
+        # reject the same records.
+        year = 2000 + ds // 10000
+        month = ds // 100 % 100
+        day = ds % 100
+        leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+        mdays = 31 - (month == 2) * (3 - leap) - \
+            ((month == 4) | (month == 6) | (month == 9) | (month == 11))
+        return (ds != 0) & (year <= datetime.MAXYEAR) & (month >= 1) & \
+            (month <= 12) & (day >= 1) & (day <= mdays) & \
+            (ts // 10000 <= 23) & (ts // 100 % 100 <= 59) & (ts % 100 <= 61)
+
+    @staticmethod
+    def _logger_epochs(dates, times):
+        offsets = dict()
+        epochs = []
+        for ds, ts in zip(dates, times):
+            if not CM1._logger_time_valid(ds, ts):
+                epochs.append(None)
+                continue
+            t = (2000 + ds // 10000, ds // 100 % 100, ds % 100,
+                 ts // 10000, ts // 100 % 100, ts % 100)
+            naive = calendar.timegm(t)
+            hour = naive // 3600
+            if hour not in offsets:
+                offsets[hour] = CM1._utc_offset(hour)
+            epochs.append(naive + offsets[hour])
+        return epochs
+
+    @staticmethod
+    def _logger_epochs_numpy(ds, ts):
+        year = 2000 + ds // 10000
+        month = ds // 100 % 100
+        day = ds % 100
+        hour = ts // 10000
+        minute = ts // 100 % 100
+        second = ts % 100
+        valid = CM1._logger_time_valid(ds, ts)
+        days = ((year[valid] - 1970).astype('M8[Y]') +
+                (month[valid] - 1).astype('m8[M]')).astype('M8[D]') + \
+            (day[valid] - 1).astype('m8[D]')
+        naive = days.astype(numpy.int64) * 86400 + hour[valid] * 3600 + \
+            minute[valid] * 60 + second[valid]
+        hours, index = numpy.unique(naive // 3600, return_inverse=True)
+        offsets = numpy.array([CM1._utc_offset(int(h)) for h in hours],
+                              dtype=numpy.int64)
+        epochs = [None] * len(ds)
+        for i, x in zip(numpy.flatnonzero(valid).tolist(),
+                        (naive + offsets[index]).tolist()):
+            epochs[i] = x
+        return epochs
+
+
+class CM1Daemon(object):
+    """Owns a port and serves register reads and writes to clients on a unix
+    socket, so that weewx, the command line tools and other consumers can
+    share the stations on the port without corrupting each other's frames.
+
+    Requests are served one at a time.  Identical reads that are waiting at
+    the same time are answered by a single transaction, and a read is
+    answered without a transaction if it lies within a block read less than
+    max_age seconds ago.  A write discards the cached blocks that it
+    overlaps.
+
+    Each request and response is one line of json:
+      {"op": "read", "address": 1, "register": 200, "count": 10}
+      {"data": "<payload as hex>"}
+      {"op": "write", "address": 1, "register": 104,
+       "values": [1, 54464, 3, 43507]} (the clock, 12:00:00 2024-01-15)
+      {"ok": true}
+      {"op": "logger_read", "address": 1, "count": 120, "newest": 7,
+       "position": 0, "records": 10}
+      {"data": "<records as hex>"}
+      {"op": "stats"}
+    A logger_read selects the logger window and reads it in one request, so
+    no other request can come between them.  Only the clock registers may be
+    written.  The other registers that the driver knows of are assumed, or
+    set the port and the logger window, so a write to them is refused.  A
+    failure is answered with error, and the kind and code of the failure as
+    given by classify_error.
+
+    There is one transport for the port, shared by the stations on it."""
+
+    DEFAULT_SOCKET = '/var/run/cm1d.sock'
+    DEFAULT_MAX_AGE = 1.0 # seconds
+    WRITABLE_REGISTERS = (104, 108) # the clock
+
+    def __init__(self, port, path=DEFAULT_SOCKET,
+                 baud_rate=CM1.DEFAULT_BAUD_RATE, timeout=CM1.DEFAULT_TIMEOUT,
+                 max_age=DEFAULT_MAX_AGE, client='native'):
+        self.port = port
+        self.path = path
+        self.baud_rate = baud_rate
+        self.timeout = timeout
+        self.max_age = max_age
+        self.client = client
+        self.transport = Transport.create(port, CM1.DEFAULT_ADDRESS,
+                                          baud_rate, timeout, client=client)
+        self.stations = dict()
+        self.counts = dict(clients=0, requests=0, coalesced=0)
+        self.running = False
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(5)
+        # the unanswered input from each client
+        self.clients = dict()
+        loginf("cm1 daemon for %s on %s" % (port, path))
+
+    def _station(self, address):
+        if address not in self.stations:
+            self.stations[address] = CM1(self.port, address, self.baud_rate,
+                                         self.timeout, True,
+                                         transport=self.transport,
+                                         cache_ttl=self.max_age)
+        return self.stations[address]
+
+    def serve_forever(self):
+        self.running = True
+        while self.running:
+            self.serve_once(0.5)
+        self.close()
+
+    def stop(self):
+        self.running = False
+
+    def serve_once(self, timeout=None):
+        """Wait up to timeout for requests, then answer every request that
+        has arrived."""
+        r, _, _ = select.select([self.listener] + self.clients.keys(), [],
+                                [], timeout)
+        requests = []
+        for s in r:
+            if s is self.listener:
+                self.clients[s.accept()[0]] = ''
+                self.counts['clients'] += 1
+                continue
+            try:
+                x = s.recv(4096)
+            except socket.error:
+                x = ''
+            if not x:
+                self._drop(s)
+                continue
+            lines = (self.clients[s] + x).split("\n")
+            self.clients[s] = lines.pop()
+            requests.extend((s, line) for line in lines if line.strip())
+        answers = dict()
+        for conn, line in requests:
+            try:
+                resp = self._answer(json.loads(line), answers)
+            except (ValueError, KeyError, TypeError), e:
+                resp = dict(error="bad request: %s" % e, kind='other')
+            try:
+                conn.sendall(json.dumps(resp) + "\n")
+            except socket.error:
+                self._drop(conn)
+
+    def _drop(self, conn):
+        if self.clients.pop(conn, None) is not None:
+            conn.close()
+
+    def _answer(self, req, answers):
+        self.counts['requests'] += 1
+        op = req['op']
+        if op == 'stats':
+            return self.get_stats()
+        address = int(req['address'])
+        if op == 'logger_read':
+            answers.clear()
+            status = dict(count=int(req['count']), newest=int(req['newest']))
+            try:
+                raw = self._station(address).read_logger(
+                    status, int(req['position']), int(req['records']))
+            except (IOError, ValueError, TypeError), e:
+                return self._error(e)
+            return dict(data=raw.encode('hex'))
+        reg = int(req['register'])
+        if op == 'write':
+            lo, hi = CM1Daemon.WRITABLE_REGISTERS
+            if not lo <= reg or hi < reg + len(req['values']):
+                return dict(error="only registers %s-%s may be written" %
+                            (lo, hi - 1), kind='other')
+            answers.clear()
+            try:
+                self._station(address).write_registers(
+                    reg, [int(v) for v in req['values']])
+            except (IOError, ValueError, TypeError), e:
+                return self._error(e)
+            return dict(ok=True)
+        if op == 'read':
+            key = (address, reg, int(req['count']))
+            if key in answers:
+                self.counts['coalesced'] += 1
+            else:
+                answers[key] = self._read(*key)
+            return answers[key]
+        return dict(error="unknown request %s" % op, kind='other')
+
+    def _read(self, address, reg, cnt):
+        try:
+            payload = self._station(address).read_blocks([(reg, cnt)])[0]
+        except (IOError, ValueError, TypeError), e:
+            return self._error(e)
+        return dict(data=str(payload).encode('hex'))
+
+    @staticmethod
+    def _error(e):
+        kind, code = classify_error(e)
+        return dict(error=str(e), kind=kind, code=code)
+
+    def get_stats(self):
+        stations = dict()
+        for a in self.stations:
+            stations[str(a)] = self.stations[a].stats.snapshot()
+            if self.stations[a].cache is not None:
+                stations[str(a)]['cache'] = \
+                    self.stations[a].cache.to_dict()
+        return dict(self.counts, port=self.port, stations=stations)
+
+    def close(self):
+        for conn in self.clients.keys():
+            self._drop(conn)
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.transport.close()
+
+
+class Return(Exception):
+    """Raised by a coroutine to return a value."""
+
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+
+class Future(object):
+    """The result of an operation that has not finished.  A coroutine waits
+    for a future by yielding it, and is resumed with the result, or has the
+    error raised in it."""
+
+    def __init__(self):
+        self.done = False
+        self.result = None
+        self.error = None
+        self.callbacks = []
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_error(self, error):
+        self._finish(None, error)
+
+    def _finish(self, result, error):
+        if self.done:
+            return
+        self.done = True
+        self.result = result
+        self.error = error
+        callbacks, self.callbacks = self.callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+    def add_callback(self, fn):
+        if self.done:
+            fn(self)
+        else:
+            self.callbacks.append(fn)
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class AsyncLock(object):
+    # holds a link for one transaction at a time
+
+    def __init__(self):
+        self.locked = False
+        self.waiters = collections.deque()
+
+    def acquire(self):
+        f = Future()
+        if self.locked:
+            self.waiters.append(f)
+        else:
+            self.locked = True
+            f.set_result(True)
+        return f
+
+    def release(self):
+        if self.waiters:
+            self.waiters.popleft().set_result(True)
+        else:
+            self.locked = False
+
+
+class EventLoop(object):
+    """Single-threaded scheduler for coroutines, built on select.
+
+    A coroutine is a generator that yields futures and returns its value by
+    raising Return.  Every station and port is serviced by one loop, which
+    waits on the file descriptors of all the links at once, with timers for
+    the poll slots, the response timeouts and the waits between retries.
+    Other threads hand work to the loop with run_sync."""
+
+    def __init__(self):
+        self.timers = []
+        self.seq = 0
+        self.readers = dict()
+        self.ready = collections.deque()
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wake_r, self.wake_w = os.pipe()
+        self.running = False
+        self.thread = None
+
+    def call_soon(self, fn, *args):
+        self.ready.append((fn, args))
+
+    def call_at(self, when, fn, *args):
+        # returns a handle that can be cancelled
+        self.seq += 1
+        timer = [when, self.seq, fn, args]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    @staticmethod
+    def cancel(timer):
+        timer[2] = None
+
+    def call_soon_threadsafe(self, fn, *args):
+        with self.lock:
+            self.pending.append((fn, args))
+        os.write(self.wake_w, 'x')
+
+    def add_reader(self, fd, fn):
+        self.readers[fd] = fn
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def sleep_until(self, when):
+        f = Future()
+        self.call_at(when, f.set_result, None)
+        return f
+
+    def sleep(self, seconds):
+        return self.sleep_until(time.time() + seconds)
+
+    def spawn(self, coro):
+        """Run a coroutine.  Returns a future for its value."""
+        result = Future()
+
+        def step(value=None, error=None):
+            try:
+                if error is not None:
+                    f = coro.throw(error)
+                else:
+                    f = coro.send(value)
+            except Return, r:
+                result.set_result(r.value)
+                return
+            except StopIteration:
+                result.set_result(None)
+                return
+            except Exception, e:
+                result.set_error(e)
+                return
+            f.add_callback(lambda f: self.call_soon(resume, f))
+
+        def resume(f):
+            if f.error is not None:
+                step(error=f.error)
+            else:
+                step(f.result)
+
+        self.call_soon(step)
+        return result
+
+    def gather(self, futures):
+        """Return a future for the list of results of all the futures.  A
+        future that failed gives its error in the list."""
+        result = Future()
+        values = [None] * len(futures)
+        remaining = [len(futures)]
+
+        def done(i, f):
+            values[i] = f.error if f.error is not None else f.result
+            remaining[0] -= 1
+            if not remaining[0]:
+                result.set_result(values)
+
+        if not futures:
+            result.set_result(values)
+        for i, f in enumerate(futures):
+            f.add_callback(lambda f, i=i: done(i, f))
+        return result
+
+    def run_once(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        self.ready.extend(pending)
+        timeout = 1.0
+        if self.ready:
+            timeout = 0
+        elif self.timers:
+            timeout = max(0, min(timeout, self.timers[0][0] - time.time()))
+        fds = self.readers.keys() + [self.wake_r]
+        try:
+            r, _, _ = select.select(fds, [], [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd in r:
+            if fd == self.wake_r:
+                os.read(self.wake_r, 1024)
+            elif fd in self.readers:
+                self.readers[fd]()
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)
+            if timer[2] is not None:
+                self.ready.append((timer[2], timer[3]))
+        for _ in range(len(self.ready)):
+            fn, args = self.ready.popleft()
+            fn(*args)
+
+    def run_until_complete(self, coro):
+        f = self.spawn(coro)
+        while not f.done:
+            self.run_once()
+        return f.get()
+
+    def run_forever(self):
+        self.thread = threading.current_thread()
+        self.running = True
+        try:
+            while self.running:
+                self.run_once()
+        finally:
+            self.thread = None
+
+    def stop(self):
+        self.call_soon_threadsafe(setattr, self, 'running', False)
+
+    def run_sync(self, coro):
+        """Run a coroutine to completion from any thread, and return its
+        value.  This is the adapter between the loop and blocking code."""
+        if self.thread is None or self.thread is threading.current_thread():
+            return self.run_until_complete(coro)
+        done = threading.Event()
+        box = []
+
+        def start():
+            f = self.spawn(coro)
+            f.add_callback(lambda f: (box.append(f), done.set()))
+
+        self.call_soon_threadsafe(start)
+        done.wait()
+        return box[0].get()
+
+    def close(self):
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+
+class AsyncLink(object):
+    """Modbus transactions without blocking, on the port of a transport.
+
+    The link uses the file descriptor of the serial port or socket that the
+    transport already has open, so switching to the event loop does not
+    open the port again.  Stations on one port share a link, and take turns
+    with a lock."""
+
+    def __init__(self, loop, transport):
+        self.loop = loop
+        self.transport = transport
+        self.lock = AsyncLock()
+        self.conn = getattr(transport, 'conn', None)
+        self.mbap = isinstance(transport, ModbusTCPTransport)
+        self.last_io = 0
+
+    @staticmethod
+    def supports(transport):
+        return isinstance(transport, (RTUSerialTransport, SerialTransport,
+                                      ModbusTCPTransport,
+                                      RTUOverTCPTransport))
+
+    def _open(self, timeout):
+        if self.conn is not None:
+            self.conn.connect(timeout)
+            return self.conn.sock.fileno()
+        self.transport.open()
+        port = self.transport.serial
+        if port.in_waiting:
+            # the rest of a response to an earlier request that timed out
+            port.reset_input_buffer()
+        return port.fileno()
+
+    def _fail(self, e):
+        # after an error on a socket, a late response would be taken for
+        # the next one, so start again with a new connection
+        if self.conn is not None:
+            self.conn.close()
+        raise e
+
+    def _read(self, fd, n, deadline):
+        # a future for exactly n bytes from fd
+        f = Future()
+        buf = bytearray()
+
+        def finish(error=None):
+            self.loop.remove_reader(fd)
+            EventLoop.cancel(timer)
+            if error is not None:
+                f.set_error(error)
+            else:
+                f.set_result(buf)
+
+        def readable():
+            try:
+                x = os.read(fd, n - len(buf))
+            except OSError, e:
+                if e.errno in [errno.EAGAIN, errno.EINTR]:
+                    return
+                return finish(IOError("read failed: %s" % e))
+            if not x:
+                return finish(IOError("connection closed"))
+            buf.extend(x)
+            if len(buf) == n:
+                finish()
+
+        timer = self.loop.call_at(deadline, finish, NoResponseError(
+            "no response from %s" % self.transport.settings))
+        self.loop.add_reader(fd, readable)
+        return f
+
+    def transact(self, address, pdu, timeout):
+        """Send a request pdu to the station at address, and return the
+        response pdu."""
+        yield self.lock.acquire()
+        try:
+            # the gap follows the baud rate, which a probe may change
+            wait = self.last_io + getattr(self.transport, 'gap', 0) - \
+                time.time()
+            if wait > 0:
+                yield self.loop.sleep(wait)
+            fd = self._open(timeout)
+            deadline = time.time() + timeout
+            if self.mbap:
+                resp = yield self.loop.spawn(
+                    self._mbap(fd, address, pdu, deadline))
+            else:
+                resp = yield self.loop.spawn(
+                    self._rtu(fd, address, pdu, deadline))
+        finally:
+            self.last_io = time.time()
+            self.lock.release()
+        raise Return(resp)
+
+    def _send(self, fd, data):
+        try:
+            if self.conn is not None:
+                self.conn.sock.sendall(bytes(data))
+            else:
+                os.write(fd, bytes(data))
+        except (socket.error, OSError), e:
+            self._fail(IOError("send failed: %s" % e))
+
+    def _rtu(self, fd, address, pdu, deadline):
+        self._send(fd, _rtu_frame(address, pdu))
+        try:
+            resp = yield self._read(fd, 3, deadline)
+            if resp[1] & 0x80:
+                n = 2
+            elif resp[1] in [3, 4]:
+                n = resp[2] + 2
+            else:
+                n = 5 # echo of address and count, plus crc
+            resp += yield self._read(fd, n, deadline)
+        except IOError, e:
+            self._fail(e)
+        if crc16(resp[:-2]) != resp[-2] + (resp[-1] << 8):
+            raise CRCError("bad crc in response")
+        if resp[0] != address:
+            raise IOError("response from address %s" % resp[0])
+        raise Return(resp[1:-2])
+
+    def _mbap(self, fd, address, pdu, deadline):
+        tid = self.conn.next_tid()
+        self._send(fd, struct.pack('>HHHB', tid, 0, len(pdu) + 1, address) +
+                   bytes(pdu))
+        try:
+            while True:
+                hdr = yield self._read(fd, 7, deadline)
+                rtid, _, length, _ = struct.unpack('>HHHB', bytes(hdr))
+                if length < 2:
+                    raise IOError("bad response length %s" % length)
+                resp = yield self._read(fd, length - 1, deadline)
+                if rtid == tid:
+                    break
+                logdbg("discarded response with transaction id %s" % rtid)
+        except IOError, e:
+            self._fail(e)
+        raise Return(resp)
+
+
+class AsyncCM1(object):
+    """Coroutine version of the CM1 protocol.  It runs the protocol
+    coroutines of a CM1, with its register map, cache, response time
+    estimates, statistics and recorder, and does the transactions through an
+    AsyncLink instead of the CM1 transport."""
+
+    def __init__(self, cm1, link):
+        self.cm1 = cm1
+        self.link = link
+        self.address = cm1.address
+        self.stats = cm1.stats
+
+    def _transact(self, reg, cnt, write, pdu, timeout=None):
+        # a transaction with a timeout based on its response time, or an
+        # untimed transaction with the given timeout
+        cm1 = self.cm1
+        timed = timeout is None
+        est = cm1._estimator(reg, cnt, write) if timed else None
+        if timed:
+            timeout = est.timeout if est is not None else cm1.timeout
+        t0 = time.time()
+        try:
+            resp = yield self.link.loop.spawn(
+                self.link.transact(self.address, pdu, timeout))
+            _check_pdu(16 if write else 3, resp)
+        except (IOError, ValueError, TypeError), e:
+            if timed:
+                cm1._record(reg, cnt, write, est, time.time() - t0, e)
+            raise
+        if timed:
+            cm1._record(reg, cnt, write, est, time.time() - t0)
+        raise Return(resp)
+
+    def read_block(self, reg, cnt, timeout=None):
+        resp = yield self.link.loop.spawn(
+            self._transact(reg, cnt, False, _read_pdu(reg, cnt), timeout))
+        if resp[1] != 2 * cnt or len(resp) != 2 + 2 * cnt:
+            raise IOError("expected %s registers, got %s bytes" %
+                          (cnt, len(resp) - 2))
+        raise Return(bytes(resp[2:]))
+
+    def read_registers(self, reg, cnt):
+        x = yield self.link.loop.spawn(self.read_block(reg, cnt))
+        raise Return(list(struct.unpack('>%dH' % cnt, x)))
+
+    def _run(self, coro):
+        """Run a protocol coroutine of the CM1 (see CM1._run) on the event
+        loop, with the transactions done through the link."""
+        spawn = self.link.loop.spawn
+        value = error = None
+        while True:
+            try:
+                if error is not None:
+                    step = coro.throw(error)
+                else:
+                    step = coro.send(value)
+            except Return, r:
+                raise Return(r.value)
+            except StopIteration:
+                raise Return(None)
+            value = error = None
+            try:
+                if isinstance(step, types.GeneratorType):
+                    value = yield spawn(self._run(step))
+                elif step[0] in ['read', 'probe']:
+                    value = yield spawn(self.read_block(*step[1:]))
+                elif step[0] == 'read_many':
+                    # the link has no pipelining, so read one at a time
+                    value = yield self.link.loop.gather(
+                        [spawn(self.read_block(reg, cnt))
+                         for reg, cnt in step[1]])
+                elif step[0] == 'write':
+                    reg, values = step[1:]
+                    yield spawn(self._transact(reg, len(values), True,
+                                               _write_pdu(reg, values)))
+                else:
+                    raise IOError("%s is not available on the event loop" %
+                                  step[0])
+            except Exception, e:
+                error = e
+
+    def write_registers(self, reg, values):
+        return self._run(self.cm1._write_registers_co(reg, values))
+
+    def read_blocks(self, blocks, tries=None):
+        return self._run(self.cm1._read_blocks_co(blocks, tries))
+
+    def read_current(self, plan, pkt, tries=None, span=None):
+        return self._run(self.cm1._read_current_co(plan, pkt, tries, span))
+
+    def get_current(self):
+        return self._run(self.cm1._current_co())
+
+    def get_system_parameters(self):
+        return self._run(self.cm1._system_parameters_co())
+
+    def get_clock(self):
+        return self._run(self.cm1._clock_co())
+
+    def probe(self, count=20):
+        return self._run(self.cm1._probe_co(count))
+
+    def find_baud_rate(self, rates=None):
+        return self._run(self.cm1._find_baud_rate_co(rates))
+
+    def get_logger_status(self):
+        return self._run(self.cm1._logger_status_co())
+
+    def get_logger_records(self, status, pos, n):
+        return self._run(self.cm1._logger_records_co(status, pos, n))
+
+    def find_logger_record(self, status, since_ts):
+        return self._run(self.cm1._find_logger_record_co(status, since_ts))
+
+
+if __name__ == '__main__':
+    import optparse
+
+    usage = """%prog [options] [--debug] [--help]"""
+
+    def main():
+        syslog.openlog('wee_cm1', syslog.LOG_PID | syslog.LOG_CONS)
+        parser = optparse.OptionParser(usage=usage)
+        parser.add_option('--version', dest='version', action='store_true',
+                          help='display driver version')
+        parser.add_option('--debug', dest='debug', action='store_true',
+                          help='display diagnostic information while running')
+        parser.add_option('--port', dest='port', metavar='PORT',
+                          help='serial port to which the station is'
+                          ' connected, tcp://host:port or'
+                          ' rtu+tcp://host:port for a network gateway, or'
+                          ' cm1d:///path/to/socket to go through the cm1'
+                          ' daemon',
+                          default=CM1.DEFAULT_PORT)
+        parser.add_option('--address', dest='address', metavar='ADDRESS',
+                          help='modbus slave address', type=int,
+                          default=CM1.DEFAULT_ADDRESS)
+        parser.add_option('--baud-rate', dest='baud_rate', metavar='BAUD_RATE',
+                          help='modbus slave baud rate', type=int,
+                          default=CM1.DEFAULT_BAUD_RATE)
+        parser.add_option('--timeout', dest='timeout', metavar='TIMEOUT',
+                          help='modbus timeout, in seconds', type=float,
+                          default=CM1.DEFAULT_TIMEOUT)
+        parser.add_option('--cache-ttl', dest='cache_ttl', metavar='SECONDS',
+                          type=float, default=0,
+                          help='answer reads from registers read less than'
+                          ' SECONDS ago')
+        parser.add_option('--client', dest='client', type='choice',
+                          default='native',
+                          choices=['native', 'minimalmodbus'],
+                          help='modbus client for a serial port: native or'
+                          ' minimalmodbus')
+        parser.add_option('--daemon', dest='daemon', action='store_true',
+                          help='own the port and serve the stations on it to'
+                          ' other processes until interrupted')
+        parser.add_option('--socket', dest='socket', metavar='PATH',
+                          default=CM1Daemon.DEFAULT_SOCKET,
+                          help='unix socket of the daemon')
+        parser.add_option('--max-age', dest='max_age', type=float,
+                          default=CM1Daemon.DEFAULT_MAX_AGE,
+                          metavar='SECONDS',
+                          help='how long the daemon answers reads from a'
+                          ' block it has read')
+        parser.add_option('--daemon-stats', dest='daemonstats',
+                          action='store_true',
+                          help='display the statistics of the daemon on'
+                          ' --socket')
+        parser.add_option('--get-time', dest='gettime', action='store_true',
+                          help='get station time')
+        parser.add_option('--set-time', dest='settime', action='store_true',
+                          help='set station time to computer time')
+        parser.add_option('--get-config', dest='getconfig',
+                          action='store_true',
+                          help='display the raw configuration registers')
+        parser.add_option('--get-logger-status', dest='loggerstatus',
+                          action='store_true',
+                          help='display the data logger status')
+        parser.add_option('--dump-logger', dest='dumplogger', type=int,
+                          metavar='N',
+                          help='display the N most recent logger records')
+        parser.add_option('--import-logger', dest='importlogger',
+                          metavar='CONFIG_FILE',
+                          help='download the logger records that are newer'
+                          ' than the weewx archive, and add them to the'
+                          ' archive in batches')
+        parser.add_option('--batch-size', dest='batch_size', type=int,
+                          default=500, metavar='N',
+                          help='records added to the archive in each'
+                          ' transaction')
+        parser.add_option('--probe-baud', dest='probebaud',
+                          action='store_true',
+                          help='find the baud rate of the station and measure'
+                          ' errors and latency at that rate')
+        parser.add_option('--probe-log', dest='probelog', metavar='FILE',
+                          help='append the probe results as JSON to FILE')
+        parser.add_option('--record', dest='record', metavar='FILE',
+                          help='append the raw register blocks to FILE')
+        parser.add_option('--replay', dest='replay', metavar='FILE',
+                          help='decode every raw register block in FILE')
+        parser.add_option('--quiet', dest='quiet', action='store_true',
+                          help='with --replay, report only the decode rate')
+        parser.add_option('--count', dest='count', type=int, default=100,
+                          metavar='N',
+                          help='number of reads at each rate for'
+                          ' --probe-baud')
+        (options, _) = parser.parse_args()
+
+        if options.version:
+            print "cm1 driver version %s" % DRIVER_VERSION
+            exit(1)
+
+        if options.debug is not None:
+            syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_DEBUG))
+        else:
+            syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_INFO))
+
+        if options.replay:
+            replay_capture(options.replay, options.quiet)
+            exit(0)
+
+        if options.importlogger:
+            import_logger(options.importlogger, options.batch_size)
+            exit(0)
+
+        if options.daemonstats:
+            print json.dumps(DaemonTransport(options.socket, None,
+                                             options.timeout).request(
+                                                 op='stats'),
+                             sort_keys=True, indent=2)
+            exit(0)
+        if options.daemon:
+            daemon = CM1Daemon(options.port, options.socket,
+                               options.baud_rate, options.timeout,
+                               options.max_age, options.client)
+            print "serving %s on %s" % (options.port, options.socket)
+            try:
+                daemon.serve_forever()
+            except KeyboardInterrupt:
+                daemon.close()
+            exit(0)
+        if options.probebaud:
+            probe_baud(options.port, options.address, options.baud_rate,
+                       options.timeout, options.count, options.probelog,
+                       options.client)
+            exit(0)
+        if options.getconfig:
+            get_config(options.port, options.address, options.baud_rate,
+                       options.timeout, options.client)
+            exit(0)
+
+        if True:
+            test_CM1(options.port, options.address, options.baud_rate,
+                     options.timeout, options.debug,
+                     options.gettime, options.settime,
+                     options.loggerstatus, options.dumplogger, options.client,
+                     options.record, options.cache_ttl)
+
+    def test_CM1(port, address, baud_rate, timeout, debug, gettime, settime,
+                 loggerstatus=False, dumplogger=None, client='native',
+                 record=None, cache_ttl=0):
+        station = CM1(port, address, baud_rate, timeout, client=client,
+                      cache_ttl=cache_ttl)
+        if record:
+            station.recorder = RawRecorder.get(record)
+        station.transport.debug = debug
+        if loggerstatus:
+            status = station.get_logger_status()
+            print "logger status:", status
+            try:
+                CM1.check_logger_status(status)
+            except ValueError, e:
+                print "not plausible: %s" % e
+            exit(0)
+        if dumplogger:
+            status = station.get_logger_status()
+            try:
+                CM1.check_logger_status(status)
+            except ValueError, e:
+                print "logger status not plausible: %s" % e
+                exit(1)
+            pos = max(0, status['count'] - dumplogger)
+            t0 = time.time()
+            recs = station.get_logger_records(status, pos,
+                                              status['count'] - pos)
+            elapsed = time.time() - t0
+            for rec in recs:
+                print rec
+            print "%s records in %.2f seconds" % (len(recs), elapsed)
+            exit(0)
+        if gettime:
+            print "epoch:", station.get_clock()
+            print "date:", station.get_date()
+            print "time:", station.get_time()
+            exit(0)
+        if settime:
+            print "epoch before:", station.get_clock()
+            station.set_clock()
+            print "epoch after:", station.get_clock()
+            print "date:", station.get_date()
             print "time:", station.get_time()
             exit(0)
         data = station.get_system_parameters()
@@ -551,35 +4542,96 @@ if __name__ == '__main__':
         data = station.get_current()
         print "current values: ", data
 
-    def test_mmb(port, address, baud_rate, timeout, debug):
-        print "\n\nminimalmodbus"
-        import minimalmodbus
-        instrument = minimalmodbus.Instrument(port, address)
-        instrument.serial.baudrate = baud_rate
-        instrument.serial.timeout = timeout
-        instrument.debug = debug
-        print instrument.read_register(100, 1)
-        print instrument.read_registers(100, 11)
-        print instrument.read_register(200, 1)
-        print instrument.read_registers(200, 92)
-
-    def test_mbtk(port, address, baud_rate, timeout, debug):
-        print "\n\nmodbus-tk"
-        import modbus_tk
-        import modbus_tk.defines as cst
-        from modbus_tk import modbus_rtu
-        import serial
-        if debug:
-            logger = modbus_tk.utils.create_logger("console")
-        master = modbus_rtu.RtuMaster(
-            serial.Serial(port=port, baudrate=baud_rate,
-                          bytesize=8, parity='N', stopbits=1))
-        master.set_timeout(timeout)
-        if debug:
-            master.set_verbose(True)
-        print master.execute(address, cst.READ_HOLDING_REGISTERS, 100, 1)
-        print master.execute(address, cst.READ_HOLDING_REGISTERS, 100, 11)
-        print master.execute(address, cst.READ_HOLDING_REGISTERS, 200, 1)
-        print master.execute(address, cst.READ_HOLDING_REGISTERS, 200, 92)
+    def get_config(port, address, baud_rate, timeout, client='native'):
+        station = CM1(port, address, baud_rate, timeout, client=client)
+        print "these registers are not in the published register map"
+        for i, value in enumerate(station.get_config()):
+            print "register %s: %s" % (CM1.CONFIG_REGISTER + i, value)
+
+    def import_logger(config_path, batch_size):
+        import configobj
+        import shutil
+        import tempfile
+        import weewx.manager
+        config_dict = configobj.ConfigObj(config_path, file_error=True)
+        # the import does not poll, so it has no identities to add.  a
+        # scratch file keeps it from pruning the one that weewx uses.
+        tmpdir = tempfile.mkdtemp(prefix='cm1import')
+        config_dict[DRIVER_NAME]['identity_file'] = os.path.join(
+            tmpdir, 'identity.json')
+        driver = CM1Driver(**config_dict[DRIVER_NAME])
+        # asking for the import is enough to enable the download
+        driver.logger_download = True
+        t0 = time.time()
+        n = 0
+        with weewx.manager.open_manager_with_config(
+                config_dict, 'wx_binding', initialize=True) as dbm:
+            batch = []
+            for rec in driver.genArchiveRecords(dbm.lastGoodStamp()):
+                batch.append(rec)
+                if len(batch) >= batch_size:
+                    # one transaction for the whole batch
+                    dbm.addRecord(batch)
+                    n += len(batch)
+                    batch = []
+            if batch:
+                dbm.addRecord(batch)
+                n += len(batch)
+        driver.closePort()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        elapsed = time.time() - t0
+        print "imported %s records in %.1f seconds (%.1f records/s)" % (
+            n, elapsed, n / elapsed if elapsed > 0 else 0)
+
+    def probe_baud(port, address, baud_rate, timeout, count, log_path=None,
+                   client='native'):
+        station = CM1(port, address, baud_rate, timeout, client=client)
+        if station.transport.baud_rate is None:
+            print "%s has no baud rate" % port
+            return
+        if station.find_baud_rate([baud_rate] + CM1.SUPPORTED_BAUD_RATES) \
+                is None:
+            print "no response at any baud rate"
+            return
+        print "station is at %s baud" % station.transport.baud_rate
+        results = [station.probe(count)]
+        best = CM1.recommend_baud_rate(results)
+        print "%8s %8s %10s %10s %10s" % ('baud', 'errors', 'mean ms',
+                                          'p90 ms', 'max ms')
+        for r in results:
+            ms = lambda x: '%.1f' % (1000 * x) if x is not None else '-'
+            print "%8s %8s %10s %10s %10s" % (
+                r['baud_rate'], '-' if r['errors'] is None else r['errors'],
+                ms(r['latency']), ms(r.get('latency_p90')),
+                ms(r.get('latency_max')))
+        print "recommended: %s" % best
+        if log_path:
+            with open(log_path, 'a') as f:
+                f.write(json.dumps(dict(
+                    time=time.time(), port=port, address=address,
+                    results=results, recommended=best,
+                    baud_rate=station.transport.baud_rate),
+                                   sort_keys=True) + "\n")
+
+    def replay_capture(path, quiet=False):
+        # decode each block on its own, so a capture can be checked against
+        # the current decoder whatever plan recorded it
+        transport = ReplayTransport(path)
+        regmap = RegisterMap(CM1.REGISTER_MAP)
+        plans = dict()
+        t0 = time.time()
+        for ts, address, reg, cnt, payload in transport.records():
+            plan = plans.get((reg, cnt))
+            if plan is None:
+                plan = regmap.compile([(reg, cnt)])
+                plans[(reg, cnt)] = plan
+            pkt = plan.decode([payload], dict(time=ts, address=address))
+            if not quiet:
+                print pkt
+        elapsed = time.time() - t0
+        print "%s records in %.2f seconds (%.0f records/s)" % (
+            len(transport), elapsed,
+            len(transport) / elapsed if elapsed > 0 else 0)
+        transport.close()
 
     main()
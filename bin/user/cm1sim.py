@@ -0,0 +1,808 @@
+#!/usr/bin/env python
+# Copyright 2016 Matthew Wall
+# Distributed under the terms of the GNU Public License (GPLv3)
+
+"""Simulated CM1 and benchmarks for the CM1 driver.
+
+The simulator answers Modbus-RTU requests on a pseudo-terminal, or Modbus TCP
+and raw RTU frames on a local socket, so the driver can be run and measured
+without a station.  None of this is needed by weewx, so it is kept out of the
+driver module.
+
+PYTHONPATH=bin python bin/user/cm1sim.py --serve-simulator
+PYTHONPATH=bin python bin/user/cm1sim.py --simulator --benchmark
+PYTHONPATH=bin python bin/user/cm1sim.py --port /dev/ttyUSB0 --sweep
+"""
+
+import json
+import os
+import random
+import select
+import shutil
+import socket
+import struct
+import syslog
+import tempfile
+import threading
+import time
+
+import weewx
+
+import cm1
+from cm1 import CM1, CM1Driver, DRIVER_VERSION, Transport, crc16, loginf
+from cm1 import serial
+
+
+class CM1Simulator(object):
+    """Software CM1 that answers Modbus-RTU requests on a pseudo-terminal,
+    or Modbus TCP or RTU-over-TCP requests on a local socket.
+
+    The simulator serves the system registers (100-110), the logger status
+    and select registers, the current conditions (200-291) and the logger
+    window.  Faults can be injected to exercise the driver: latency is added
+    to every response, and each request may be dropped (timeout), answered
+    with a bad CRC, answered with a Modbus exception, or answered with a
+    response that is cut short.  On modbus tcp, a stale response with
+    another transaction id may be sent ahead of the real one.  The address
+    may be a list, to simulate several stations on one bus."""
+
+    READ_FUNCTIONS = [3, 4]
+    VALID_RANGES = [(100, 111), (CM1.LOGGER_STATUS_REGISTER,
+                                 CM1.LOGGER_SELECT_REGISTER + 2),
+                    (CM1.CONFIG_REGISTER,
+                     CM1.CONFIG_REGISTER + CM1.CONFIG_COUNT),
+                    (200, 292),
+                    (CM1.LOGGER_WINDOW_REGISTER,
+                     CM1.LOGGER_WINDOW_REGISTER + CM1.MAX_READ_REGISTERS)]
+
+    def __init__(self, address=CM1.DEFAULT_ADDRESS, latency=0.0,
+                 crc_error_rate=0.0, timeout_rate=0.0, exception_rate=0.0,
+                 exception_code=4, logger_records=0, logger_interval=5,
+                 seed=None, baud_rate=CM1.DEFAULT_BAUD_RATE,
+                 baud_error_rates=None, short_rate=0.0, stale_rate=0.0):
+        self.address = address
+        # on a pseudo-terminal, requests are answered only at baud_rate, and
+        # baud_error_rates gives the fraction of bad responses at each rate
+        self.baud_rate = baud_rate
+        self.baud_error_rates = baud_error_rates or dict()
+        self.addresses = address if isinstance(address, list) else [address]
+        self.latency = latency
+        self.crc_error_rate = crc_error_rate
+        self.timeout_rate = timeout_rate
+        self.exception_rate = exception_rate
+        self.exception_code = exception_code
+        self.short_rate = short_rate
+        self.stale_rate = stale_rate
+        self.random = random.Random(seed)
+        self.stats = dict(requests=0, responses=0, timeouts=0,
+                          crc_errors=0, exceptions=0, short=0, stale=0)
+        self.registers = dict()
+        self.clock_offset = 0
+        self.logger_select = 0
+        self.logger_interval = logger_interval
+        self.logger = dict()
+        self._init_registers()
+        self._init_logger(logger_records, logger_interval)
+        self.master = None
+        self.slave = None
+        self.listener = None
+        self.thread = None
+        self.running = False
+
+    def _init_registers(self):
+        r = self.registers
+        for reg in range(100, 111) + range(200, 292) + range(
+                CM1.CONFIG_REGISTER,
+                CM1.CONFIG_REGISTER + CM1.CONFIG_COUNT):
+            r[reg] = 0
+        r[100] = 120 # product id
+        r[101] = 105 # firmware version
+        r[102], r[103] = 0, 12345 # serial number
+        r[108] = 13200 # battery, mV
+        r[109] = 18000 # solar, mV
+        r[110] = 3 # float charge
+        r[201], r[202] = 35, 2250
+        r[203], r[204] = 32, 2240
+        r[205], r[206] = 30, 2230
+        r[207], r[208] = 81, 2300
+        r[221], r[222] = 215, 455
+        r[223], r[224], r[225] = 10132, 0, 220
+        r[240], r[241] = 215, 215
+        r[248], r[249] = 90, 140
+        r[244], r[245] = CM1Simulator._from_float(12.5)
+        r[246], r[247] = CM1Simulator._from_float(-3.25)
+        r[284] = 63 # out of range
+        r[133], r[135], r[137], r[138] = 0, 120, 2, 2
+
+    def _init_logger(self, n, interval):
+        # fill the ring so that the newest record is a few slots from the
+        # start, so a full download wraps around the end of the ring
+        n = min(n, CM1.LOGGER_CAPACITY)
+        newest = (n + 7) % CM1.LOGGER_CAPACITY
+        self.logger_count = n
+        self.logger_newest = newest
+        now = int(time.time()) // 60 * 60
+        for pos in range(n):
+            ts = now - (n - pos) * interval * 60
+            idx = (newest - n + 1 + pos) % CM1.LOGGER_CAPACITY
+            self.logger[idx] = self._make_record(ts)
+
+    def _make_record(self, ts):
+        ds, tm = CM1Simulator._to_date_time(ts)
+        r = self.registers
+        x = [tm >> 16, tm & 0xffff, ds >> 16, ds & 0xffff,
+             r[201], r[202], r[207], r[208], r[221], r[222], r[223],
+             self.random.randint(0, 2), r[240], r[241], r[248], r[249]]
+        x.extend(CM1Simulator._from_float(12.5))
+        x.extend(CM1Simulator._from_float(-3.25))
+        return x
+
+    @staticmethod
+    def _from_float(f):
+        return struct.unpack('>HH', struct.pack('f', f))
+
+    @staticmethod
+    def _to_date_time(ts):
+        t = time.localtime(ts)
+        ds = (t.tm_year - 2000) * 10000 + t.tm_mon * 100 + t.tm_mday
+        tm = t.tm_hour * 10000 + t.tm_min * 100 + t.tm_sec
+        return ds, tm
+
+    def _update(self):
+        # make the weather change a little on every read
+        r = self.registers
+        r[201] = max(0, r[201] + self.random.randint(-5, 5))
+        r[202] = (r[202] + self.random.randint(-50, 50)) % 3600
+        if self.random.random() < 0.05:
+            r[242] = (r[242] + 1) & 0xffff
+        ds, tm = CM1Simulator._to_date_time(time.time() + self.clock_offset)
+        r[104], r[105] = tm >> 16, tm & 0xffff
+        r[106], r[107] = ds >> 16, ds & 0xffff
+        r[120] = r[CM1.CONFIG_REGISTER] = self.logger_interval
+        r[121], r[122] = self.logger_count >> 16, self.logger_count & 0xffff
+        r[123], r[124] = self.logger_newest >> 16, self.logger_newest & 0xffff
+        r[125] = self.logger_select >> 16
+        r[126] = self.logger_select & 0xffff
+
+    def _valid(self, reg, cnt):
+        for lo, hi in CM1Simulator.VALID_RANGES:
+            if lo <= reg and reg + cnt <= hi:
+                return True
+        return False
+
+    def _read(self, reg, cnt):
+        if reg >= CM1.LOGGER_WINDOW_REGISTER:
+            x = []
+            idx = self.logger_select
+            while len(x) < cnt + reg - CM1.LOGGER_WINDOW_REGISTER:
+                x.extend(self.logger.get(idx % CM1.LOGGER_CAPACITY,
+                                         [0] * CM1.LOGGER_RECORD_SIZE))
+                idx += 1
+            return x[reg - CM1.LOGGER_WINDOW_REGISTER:][:cnt]
+        return [self.registers[reg + i] for i in range(cnt)]
+
+    def _write(self, reg, values):
+        for i, v in enumerate(values):
+            self.registers[reg + i] = v
+        if reg == CM1.LOGGER_SELECT_REGISTER and len(values) == 2:
+            self.logger_select = (values[0] << 16) + values[1]
+        if reg == 104 and len(values) == 4:
+            ts = CM1._to_long(values[0], values[1])
+            ds = CM1._to_long(values[2], values[3])
+            self.clock_offset = CM1._to_epoch(ds, ts) - time.time()
+
+    def process_pdu(self, pdu):
+        """Return the response PDU for a request PDU."""
+        fn = pdu[0]
+        if self.exception_rate and self.random.random() < self.exception_rate:
+            self.stats['exceptions'] += 1
+            return bytearray([fn | 0x80, self.exception_code])
+        if fn in CM1Simulator.READ_FUNCTIONS or fn == 16:
+            reg, cnt = struct.unpack('>HH', bytes(pdu[1:5]))
+            limit = 125 if fn != 16 else 123
+            if cnt < 1 or cnt > limit:
+                return bytearray([fn | 0x80, 3])
+            if not self._valid(reg, cnt):
+                return bytearray([fn | 0x80, 2])
+            self._update()
+            if fn == 16:
+                values = struct.unpack('>%dH' % cnt, bytes(pdu[6:6 + 2 * cnt]))
+                self._write(reg, values)
+                return bytearray(pdu[0:5])
+            x = self._read(reg, cnt)
+            return bytearray([fn, 2 * cnt]) + \
+                bytearray(struct.pack('>%dH' % cnt, *x))
+        if fn == 6:
+            reg, value = struct.unpack('>HH', bytes(pdu[1:5]))
+            if not self._valid(reg, 1):
+                return bytearray([fn | 0x80, 2])
+            self._write(reg, [value])
+            return bytearray(pdu[0:5])
+        return bytearray([fn | 0x80, 1])
+
+    def process_frame(self, frame):
+        """Return the RTU response frame for an RTU request frame, or None
+        if the simulator should not answer."""
+        self.stats['requests'] += 1
+        if len(frame) < 4 or crc16(frame[:-2]) != \
+                frame[-2] + (frame[-1] << 8):
+            return None
+        if frame[0] not in self.addresses:
+            return None
+        if self.timeout_rate and self.random.random() < self.timeout_rate:
+            self.stats['timeouts'] += 1
+            return None
+        resp = bytearray([frame[0]]) + self.process_pdu(frame[1:-2])
+        crc = crc16(resp)
+        if self.crc_error_rate and \
+                self.random.random() < self.crc_error_rate:
+            self.stats['crc_errors'] += 1
+            crc ^= 0x5555
+        resp += bytearray([crc & 0xff, crc >> 8])
+        self.stats['responses'] += 1
+        return self._cut(resp)
+
+    def _cut(self, resp):
+        # lose the end of the response, as a gateway might
+        if self.short_rate and self.random.random() < self.short_rate:
+            self.stats['short'] += 1
+            return resp[:-3]
+        return resp
+
+    def process_mbap(self, frame):
+        """Return the modbus tcp response for a modbus tcp request, or None
+        if the simulator should not answer."""
+        self.stats['requests'] += 1
+        tid, _, _, unit = struct.unpack('>HHHB', bytes(frame[0:7]))
+        if unit not in self.addresses:
+            return None
+        if self.timeout_rate and self.random.random() < self.timeout_rate:
+            self.stats['timeouts'] += 1
+            return None
+        pdu = self.process_pdu(frame[7:])
+        self.stats['responses'] += 1
+        resp = bytearray(struct.pack('>HHHB', tid, 0, len(pdu) + 1,
+                                     unit)) + pdu
+        if self.stale_rate and self.random.random() < self.stale_rate:
+            # the answer to an earlier request that the client gave up on
+            self.stats['stale'] += 1
+            resp = bytearray(struct.pack('>H', (tid - 1) & 0xffff)) + \
+                resp[2:] + resp
+        return self._cut(resp)
+
+    def _read_frame(self, fd):
+        # read one request frame.  the frame length follows from the
+        # function code, so there is no need to wait for a silent period.
+        frame = self._read_bytes(fd, 2)
+        if frame is None:
+            return None
+        fn = frame[1]
+        if fn == 16:
+            frame += self._read_bytes(fd, 5) or bytearray()
+            if len(frame) == 7:
+                frame += self._read_bytes(fd, frame[6] + 2) or bytearray()
+        elif fn in [3, 4, 6]:
+            frame += self._read_bytes(fd, 6) or bytearray()
+        else:
+            # unknown function: take whatever else arrives with the frame
+            time.sleep(0.01)
+            while select.select([fd], [], [], 0)[0]:
+                frame += bytearray(os.read(fd, 256))
+        return frame
+
+    def _read_mbap(self, fd):
+        frame = self._read_bytes(fd, 7)
+        if frame is None:
+            return None
+        length = struct.unpack('>H', bytes(frame[4:6]))[0]
+        rest = self._read_bytes(fd, length - 1)
+        if rest is None:
+            return None
+        return frame + rest
+
+    def _read_bytes(self, fd, n):
+        # returns None at end of file or when the simulator stops
+        buf = bytearray()
+        while len(buf) < n and self.running:
+            r, _, _ = select.select([fd], [], [], 0.1)
+            if r:
+                try:
+                    x = os.read(fd, n - len(buf))
+                except OSError:
+                    return None
+                if not x:
+                    return None
+                buf += bytearray(x)
+        return buf if len(buf) == n else None
+
+    def _respond(self, resp, send):
+        if resp is None:
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        send(bytes(resp))
+
+    def _serve(self):
+        import termios
+        send = lambda x: os.write(self.master, x)
+        while self.running:
+            frame = self._read_frame(self.master)
+            if frame is None:
+                continue
+            # a frame sent at the wrong speed would arrive garbled
+            speed = termios.tcgetattr(self.master)[4]
+            if speed != getattr(termios, 'B%d' % self.baud_rate, speed):
+                continue
+            resp = self.process_frame(frame)
+            rate = self.baud_error_rates.get(self.baud_rate, 0)
+            if resp is not None and rate and self.random.random() < rate:
+                self.stats['crc_errors'] += 1
+                resp[-1] ^= 0x55
+            self._respond(resp, send)
+
+    def _serve_tcp(self, rtu):
+        clients = []
+        while self.running:
+            r, _, _ = select.select([self.listener] + clients, [], [], 0.1)
+            for s in r:
+                if s is self.listener:
+                    c = s.accept()[0]
+                    c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    clients.append(c)
+                    continue
+                if rtu:
+                    frame = self._read_frame(s.fileno())
+                else:
+                    frame = self._read_mbap(s.fileno())
+                if frame is None:
+                    clients.remove(s)
+                    s.close()
+                elif rtu:
+                    self._respond(self.process_frame(frame), s.sendall)
+                else:
+                    self._respond(self.process_mbap(frame), s.sendall)
+        for s in clients:
+            s.close()
+
+    def _start(self, target, *args):
+        self.running = True
+        self.thread = threading.Thread(target=target, args=args)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def open(self):
+        """Create the pseudo-terminal pair, start serving, and return the
+        name of the port to which a client should connect."""
+        import tty
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self._start(self._serve)
+        port = os.ttyname(self.slave)
+        loginf("simulator: serving address %s on %s" % (self.address, port))
+        return port
+
+    def open_tcp(self, rtu=False, host='127.0.0.1', port=0):
+        """Serve on a tcp socket, as a stand-in for a network gateway.  The
+        simulator speaks modbus tcp, or raw rtu frames if rtu is set.
+        Returns the port to which a client should connect."""
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(5)
+        self._start(self._serve_tcp, rtu)
+        port = "%s://%s:%s" % ('rtu+tcp' if rtu else 'tcp', host,
+                               self.listener.getsockname()[1])
+        loginf("simulator: serving address %s on %s" % (self.address, port))
+        return port
+
+    def close(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for fd in [self.master, self.slave]:
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, _, value, traceback):
+        self.close()
+
+
+def benchmark_decode(n=10000):
+    """Measure the logger decode rate with each decoder that is
+    available, on n simulated records."""
+    sim = CM1Simulator(logger_records=n, seed=0)
+    raw = struct.pack('>%dH' % (n * CM1.LOGGER_RECORD_SIZE),
+                      *[x for i in sorted(sim.logger)
+                        for x in sim.logger[i]])
+    results = dict()
+    saved = cm1.numpy
+    for name in ['numpy', 'python']:
+        if name == 'numpy' and saved is None:
+            continue
+        cm1.numpy = saved if name == 'numpy' else None
+        t0 = time.time()
+        CM1.decode_logger_records(raw, n)
+        elapsed = time.time() - t0
+        results[name] = dict(records=n, seconds=elapsed,
+                             records_per_second=n / elapsed)
+    cm1.numpy = saved
+    return results
+
+
+def summarize(samples):
+    # latency statistics, in seconds
+    samples = sorted(samples)
+    n = len(samples)
+    if n == 0:
+        return dict(count=0)
+    def pct(p):
+        return samples[min(n - 1, int(p * n))]
+    return dict(count=n, min=samples[0], mean=sum(samples) / n,
+                p50=pct(0.50), p90=pct(0.90), p99=pct(0.99),
+                max=samples[-1])
+
+
+def save_results(results, filename=None):
+    s = json.dumps(results, indent=2, sort_keys=True)
+    if filename:
+        with open(filename, 'w') as f:
+            f.write(s + "\n")
+    else:
+        print s
+
+
+def importable(name):
+    # whether an optional modbus client is installed
+    try:
+        __import__(name)
+        return True
+    except ImportError:
+        return False
+
+
+def run_benchmark(port, address, baud_rate, timeout, count, sim=None,
+                  client='native'):
+    """Measure get_current latency, loop packet throughput, retry
+    behaviour and logger download rate.  On a serial port, get_current
+    is measured with both modbus clients.  Returns a dict that can be
+    saved as JSON and compared between runs."""
+    results = dict(driver_version=DRIVER_VERSION, port=port,
+                   address=address, baud_rate=baud_rate,
+                   timeout=timeout, count=count, timestamp=time.time(),
+                   simulator=sim is not None, client=client)
+    if sim is not None:
+        results['simulator_settings'] = dict(
+            latency=sim.latency, crc_error_rate=sim.crc_error_rate,
+            timeout_rate=sim.timeout_rate,
+            exception_rate=sim.exception_rate,
+            exception_code=sim.exception_code, short_rate=sim.short_rate,
+            stale_rate=sim.stale_rate)
+
+    # the other client is timed too, if it can be used on the port
+    clients = [client]
+    if '://' not in port:
+        clients = [client] + [c for c in ['native', 'minimalmodbus']
+                              if c != client and importable(c)]
+    results['clients'] = dict()
+    for c in clients:
+        station = CM1(port, address, baud_rate, timeout, client=c)
+        samples = []
+        errors = 0
+        for _ in range(count):
+            t0 = time.time()
+            try:
+                station.get_current()
+                samples.append(time.time() - t0)
+            except (IOError, ValueError, TypeError):
+                errors += 1
+        station.transport.close()
+        results['clients'][c] = summarize(samples)
+        results['clients'][c]['errors'] = errors
+        print "get_current (%s): %s" % (c, results['clients'][c])
+    results['get_current'] = results['clients'][client]
+
+    # a scratch identity file, so the benchmark neither reads nor
+    # replaces the one that weewx uses.  the logger registers are assumed,
+    # so the download is timed only against the simulator.
+    tmpdir = tempfile.mkdtemp(prefix='cm1bench')
+    driver = CM1Driver(port=port, address=address, baud_rate=baud_rate,
+                       timeout=timeout, poll_interval=0, retry_wait=0,
+                       modbus_client=client, logger_download=sim is not None,
+                       identity_file=os.path.join(tmpdir, 'identity.json'))
+    if sim is not None:
+        t0 = time.time()
+        n = 0
+        try:
+            for _ in driver.genArchiveRecords(None):
+                n += 1
+        except weewx.WeeWxIOError, e:
+            results['archive_error'] = str(e)
+        elapsed = time.time() - t0
+        results['archive'] = dict(records=n, seconds=elapsed,
+                                  records_per_second=n / elapsed
+                                  if elapsed > 0 else 0)
+    else:
+        results['archive'] = 'skipped'
+    print "archive: %s" % results['archive']
+    results['logger_decode'] = benchmark_decode()
+    print "logger decode: %s" % results['logger_decode']
+    stats0 = dict(sim.stats) if sim is not None else None
+    t0 = time.time()
+    n = 0
+    failures = 0
+    gen = driver.genLoopPackets()
+    while n + failures < count:
+        try:
+            gen.next()
+            n += 1
+        except weewx.WeeWxIOError:
+            failures += 1
+            gen = driver.genLoopPackets()
+    elapsed = time.time() - t0
+    driver.closePort()
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    results['loop'] = dict(packets=n, failures=failures,
+                           seconds=elapsed,
+                           packets_per_second=n / elapsed
+                           if elapsed > 0 else 0,
+                           buffer=driver.buffer.stats())
+    if stats0 is not None:
+        # retry behaviour: how many transactions each packet cost, and
+        # which faults caused the extra transactions
+        stats = dict((k, sim.stats[k] - stats0[k]) for k in stats0)
+        results['loop']['transactions'] = stats['requests']
+        results['loop']['transactions_per_packet'] = \
+            float(stats['requests']) / max(driver.buffer.queued, 1)
+        results['loop']['faults'] = stats
+    print "loop: %s" % results['loop']
+    return results
+
+
+class ModbusTkTransport(Transport):
+    # modbus-tk as a client, for comparison in a sweep
+
+    def __init__(self, port, address, baud_rate, timeout):
+        import modbus_tk.defines
+        from modbus_tk import modbus_rtu
+        self.read_function = modbus_tk.defines.READ_HOLDING_REGISTERS
+        self.address = address
+        self.master = modbus_rtu.RtuMaster(
+            serial.Serial(port=port, baudrate=baud_rate, bytesize=8,
+                          parity='N', stopbits=1))
+        self.master.set_timeout(timeout)
+
+    def read_block(self, reg, cnt):
+        values = self.master.execute(self.address, self.read_function,
+                                     reg, cnt)
+        return struct.pack('>%dH' % cnt, *values)
+
+    def write_registers(self, reg, values):
+        import modbus_tk.defines
+        self.master.execute(self.address,
+                            modbus_tk.defines.WRITE_MULTIPLE_REGISTERS, reg,
+                            output_value=values)
+
+    def close(self):
+        self.master.close()
+
+
+def sweep_clients(port):
+    # the clients that can be used on the port
+    if '://' in port:
+        return ['native']
+    return ['native'] + [c for c in ['minimalmodbus', 'modbus_tk']
+                         if importable(c)]
+
+
+def parse_sizes(text):
+    if '-' in text:
+        lo, hi = text.split('-')
+        return range(int(lo), int(hi) + 1)
+    return [int(x) for x in text.split(',')]
+
+
+def run_sweep(port, address, baud_rate, timeout, count, start, sizes):
+    """Time count reads of each block size from start, with each modbus
+    client that is available.  Returns latency percentiles, throughput
+    and error rate for each client and block size."""
+    results = []
+    for client in sweep_clients(port):
+        if client == 'modbus_tk':
+            transport = ModbusTkTransport(port, address, baud_rate,
+                                          timeout)
+        else:
+            transport = Transport.create(port, address, baud_rate,
+                                         timeout, client=client)
+        for cnt in sizes:
+            samples = []
+            errors = 0
+            t0 = time.time()
+            for _ in range(count):
+                t1 = time.time()
+                try:
+                    transport.read_registers(start, cnt)
+                    samples.append(time.time() - t1)
+                except (IOError, ValueError, TypeError):
+                    errors += 1
+            elapsed = time.time() - t0
+            r = summarize(samples)
+            r.update(client=client, register=start, registers=cnt,
+                     transactions=count, errors=errors,
+                     error_rate=float(errors) / count,
+                     transactions_per_second=count / elapsed,
+                     registers_per_second=cnt * len(samples) / elapsed)
+            print "%-14s %4s registers: p50 %.1f ms, p99 %.1f ms," \
+                  " %.0f registers/s, %s errors" % (
+                      client, cnt, 1000 * (r.get('p50') or 0),
+                      1000 * (r.get('p99') or 0),
+                      r['registers_per_second'], errors)
+            results.append(r)
+        transport.close()
+    return dict(driver_version=DRIVER_VERSION, port=port,
+                address=address, baud_rate=baud_rate, timeout=timeout,
+                timestamp=time.time(), results=results)
+
+
+def save_csv(rows, filename):
+    columns = ['client', 'register', 'registers', 'transactions',
+               'errors', 'error_rate', 'min', 'mean', 'p50', 'p90', 'p99',
+               'max', 'transactions_per_second', 'registers_per_second']
+    with open(filename, 'w') as f:
+        f.write(','.join(columns) + "\n")
+        for r in rows:
+            f.write(','.join('' if r.get(c) is None else str(r[c])
+                             for c in columns) + "\n")
+
+
+if __name__ == '__main__':
+    import optparse
+
+    usage = """%prog [options] [--help]"""
+
+    def main():
+        syslog.openlog('wee_cm1sim', syslog.LOG_PID | syslog.LOG_CONS)
+        syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_INFO))
+        parser = optparse.OptionParser(usage=usage)
+        parser.add_option('--port', dest='port', metavar='PORT',
+                          help='port of the station to measure, as for the'
+                          ' driver', default=CM1.DEFAULT_PORT)
+        parser.add_option('--address', dest='address', metavar='ADDRESS',
+                          help='modbus slave address', type=int,
+                          default=CM1.DEFAULT_ADDRESS)
+        parser.add_option('--baud-rate', dest='baud_rate', metavar='BAUD_RATE',
+                          help='modbus slave baud rate', type=int,
+                          default=CM1.DEFAULT_BAUD_RATE)
+        parser.add_option('--timeout', dest='timeout', metavar='TIMEOUT',
+                          help='modbus timeout, in seconds', type=float,
+                          default=CM1.DEFAULT_TIMEOUT)
+        parser.add_option('--client', dest='client', type='choice',
+                          default='native',
+                          choices=['native', 'minimalmodbus'],
+                          help='modbus client for a serial port: native or'
+                          ' minimalmodbus')
+        parser.add_option('--benchmark', dest='benchmark', action='store_true',
+                          help='measure driver performance')
+        parser.add_option('--sweep', dest='sweep', action='store_true',
+                          help='time reads of each block size with each'
+                          ' modbus client')
+        parser.add_option('--sweep-start', dest='sweep_start', type=int,
+                          default=200, metavar='REGISTER',
+                          help='first register of the blocks in a sweep')
+        parser.add_option('--sweep-sizes', dest='sweep_sizes',
+                          default='1,2,4,8,16,32,64,92', metavar='SIZES',
+                          help='block sizes in a sweep, as a list such as'
+                          ' 1,8,64 or a range such as 1-125')
+        parser.add_option('--count', dest='count', type=int, default=100,
+                          metavar='N',
+                          help='number of transactions per benchmark')
+        parser.add_option('--output', dest='output', metavar='FILE',
+                          help='write benchmark results to FILE, as CSV if'
+                          ' FILE ends in .csv, otherwise as JSON')
+        parser.add_option('--simulator', dest='simulator',
+                          action='store_true',
+                          help='use a simulated station instead of the port')
+        parser.add_option('--serve-simulator', dest='servesim',
+                          action='store_true',
+                          help='run a simulated station until interrupted')
+        parser.add_option('--sim-transport', dest='sim_transport',
+                          type='choice', default='serial',
+                          choices=['serial', 'tcp', 'rtu+tcp'],
+                          help='how the simulator is reached: serial, tcp,'
+                          ' or rtu+tcp')
+        parser.add_option('--sim-latency', dest='sim_latency', type=float,
+                          default=0.0, metavar='SECONDS',
+                          help='simulator response latency')
+        parser.add_option('--sim-crc-errors', dest='sim_crc', type=float,
+                          default=0.0, metavar='RATE',
+                          help='fraction of simulator responses with bad CRC')
+        parser.add_option('--sim-timeouts', dest='sim_timeouts', type=float,
+                          default=0.0, metavar='RATE',
+                          help='fraction of requests the simulator ignores')
+        parser.add_option('--sim-exceptions', dest='sim_exceptions',
+                          type=float, default=0.0, metavar='RATE',
+                          help='fraction of requests answered with an'
+                          ' exception')
+        parser.add_option('--sim-exception-code', dest='sim_code', type=int,
+                          default=4, metavar='CODE',
+                          help='modbus exception code to inject (1-4)')
+        parser.add_option('--sim-short', dest='sim_short', type=float,
+                          default=0.0, metavar='RATE',
+                          help='fraction of responses that are cut short')
+        parser.add_option('--sim-stale', dest='sim_stale', type=float,
+                          default=0.0, metavar='RATE',
+                          help='fraction of modbus tcp responses that follow'
+                          ' a stale response')
+        parser.add_option('--sim-baud-rate', dest='sim_baud', type=int,
+                          default=CM1.DEFAULT_BAUD_RATE, metavar='RATE',
+                          help='baud rate of the simulated station')
+        parser.add_option('--sim-baud-errors', dest='sim_baud_errors',
+                          metavar='RATE:FRACTION,...',
+                          help='fraction of bad responses at each baud rate,'
+                          ' for example 115200:0.1,57600:0.01')
+        parser.add_option('--sim-logger-records', dest='sim_records',
+                          type=int, default=2000, metavar='N',
+                          help='number of records in the simulated logger')
+        (options, _) = parser.parse_args()
+
+        sim = None
+        if options.simulator or options.servesim:
+            sim = CM1Simulator(address=options.address,
+                               latency=options.sim_latency,
+                               crc_error_rate=options.sim_crc,
+                               timeout_rate=options.sim_timeouts,
+                               exception_rate=options.sim_exceptions,
+                               exception_code=options.sim_code,
+                               short_rate=options.sim_short,
+                               stale_rate=options.sim_stale,
+                               logger_records=options.sim_records,
+                               baud_rate=options.sim_baud,
+                               baud_error_rates=dict(
+                                   (int(a), float(b)) for a, b in
+                                   [x.split(':') for x in
+                                    (options.sim_baud_errors or '').split(',')
+                                    if x]))
+            if options.sim_transport == 'serial':
+                options.port = sim.open()
+            else:
+                options.port = sim.open_tcp(
+                    rtu=options.sim_transport == 'rtu+tcp')
+        if options.servesim:
+            print "simulated station at address %s on %s" % (
+                options.address, options.port)
+            try:
+                while True:
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                pass
+            sim.close()
+            exit(0)
+        if options.sweep:
+            results = run_sweep(options.port, options.address,
+                                options.baud_rate, options.timeout,
+                                options.count, options.sweep_start,
+                                parse_sizes(options.sweep_sizes))
+            if options.output and options.output.endswith('.csv'):
+                save_csv(results['results'], options.output)
+            else:
+                save_results(results, options.output)
+        elif options.benchmark:
+            results = run_benchmark(options.port, options.address,
+                                    options.baud_rate, options.timeout,
+                                    options.count, sim, options.client)
+            save_results(results, options.output)
+        else:
+            parser.print_help()
+        if sim is not None:
+            sim.close()
+
+    main()
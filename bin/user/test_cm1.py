@@ -0,0 +1,1324 @@
+#!/usr/bin/env python
+# Copyright 2016 Matthew Wall
+# Distributed under the terms of the GNU Public License (GPLv3)
+
+"""Tests for the CM1 driver.  They need weewx on the python path, and run
+against the simulated CM1, so no station is needed:
+
+PYTHONPATH=bin:/usr/share/weewx python bin/user/test_cm1.py
+"""
+
+import itertools
+import json
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+import cm1
+from cm1 import CM1
+from cm1sim import CM1Simulator
+
+
+def _pack(regs):
+    return struct.pack('>%dH' % len(regs), *regs)
+
+
+class RegisterMapTest(unittest.TestCase):
+
+    # three fields, two of them one register apart
+    FIELDS = [
+        ('a', 'g', 10, 'H', None, None, None),
+        ('b', 'g', 12, 'H', None, None, None),
+        ('c', 'g', 100, 'H', None, None, None),
+    ]
+
+    def test_gap_read_through_when_cheaper(self):
+        regmap = cm1.RegisterMap(RegisterMapTest.FIELDS)
+        # a transaction costs as much as 50 registers
+        self.assertEqual(regmap.optimize(cost=(0.5, 0.01)),
+                         [(10, 3), (100, 1)])
+        # transactions are free, so every gap is skipped
+        self.assertEqual(regmap.optimize(cost=(0.0, 1.0)),
+                         [(10, 1), (12, 1), (100, 1)])
+
+    def test_gap_not_read_past_max_count(self):
+        regmap = cm1.RegisterMap(RegisterMapTest.FIELDS)
+        self.assertEqual(regmap.optimize(cost=(1.0, 0.0), max_count=2),
+                         [(10, 1), (12, 1), (100, 1)])
+
+    def test_optimize_covers_every_field(self):
+        regmap = cm1.RegisterMap(CM1.REGISTER_MAP)
+        blocks = regmap.optimize()
+        for f in CM1.REGISTER_MAP:
+            n = cm1.RegisterMap.size(f)
+            self.assertTrue(any(r <= f[2] and f[2] + n <= r + c
+                                for r, c in blocks), f[0])
+        for r, c in blocks:
+            self.assertTrue(c <= CM1.MAX_READ_REGISTERS)
+
+    def test_optimize_is_no_slower_than_ranges(self):
+        regmap = cm1.RegisterMap(CM1.REGISTER_MAP)
+        for baud_rate in CM1.SUPPORTED_BAUD_RATES:
+            cost = cm1.transaction_cost(baud_rate)
+            self.assertTrue(
+                cm1.plan_cost(regmap.optimize(cost=cost), cost) <=
+                cm1.plan_cost(regmap.ranges(), cost))
+
+    def test_transaction_cost(self):
+        fixed, per_reg = cm1.transaction_cost(9600, turnaround=0.0)
+        self.assertAlmostEqual(per_reg, 22.0 / 9600)
+        self.assertAlmostEqual(fixed, 20 * 11.0 / 9600)
+        self.assertTrue(cm1.transaction_cost(19200)[0] < fixed + 0.005)
+
+
+class DecodePlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = CM1Simulator(seed=1)
+        self.sim._update()
+        self.regmap = cm1.RegisterMap(CM1.REGISTER_MAP)
+        self.plan = self.regmap.compile(self.regmap.optimize())
+
+    def _raws(self):
+        return [_pack(self.sim._read(r, c)) for r, c in self.plan.blocks]
+
+    def test_decode(self):
+        pkt = self.plan.decode(self._raws(), dict())
+        self.assertAlmostEqual(pkt['temperature'], 21.5)
+        self.assertAlmostEqual(pkt['humidity'], 45.5)
+        self.assertAlmostEqual(pkt['pressure'], 1013.2)
+        self.assertEqual(pkt['analog_2'], -3.25)
+        self.assertEqual(pkt['serial_number'], 12345)
+
+    def test_gate(self):
+        # a wind status other than 0 means the wind values are not valid
+        self.sim.registers[200] = 1
+        pkt = self.plan.decode(self._raws(), dict())
+        self.assertEqual(pkt['wind_speed'], None)
+        self.assertAlmostEqual(pkt['temperature'], 21.5)
+
+    def test_missing_block(self):
+        raws = self._raws()
+        raws[0] = None
+        pkt = self.plan.decode(raws, dict())
+        self.assertFalse('product_id' in pkt)
+        self.assertTrue('temperature' in pkt)
+
+    def test_plan_is_compiled_once(self):
+        self.assertTrue(self.regmap.compile(self.plan.blocks) is self.plan)
+
+
+class LoggerDecodeTest(unittest.TestCase):
+
+    def setUp(self):
+        sim = CM1Simulator(logger_records=50, seed=1)
+        recs = [sim.logger[i] for i in sorted(sim.logger)]
+        # a slot that has never been written
+        recs.append([0] * CM1.LOGGER_RECORD_SIZE)
+        self.n = len(recs)
+        self.raw = _pack([x for r in recs for x in r])
+
+    def _decode(self, use_numpy):
+        saved = cm1.numpy
+        if not use_numpy:
+            cm1.numpy = None
+        try:
+            return CM1.decode_logger_records(self.raw, self.n)
+        finally:
+            cm1.numpy = saved
+
+    def test_python_decode(self):
+        recs = self._decode(False)
+        self.assertEqual(len(recs), self.n)
+        self.assertEqual(recs[-1], None)
+        for rec in recs[:-1]:
+            self.assertTrue(rec['dateTime'] > 0)
+            self.assertAlmostEqual(rec['temperature'], 21.5)
+            self.assertEqual(rec['analog_2'], -3.25)
+
+    @unittest.skipIf(cm1.numpy is None, "numpy is not installed")
+    def test_numpy_matches_python(self):
+        self.assertEqual(self._decode(True), self._decode(False))
+
+    def test_garbage_times(self):
+        # the numpy decoder uses the same validity check, so this covers
+        # the records that it rejects too
+        dates = [0, 80000101, 79991231, 240229, 1000229, 4000229, 240431,
+                 241301, 240100, 240115, 240115, 240115]
+        times = [120000, 120000, 235959, 0, 0, 0, 0, 0, 0, 240000, 6000,
+                 61]
+        valid = [False, False, True, True, False, True, False, False, False,
+                 False, False, True]
+        self.assertEqual([bool(CM1._logger_time_valid(d, t))
+                          for d, t in zip(dates, times)], valid)
+        epochs = CM1._logger_epochs(dates, times)
+        self.assertEqual([x is not None for x in epochs], valid)
+
+
+class LoggerStatusTest(unittest.TestCase):
+
+    def test_plausible(self):
+        CM1.check_logger_status(dict(interval=5, count=CM1.LOGGER_CAPACITY,
+                                     newest=CM1.LOGGER_CAPACITY - 1))
+
+    def test_not_plausible(self):
+        for status in [dict(interval=7, count=10, newest=9),
+                       dict(interval=5, count=CM1.LOGGER_CAPACITY + 1,
+                            newest=9),
+                       dict(interval=5, count=10,
+                            newest=CM1.LOGGER_CAPACITY)]:
+            self.assertRaises(ValueError, CM1.check_logger_status, status)
+
+    def test_download_is_skipped(self):
+        tmpdir = tempfile.mkdtemp()
+        sim = CM1Simulator(logger_records=20, logger_interval=7, seed=1)
+        try:
+            driver = cm1.CM1Driver(
+                port=sim.open(), timeout=1.0, logger_download=True,
+                identity_file=os.path.join(tmpdir, 'identity.json'))
+            self.assertEqual(list(driver.genArchiveRecords(None)), [])
+            sim.logger_interval = 5
+            self.assertEqual(len(list(driver.genArchiveRecords(None))), 20)
+            driver.closePort()
+        finally:
+            sim.close()
+            shutil.rmtree(tmpdir)
+
+    def test_select_is_not_written_unless_confirmed(self):
+        sim = CM1Simulator(logger_records=20, seed=1)
+        try:
+            station = CM1(sim.open(), 1, CM1.DEFAULT_BAUD_RATE, 1.0)
+            status = station.get_logger_status()
+            station.read_logger(status, 5, 1)
+            self.assertNotEqual(sim.logger_select, 0)
+            sim.logger_select = 0
+            sim.logger_interval = 7
+            self.assertRaises(IOError, station.read_logger, status, 5, 1)
+            self.assertEqual(sim.logger_select, 0)
+            sim.logger_interval = 5
+            sim.logger_select = CM1.LOGGER_CAPACITY
+            self.assertRaises(IOError, station.read_logger, status, 5, 1)
+            self.assertEqual(sim.logger_select, CM1.LOGGER_CAPACITY)
+            station.transport.close()
+        finally:
+            sim.close()
+
+
+class DeadbandFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.f = cm1.DeadbandFilter({'outTemp': 0.5}, heartbeat=300,
+                                    deltas=['rain'], gusts=['windGust'])
+        self.ts = 1000
+
+    def _pkt(self, **fields):
+        self.ts += 10
+        pkt = dict(dateTime=self.ts, usUnits=17, outTemp=20.0, rain=0.0,
+                   windGust=5.0)
+        pkt.update(fields)
+        return pkt
+
+    def test_small_change_is_held(self):
+        self.assertTrue(self.f.filter(self._pkt()) is not None)
+        self.assertEqual(self.f.filter(self._pkt(outTemp=20.3)), None)
+        self.assertEqual(self.f.held, 1)
+        self.assertTrue(self.f.filter(self._pkt(outTemp=20.6)) is not None)
+        self.assertEqual(self.f.held, 0)
+
+    def test_rain_is_never_suppressed(self):
+        self.f.filter(self._pkt())
+        pkt = self.f.filter(self._pkt(rain=0.2))
+        self.assertEqual(pkt['rain'], 0.2)
+
+    def test_gust_is_never_suppressed(self):
+        self.f.filter(self._pkt())
+        pkt = self.f.filter(self._pkt(windGust=5.1))
+        self.assertEqual(pkt['windGust'], 5.1)
+
+    def test_heartbeat(self):
+        self.f.filter(self._pkt())
+        self.ts += 300
+        self.assertTrue(self.f.filter(self._pkt()) is not None)
+
+    def test_changed_only(self):
+        self.f.changed_only = True
+        self.f.filter(self._pkt())
+        pkt = self.f.filter(self._pkt(rain=0.2))
+        self.assertEqual(sorted(pkt.keys()), ['dateTime', 'rain', 'usUnits'])
+
+    def test_heartbeat_on_a_compact_packet(self):
+        self.f.filter(self._pkt())
+        self.ts += 280
+        self.assertEqual(self.f.filter(self._pkt(outTemp=20.1)), None)
+        self.ts += 10
+        pkt = self.f.filter(dict(dateTime=self.ts, usUnits=17, windGust=6.0))
+        self.assertEqual(pkt['outTemp'], 20.1)
+        self.assertEqual(pkt['windGust'], 6.0)
+        # a delta is never carried forward
+        self.assertFalse('rain' in pkt)
+        # nor is a value older than the heartbeat
+        self.ts += 300
+        pkt = self.f.filter(dict(dateTime=self.ts, usUnits=17, windGust=6.0))
+        self.assertFalse('outTemp' in pkt)
+
+
+class SimulatorTestCase(unittest.TestCase):
+    # a simulated station, and a scratch directory for the identity cache
+    # of the driver that is made for the test
+
+    SIMULATOR = dict(seed=1)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sim = CM1Simulator(**self.SIMULATOR)
+        self.driver = None
+
+    def tearDown(self):
+        if self.driver is not None:
+            self.driver.closePort()
+        self.sim.close()
+        shutil.rmtree(self.tmpdir)
+
+    def make_driver(self, **options):
+        self.driver = cm1.CM1Driver(
+            identity_file=os.path.join(self.tmpdir, 'identity.json'),
+            **options)
+        return self.driver
+
+
+class MultiStationTest(SimulatorTestCase):
+
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.sims = []
+
+    def tearDown(self):
+        SimulatorTestCase.tearDown(self)
+        for sim in self.sims:
+            sim.close()
+
+    def _driver(self, stations):
+        return self.make_driver(timeout=1.0, poll_interval=10,
+                                stations=stations)
+
+    def _port(self, address):
+        sim = CM1Simulator(address=address, seed=1)
+        self.sims.append(sim)
+        return sim.open()
+
+    def test_stations_on_one_bus(self):
+        port = self._port([1, 2])
+        driver = self._driver({'a': dict(port=port, address=1, prefix='a_'),
+                               'b': dict(port=port, address=2, prefix='b_')})
+        self.assertEqual(len(driver.port_groups), 1)
+        self.assertEqual(driver.workers, [])
+        a, b = sorted(driver.stations, key=lambda stn: stn.name)
+        self.assertTrue(a.station.transport is b.station.transport)
+        pkt = driver._poll(1000)
+        self.assertTrue('a_outTemp' in pkt and 'b_outTemp' in pkt)
+        self.assertFalse('outTemp' in pkt)
+
+    def test_retries_end_before_the_next_poll(self):
+        # a station that does not answer must not hold up the bus for
+        # max_tries retries
+        port = self._port([1])
+        driver = self.make_driver(
+            timeout=0.3, poll_interval=2, retry_wait=0.5, max_tries=6,
+            stations={'a': dict(port=port, address=1),
+                      'b': dict(port=port, address=9, prefix='b_')})
+        t0 = time.time()
+        pkt, failed = driver._poll_group(driver.port_groups[0], t0)
+        # no try starts after the next slot, so the poll ends within one
+        # try of it.  without the deadline the retries take over 10 seconds.
+        self.assertTrue(time.time() - t0 < 5)
+        self.assertEqual(failed, 1)
+        self.assertTrue('outTemp' in pkt)
+
+    def test_timestamp_is_from_the_reads(self):
+        # the retries of a station that does not answer, and the
+        # identification on the first poll, do not move the timestamp
+        port = self._port([1])
+        driver = self.make_driver(
+            timeout=0.3, poll_interval=2, retry_wait=0.5, max_tries=6,
+            stations={'a': dict(port=port, address=1),
+                      'b': dict(port=port, address=9, prefix='b_')})
+        span = []
+        t0 = time.time()
+        pkt, failed = driver._poll_group(driver.port_groups[0], t0, span)
+        self.assertTrue(max(span) - min(span) < 0.5)
+        self.assertTrue(time.time() - t0 > 1)
+        ts = driver._finish_packet(pkt, span)['dateTime']
+        self.assertTrue(int(min(span)) <= ts <= int(max(span)) + 1)
+
+    def test_identification_is_not_tried_on_every_poll(self):
+        port = self._port([1])
+        driver = self.make_driver(port=port, address=9, timeout=0.3,
+                                  poll_interval=10, identify_retry=600)
+        stn = driver.stations[0]
+        tries = []
+        get = stn.station.get_system_parameters
+        stn.station.get_system_parameters = lambda: tries.append(1) or get()
+        for now in [1000, 1010, 1600]:
+            driver._poll_group(driver.port_groups[0], now)
+        self.assertEqual(len(tries), 2)
+        self.assertFalse(stn.identified)
+        stats = driver.get_stats()['stations']['station']
+        self.assertEqual(stats['identified'], False)
+
+    def test_stations_on_two_ports(self):
+        driver = self._driver({'a': dict(port=self._port(1), prefix='a_'),
+                               'b': dict(port=self._port(1), prefix='b_')})
+        self.assertEqual(len(driver.port_groups), 2)
+        self.assertEqual(len(driver.workers), 2)
+        pkt = driver._poll(1000)
+        self.assertTrue('a_outTemp' in pkt and 'b_outTemp' in pkt)
+
+
+class PollIntervalsTest(SimulatorTestCase):
+
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.make_driver(port=self.sim.open(), timeout=1.0, poll_interval=10,
+                         poll_intervals={'tph': 60, 'power': 300})
+        self.stn = self.driver.stations[0]
+
+    def test_only_due_groups_are_read(self):
+        due, _ = self.stn.begin_read(1000)
+        self.assertEqual(due, frozenset(cm1.CM1Station.GROUPS))
+        full = self.stn.read(dict(), 1000)
+        due, plan = self.stn.begin_read(1010)
+        self.assertFalse('tph' in due or 'power' in due)
+        self.assertTrue('wind' in due)
+        full_plan = self.stn._get_plan(frozenset(cm1.CM1Station.GROUPS))
+        self.assertTrue(sum(n for _, n in plan.blocks) <
+                        sum(n for _, n in full_plan.blocks))
+        # the groups that were not read keep their last values
+        pkt = self.stn.read(dict(), 1010)
+        self.assertEqual(pkt['outTemp'], full['outTemp'])
+        self.assertEqual(pkt['battery_voltage'], full['battery_voltage'])
+        self.assertTrue('tph' in self.stn.begin_read(1060)[0])
+
+    def test_loop_runs_at_the_shortest_interval(self):
+        self.assertEqual(self.driver.poll_interval, 10)
+        self.assertEqual(self.stn.intervals['tph'], 60)
+        self.assertEqual(self.stn.intervals['wind'], 10)
+
+
+class AcquisitionTest(SimulatorTestCase):
+
+    def _driver(self, **options):
+        return self.make_driver(port=self.sim.open(), poll_interval=0,
+                                **options)
+
+    def test_loop_drains_the_buffer(self):
+        driver = self._driver(timeout=1.0)
+        pkts = list(itertools.islice(driver.genLoopPackets(), 3))
+        self.assertEqual(len(pkts), 3)
+        self.assertTrue('outTemp' in pkts[0])
+        self.assertTrue(driver.acquirer.isAlive())
+        self.assertTrue(driver.buffer.queued >= 3)
+
+    def test_slow_consumer_drops_the_oldest(self):
+        driver = self._driver(timeout=1.0, buffer_size=2)
+        driver.genLoopPackets().next()
+        # the acquisition thread keeps polling while nothing is read
+        deadline = time.time() + 10
+        while driver.buffer.dropped == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        stats = driver.get_stats()['buffer']
+        self.assertEqual(stats['depth'], 2)
+        self.assertTrue(stats['dropped'] > 0)
+        self.assertEqual(stats['overflow'], cm1.RingBuffer.DROP_OLDEST)
+
+    def test_close_does_not_wait_for_retries(self):
+        self.sim.timeout_rate = 1.0
+        driver = self._driver(timeout=0.2, max_tries=6, retry_wait=5)
+        acquirer = driver.acquirer = cm1._AcquisitionThread(driver)
+        acquirer.start()
+        # let the first poll fail and start waiting to retry
+        time.sleep(0.5)
+        t0 = time.time()
+        driver.closePort()
+        self.driver = None
+        self.assertTrue(time.time() - t0 < 2)
+        self.assertFalse(acquirer.isAlive())
+
+
+class WindAccumulatorTest(unittest.TestCase):
+
+    def test_gust_is_the_highest_running_mean(self):
+        w = cm1.WindAccumulator(gust_window=3.0)
+        speeds = [2.0, 2.0, 2.0, 8.0, 2.0, 2.0, 5.0, 5.0, 5.0]
+        for ts, speed in enumerate(speeds):
+            w.add(ts, speed, 90.0)
+        # a single sample of 8 is not a gust; three seconds of 5 is
+        self.assertAlmostEqual(w.summary()['gust'], 5.0)
+        self.assertAlmostEqual(w.summary()['gust_dir'], 90.0)
+        self.assertAlmostEqual(w.summary()['speed'], sum(speeds) / 9)
+
+    def test_vector_mean(self):
+        w = cm1.WindAccumulator()
+        self.assertEqual(w.summary(), None)
+        w.add(0, 4.0, 350.0)
+        w.add(1, 4.0, 10.0)
+        w.add(2, None, 180.0)
+        summary = w.summary()
+        self.assertEqual(summary['samples'], 2)
+        self.assertAlmostEqual(summary['dir'] % 360, 0.0)
+        self.assertTrue(summary['vec_speed'] < summary['speed'])
+        w.reset()
+        self.assertEqual(w.summary(), None)
+
+
+class WindFastTest(SimulatorTestCase):
+
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.make_driver(port=self.sim.open(), timeout=1.0, poll_interval=10,
+                         wind_fast_interval=1)
+        self.stn = self.driver.stations[0]
+
+    def test_compact_and_full_packets(self):
+        full = self.stn.read(dict(), 1000)
+        self.assertTrue('outTemp' in full)
+        compact = self.stn.read(dict(), 1001)
+        self.assertEqual(sorted(compact.keys()),
+                         ['windDir', 'windGust', 'windGustDir', 'windSpeed',
+                          'wind_status'])
+        self.stn.read(dict(), 1002)
+        self.assertTrue('outTemp' in self.stn.read(dict(), 1010))
+
+    def test_heartbeat_with_deadbands(self):
+        self.driver.deadband = cm1.DeadbandFilter(
+            {'outTemp': 0.5}, heartbeat=300, deltas=['rain'],
+            gusts=['windGust'])
+        full = self.driver._finish_packet(self.stn.read(dict(), 1000), [])
+        self.driver.deadband.last_ts -= 300
+        compact = self.driver._finish_packet(self.stn.read(dict(), 1001), [])
+        self.assertEqual(compact['outTemp'], full['outTemp'])
+        self.assertFalse('rain' in compact)
+
+    def test_nothing_decoded_adds_nothing(self):
+        self.stn.read(dict(), 1000)
+        due, plan = self.stn.begin_read(1001)
+        self.assertEqual(due, frozenset(['wind']))
+        pkt = self.stn.end_read(dict(), 1001, due, plan, dict(),
+                                range(len(plan.blocks)))
+        self.assertEqual(pkt, dict())
+
+
+class StormTrackerTest(unittest.TestCase):
+
+    def test_burst_and_decay(self):
+        t = cm1.StormTracker(60, 2, hold=600)
+        self.assertEqual(t.update(0, 10, 0), None)
+        self.assertEqual(t.interval, 60)
+        self.assertEqual(t.update(60, 13, 0), 3)
+        self.assertTrue(t.active)
+        self.assertEqual(t.interval, 2)
+        self.assertEqual(t.update(62, 13, 0), 0)
+        self.assertTrue(t.active)
+        self.assertEqual(t.update(660, 13, 0), 0)
+        self.assertFalse(t.active)
+        self.assertEqual(t.interval, 60)
+
+    def test_status_change_starts_a_burst(self):
+        t = cm1.StormTracker(60, 2)
+        t.update(0, 10, 0)
+        self.assertEqual(t.update(60, 10, 1), 0)
+        self.assertTrue(t.active)
+
+    def test_count_reset(self):
+        t = cm1.StormTracker(60, 2)
+        t.update(0, 10, 0)
+        self.assertEqual(t.update(60, 2, 0), 2)
+
+
+class StormModeTest(SimulatorTestCase):
+
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.make_driver(port=self.sim.open(), timeout=1.0, poll_interval=10,
+                         poll_intervals={'lightning': 60}, storm_interval=2,
+                         storm_hold=600)
+        self.stn = self.driver.stations[0]
+
+    def test_burst_polling(self):
+        self.assertEqual(self.driver.poll_interval, 2)
+        pkt = self.stn.read(dict(), 1000)
+        self.assertEqual(pkt['lightning_strikes'], None)
+        # no lightning read until the idle interval has passed
+        self.assertFalse('lightning' in self.stn.begin_read(1010)[0])
+        self.sim.registers[281] += 3
+        pkt = self.stn.read(dict(), 1060)
+        self.assertEqual(pkt['lightning_strikes'], 3)
+        self.assertEqual(self.stn.intervals['lightning'], 2)
+        # in a burst, a poll of the lightning group alone is compact
+        pkt = self.stn.read(dict(), 1062)
+        self.assertEqual(pkt['lightning_strikes'], 0)
+        self.assertFalse('outTemp' in pkt)
+        self.assertTrue('lightning_distance' in pkt)
+        # the burst ends after storm_hold seconds with no strikes
+        self.stn.read(dict(), 1662)
+        self.assertEqual(self.stn.intervals['lightning'], 60)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_open_half_open_close(self):
+        b = cm1.CircuitBreaker('test', threshold=2, cooldown=10,
+                               max_cooldown=15)
+        b.failure(0)
+        self.assertEqual(b.state, cm1.CircuitBreaker.CLOSED)
+        b.failure(0)
+        self.assertEqual(b.state, cm1.CircuitBreaker.OPEN)
+        self.assertFalse(b.allow(5))
+        self.assertTrue(b.allow(10))
+        self.assertEqual(b.state, cm1.CircuitBreaker.HALF_OPEN)
+        # a failed probe opens the circuit for longer, up to the maximum
+        b.failure(10)
+        self.assertEqual(b.cooldown, 15)
+        self.assertFalse(b.allow(20))
+        self.assertTrue(b.allow(25))
+        b.success()
+        self.assertEqual(b.state, cm1.CircuitBreaker.CLOSED)
+        self.assertEqual(b.cooldown, 10)
+
+
+class PollSchedulerTest(unittest.TestCase):
+
+    def test_aligned_slots(self):
+        s = cm1.PollScheduler(10)
+        self.assertEqual(s.next(5), 5)
+        self.assertEqual(s.next(6), 10)
+        self.assertEqual(s.next(12), 20)
+
+    def test_overrun_skips_slots(self):
+        s = cm1.PollScheduler(10)
+        s.next(5)
+        self.assertEqual(s.next(35), 30)
+        self.assertEqual(s.missed, 2)
+
+    def test_no_interval(self):
+        s = cm1.PollScheduler(0)
+        self.assertEqual(s.next(7), 7)
+
+
+class TransactionStatsTest(unittest.TestCase):
+
+    def test_counts(self):
+        stats = cm1.TransactionStats()
+        stats.record(200, 10, False, 0.015)
+        stats.record(200, 10, False, 0.3, cm1.NoResponseError("timeout"))
+        stats.record(200, 10, False, 0.02, cm1.CRCError("crc"))
+        stats.record(200, 10, False, 0.02, cm1.ModbusException(2))
+        stats.record(132, 2, True, 0.01)
+        snap = stats.snapshot()
+        self.assertEqual((snap['transactions'], snap['errors']), (5, 3))
+        self.assertEqual((snap['timeouts'], snap['crc_errors']), (1, 1))
+        self.assertEqual(snap['exceptions']['02'], 1)
+        block = snap['blocks']['200-209']
+        self.assertEqual(block['bytes_sent'], 4 * 8)
+        self.assertEqual(block['bytes_received'], 5 + 20)
+        self.assertEqual(block['latency']['p50'], 0.02)
+        self.assertTrue('write 132-133' in snap['blocks'])
+
+    def test_packet_fields_are_counted_since_the_last_call(self):
+        stats = cm1.TransactionStats()
+        stats.record(200, 10, False, 0.01)
+        stats.record(200, 10, False, 0.03)
+        pkt = stats.packet_fields('a_')
+        self.assertEqual(pkt['a_cm1_transactions'], 2)
+        self.assertAlmostEqual(pkt['a_cm1_latency'], 20.0)
+        pkt = stats.packet_fields('a_')
+        self.assertEqual(pkt['a_cm1_transactions'], 0)
+        self.assertEqual(pkt['a_cm1_latency'], None)
+
+
+class StatsServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    @staticmethod
+    def _free_port():
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        return port
+
+    @staticmethod
+    def _read(s):
+        data = ''
+        while True:
+            x = s.recv(4096)
+            if not x:
+                return data
+            data += x
+
+    def test_unix_socket_and_http(self):
+        path = os.path.join(self.tmpdir, 'stats.sock')
+        port = self._free_port()
+        self.server = cm1.StatsServer(lambda: dict(transactions=3), path,
+                                      port)
+        self.server.start()
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(path)
+        self.assertEqual(json.loads(self._read(s)), dict(transactions=3))
+        s.close()
+        s = socket.create_connection(('127.0.0.1', port))
+        s.sendall("GET / HTTP/1.0\r\n\r\n")
+        head, body = self._read(s).split('\r\n\r\n', 1)
+        s.close()
+        self.assertTrue(head.startswith('HTTP/1.0 200 OK'))
+        self.assertEqual(json.loads(body), dict(transactions=3))
+        self.server.stop()
+        self.server = None
+        self.assertFalse(os.path.exists(path))
+
+    def test_driver_stats(self):
+        sim = CM1Simulator(seed=1)
+        try:
+            driver = cm1.CM1Driver(
+                port=sim.open(), timeout=1.0, poll_interval=10,
+                stats_in_packet=True,
+                identity_file=os.path.join(self.tmpdir, 'identity.json'))
+            pkt = driver._finish_packet(driver._poll(1000), [])
+            self.assertTrue(pkt['cm1_transactions'] > 0)
+            self.assertEqual(pkt['cm1_errors'], 0)
+            self.assertEqual(pkt['cm1_overruns'], 0)
+            stats = driver.get_stats()
+            self.assertEqual(stats['stations']['station']['breaker'],
+                             cm1.CircuitBreaker.CLOSED)
+            self.assertTrue(stats['stations']['station']['transactions'] > 0)
+            driver.closePort()
+        finally:
+            sim.close()
+
+
+class RingBufferTest(unittest.TestCase):
+
+    def _fill(self, overflow):
+        buf = cm1.RingBuffer(3, overflow)
+        ok = [buf.put(i) for i in range(4)]
+        return buf, ok, [buf.get(0) for _ in range(4)]
+
+    def test_drop_oldest(self):
+        buf, ok, items = self._fill(cm1.RingBuffer.DROP_OLDEST)
+        self.assertEqual(ok, [True, True, True, False])
+        self.assertEqual(items, [1, 2, 3, None])
+        self.assertEqual(buf.stats()['dropped'], 1)
+
+    def test_drop_newest(self):
+        buf, ok, items = self._fill(cm1.RingBuffer.DROP_NEWEST)
+        self.assertEqual(items, [0, 1, 2, None])
+        self.assertEqual(buf.stats()['high_water'], 3)
+
+    def test_force(self):
+        buf = cm1.RingBuffer(1, cm1.RingBuffer.DROP_NEWEST)
+        buf.put(0)
+        buf.put('error', force=True)
+        self.assertEqual(buf.get(0), 'error')
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, cm1.RingBuffer, 3, 'drop_all')
+
+
+class RTTEstimatorTest(unittest.TestCase):
+
+    def test_timeout(self):
+        est = cm1.RTTEstimator(0.2, 6.0)
+        self.assertEqual(est.timeout, 6.0)
+        est.update(0.1)
+        self.assertAlmostEqual(est.timeout, 0.3)
+        est.backoff()
+        self.assertAlmostEqual(est.timeout, 0.6)
+        for _ in range(10):
+            est.backoff()
+        self.assertEqual(est.timeout, 6.0)
+        for _ in range(50):
+            est.update(0.001)
+        self.assertEqual(est.timeout, 0.2)
+
+
+class RegisterCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = cm1.RegisterCache(1.0, max_blocks=2)
+        self.cache.put(200, 10, _pack(range(10)), now=0)
+
+    def test_covered_read(self):
+        ts, payload = self.cache.get(202, 3, now=0.5)
+        self.assertEqual(ts, 0)
+        self.assertEqual(str(payload), _pack([2, 3, 4]))
+        self.assertEqual(self.cache.get(208, 3, now=0.5), None)
+
+    def test_expiry(self):
+        self.assertEqual(self.cache.get(200, 1, now=1.5), None)
+
+    def test_invalidate(self):
+        self.cache.put(300, 2, _pack([1, 2]), now=0)
+        self.cache.invalidate(209, 2)
+        self.assertEqual(self.cache.get(200, 1, now=0), None)
+        self.assertTrue(self.cache.get(300, 2, now=0) is not None)
+        self.cache.invalidate()
+        self.assertEqual(self.cache.get(300, 2, now=0), None)
+
+    def test_oldest_block_dropped(self):
+        self.cache.put(300, 2, _pack([1, 2]), now=0)
+        self.cache.put(400, 2, _pack([1, 2]), now=0)
+        self.assertEqual(self.cache.get(200, 1, now=0), None)
+
+
+class ConfigTest(unittest.TestCase):
+
+    def test_conf_editor_asks_only_for_the_port(self):
+        editor = cm1.CM1ConfEditor()
+        labels = []
+        editor._prompt = lambda label, default=None, values=None: \
+            labels.append(label) or '/dev/ttyS0'
+        self.assertEqual(editor.prompt_for_settings(), {'port': '/dev/ttyS0'})
+        self.assertEqual(labels, ['port'])
+
+
+class SimulatorTest(unittest.TestCase):
+    # the station on a pseudo-terminal, through the built-in modbus client
+
+    def setUp(self):
+        self.sim = CM1Simulator(logger_records=20, seed=1)
+        self.station = CM1(self.sim.open(), 1, CM1.DEFAULT_BAUD_RATE, 1.0,
+                           cache_ttl=60)
+
+    def tearDown(self):
+        self.station.transport.close()
+        self.sim.close()
+
+    def test_get_config(self):
+        config = self.station.get_config()
+        self.assertEqual(len(config), CM1.CONFIG_COUNT)
+        self.assertEqual(config[0], self.sim.logger_interval)
+
+    def test_accessors_use_the_cache(self):
+        self.station.get_system_parameters()
+        n = self.station.stats.snapshot()['transactions']
+        self.station.get_clock()
+        self.station.get_clock()
+        self.assertEqual(self.station.stats.snapshot()['transactions'], n)
+
+    def test_set_clock_invalidates(self):
+        t = self.station.get_clock()
+        self.station.set_clock(t + 3600)
+        self.assertTrue(abs(self.station.get_clock() - t - 3600) < 5)
+
+    def test_logger_records(self):
+        status = self.station.get_logger_status()
+        self.assertEqual(status['count'], 20)
+        recs = self.station.get_logger_records(status, 0, 20)
+        times = [r['dateTime'] for r in recs]
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(self.station.find_logger_record(status, times[4]),
+                         5)
+
+
+
+class IdentityCacheTest(unittest.TestCase):
+
+    ID = dict(product_id=120, firmware_version=105, serial_number=12345)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'identity.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        cm1.IdentityCache(self.path, ['a']).put('a', self.ID, now=1000)
+        cached = cm1.IdentityCache(self.path, ['a']).get('a', now=1000)
+        self.assertEqual(cached['serial_number'], 12345)
+
+    def test_expired_entry_is_ignored(self):
+        cache = cm1.IdentityCache(self.path, ['a'], max_age=100)
+        cache.put('a', self.ID, now=1000)
+        self.assertTrue(cache.get('a', now=1100) is not None)
+        self.assertEqual(cache.get('a', now=1101), None)
+
+    def test_unknown_keys_are_pruned(self):
+        cm1.IdentityCache(self.path, ['a', 'b']).put('a', self.ID, now=1000)
+        cache = cm1.IdentityCache(self.path, ['b'])
+        self.assertTrue(cache.get('a', now=1000) is not None)
+        cache.put('b', self.ID, now=1000)
+        self.assertEqual(cm1.IdentityCache(self.path).get('a', now=1000),
+                         None)
+
+    def test_driver_keys(self):
+        driver = cm1.CM1Driver(port='tcp://127.0.0.1:1', address=2,
+                               identity_file=self.path)
+        self.assertEqual(driver.identity.keys,
+                         ['station@tcp://127.0.0.1:1:2'])
+        driver.closePort()
+
+
+class BaudRateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = None
+
+    def _open(self, sim):
+        self.sim = sim
+        self.station = CM1(sim.open(), 1, CM1.DEFAULT_BAUD_RATE, 1.0)
+
+    def tearDown(self):
+        if self.sim is not None:
+            self.station.transport.close()
+            self.sim.close()
+
+    def test_probe(self):
+        self._open(CM1Simulator(seed=1))
+        r = self.station.probe(5)
+        self.assertEqual((r['baud_rate'], r['errors']), (19200, 0))
+
+    def test_find_baud_rate(self):
+        self._open(CM1Simulator(seed=1, baud_rate=9600))
+        self.assertEqual(self.station.find_baud_rate(), 9600)
+        self.assertEqual(self.station.transport.baud_rate, 9600)
+
+    def test_negotiate_is_only_a_check(self):
+        # the station rate is never written, so the port follows the station
+        self.sim = CM1Simulator(seed=1, baud_rate=9600)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            driver = cm1.CM1Driver(
+                port=self.sim.open(), timeout=0.2, baud_probe='negotiate',
+                probe_count=2,
+                identity_file=os.path.join(tmpdir, 'identity.json'))
+            stn = driver.stations[0]
+            self.station = stn.station
+            self.assertEqual(stn.probe_mode, 'check')
+            stn.probe_baud_rate()
+            self.assertEqual(self.station.transport.baud_rate, 9600)
+            self.assertEqual(self.sim.baud_rate, 9600)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_recommend(self):
+        results = [dict(baud_rate=9600, error_rate=0.0),
+                   dict(baud_rate=19200, error_rate=0.1),
+                   dict(baud_rate=38400, error_rate=None)]
+        self.assertEqual(CM1.recommend_baud_rate(results), 9600)
+        self.assertEqual(CM1.recommend_baud_rate(results, 0.1), 19200)
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cm1-raw.dat')
+        self.sim = CM1Simulator(seed=1)
+
+    def tearDown(self):
+        self.sim.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        station = CM1(self.sim.open(), 1, CM1.DEFAULT_BAUD_RATE, 1.0)
+        station.recorder = cm1.RawRecorder(self.path)
+        recorded = [station.get_current() for _ in range(3)]
+        station.recorder.close()
+        station.transport.close()
+        n = len(station.current_plan.blocks)
+        self.assertEqual(len(cm1.ReplayTransport(self.path)), 3 * n)
+        station = CM1('replay://' + self.path, 1, None, 1.0)
+        self.assertEqual([station.get_current() for _ in range(3)], recorded)
+        self.assertRaises(EOFError, station.get_current)
+        station.transport.close()
+
+    def test_loop_ends_at_the_end_of_the_capture(self):
+        identity = os.path.join(self.tmpdir, 'identity.json')
+        driver = cm1.CM1Driver(port=self.sim.open(), timeout=1.0,
+                               poll_interval=0, record_file=self.path,
+                               identity_file=identity)
+        recorded = list(itertools.islice(driver.genLoopPackets(), 5))
+        driver.closePort()
+        cm1.RawRecorder.get(self.path).close()
+        driver = cm1.CM1Driver(port='replay://' + self.path, poll_interval=0,
+                               identity_file=identity)
+        replayed = []
+        try:
+            for pkt in driver.genLoopPackets():
+                replayed.append(pkt)
+        except cm1.StopNow:
+            pass
+        else:
+            self.fail("the loop ended without StopNow")
+        self.assertEqual([p['windDir'] for p in replayed[:5]],
+                         [p['windDir'] for p in recorded])
+        # a replayed packet is stamped with the time its blocks were read,
+        # not the middle of the poll, so the two can round apart
+        for a, b in zip(replayed, recorded):
+            self.assertTrue(abs(a['dateTime'] - b['dateTime']) <= 1)
+        # weewx would call again, and must not get the capture again
+        self.assertRaises(cm1.StopNow, driver.genLoopPackets().next)
+        driver.closePort()
+
+
+class DaemonTest(SimulatorTestCase):
+
+    SIMULATOR = dict(seed=1, logger_records=30)
+
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.path = os.path.join(self.tmpdir, 'cm1d.sock')
+        self.daemon = cm1.CM1Daemon(self.sim.open(), self.path, timeout=1.0)
+        self.thread = None
+
+    def tearDown(self):
+        if self.driver is not None:
+            self.driver.closePort()
+            self.driver = None
+        if self.thread is not None:
+            self.daemon.stop()
+            self.thread.join(5)
+        else:
+            self.daemon.close()
+        SimulatorTestCase.tearDown(self)
+
+    def _serve(self):
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _connect(self, n):
+        clients = []
+        for _ in range(n):
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.settimeout(5)
+            s.connect(self.path)
+            clients.append(s)
+        while self.daemon.counts['clients'] < n:
+            self.daemon.serve_once(1)
+        return clients
+
+    def _request(self, s, **req):
+        s.sendall(json.dumps(req) + "\n")
+
+    def test_client(self):
+        self._serve()
+        station = CM1('cm1d://' + self.path, 1, None, 1.0)
+        try:
+            self.assertTrue('temperature' in station.get_current())
+            self.assertEqual(station.get_system_parameters()['product_id'],
+                             120)
+            status = station.get_logger_status()
+            recs = station.get_logger_records(status, 0, 3)
+            self.assertEqual(len(recs), 3)
+            self.assertTrue(recs[0]['dateTime'] < recs[2]['dateTime'])
+            # a register that is not cached, so the daemon must read it
+            self.sim.exception_rate = 1.0
+            self.assertRaises(cm1.ModbusException, station.read_registers,
+                              CM1.CONFIG_REGISTER, 1)
+        finally:
+            station.transport.close()
+
+    def test_driver(self):
+        self._serve()
+        driver = self.make_driver(port='cm1d://' + self.path, timeout=1.0,
+                                  poll_interval=10)
+        self.assertTrue('outTemp' in driver._poll(1000))
+
+    def test_identical_reads_are_coalesced(self):
+        clients = self._connect(2)
+        for s in clients:
+            self._request(s, op='read', address=1, register=221, count=5)
+        time.sleep(0.1)
+        n = self.sim.stats['requests']
+        self.daemon.serve_once(1)
+        answers = [json.loads(s.makefile().readline()) for s in clients]
+        self.assertEqual(answers[0], answers[1])
+        self.assertTrue('data' in answers[0])
+        self.assertEqual(self.sim.stats['requests'], n + 1)
+        self.assertEqual(self.daemon.counts['coalesced'], 1)
+        for s in clients:
+            s.close()
+
+    def test_only_the_clock_is_writable(self):
+        s = self._connect(1)[0]
+        f = s.makefile()
+        n = self.sim.stats['requests']
+        # the logger select, the baud rate and the configuration
+        for reg, values in [(CM1.LOGGER_SELECT_REGISTER, [0, 1]), (131, [96]),
+                            (CM1.CONFIG_REGISTER, [5]), (106, [0, 1, 2])]:
+            self._request(s, op='write', address=1, register=reg,
+                          values=values)
+            self.daemon.serve_once(1)
+            self.assertTrue('error' in json.loads(f.readline()))
+        self.assertEqual(self.sim.stats['requests'], n)
+        self._request(s, op='write', address=1, register=104,
+                      values=[1, 54464, 3, 43507])
+        self.daemon.serve_once(1)
+        self.assertEqual(json.loads(f.readline()), dict(ok=True))
+        s.close()
+
+
+class EventLoopTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = cm1.EventLoop()
+
+    def test_coroutines(self):
+        loop = self.loop
+
+        def double(x):
+            yield loop.sleep(0.01)
+            raise cm1.Return(2 * x)
+
+        def fail():
+            yield loop.sleep(0)
+            raise IOError("failed")
+
+        def main():
+            x = yield loop.spawn(double(2))
+            results = yield loop.gather([loop.spawn(double(3)),
+                                         loop.spawn(fail())])
+            raise cm1.Return((x, results))
+
+        x, (y, e) = loop.run_until_complete(main())
+        self.assertEqual((x, y), (4, 6))
+        self.assertTrue(isinstance(e, IOError))
+
+    def test_error_is_raised_by_run(self):
+        def fail():
+            yield self.loop.sleep(0)
+            raise ValueError("bad")
+        self.assertRaises(ValueError, self.loop.run_until_complete, fail())
+
+    def test_run_sync_from_another_thread(self):
+        loop = self.loop
+
+        def later(x):
+            yield loop.sleep(0.01)
+            raise cm1.Return(x)
+
+        t = threading.Thread(target=loop.run_forever)
+        t.setDaemon(True)
+        t.start()
+        try:
+            while loop.thread is None:
+                time.sleep(0.01)
+            self.assertEqual(loop.run_sync(later(5)), 5)
+        finally:
+            loop.stop()
+            t.join(5)
+            loop.close()
+
+
+class AsyncCM1Test(SimulatorTestCase):
+
+    SIMULATOR = dict(seed=1, logger_records=30)
+
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.loop = None
+        self.station = None
+
+    def tearDown(self):
+        if self.station is not None:
+            self.station.transport.close()
+        if self.loop is not None:
+            self.loop.close()
+        SimulatorTestCase.tearDown(self)
+
+    def _open(self, port, **kwargs):
+        self.station = CM1(port, 1, CM1.DEFAULT_BAUD_RATE, 1.0, **kwargs)
+        self.loop = cm1.EventLoop()
+        link = cm1.AsyncLink(self.loop, self.station.transport)
+        return cm1.AsyncCM1(self.station, link)
+
+    def _check(self, port):
+        s = self._open(port)
+        run = self.loop.run_until_complete
+        self.assertEqual(sorted(run(s.get_current()).keys()),
+                         sorted(self.station.get_current().keys()))
+        self.assertEqual(run(s.get_system_parameters()),
+                         self.station.get_system_parameters())
+        status = run(s.get_logger_status())
+        self.assertEqual(status, self.station.get_logger_status())
+        self.assertEqual(run(s.get_logger_records(status, 5, 3)),
+                         self.station.get_logger_records(status, 5, 3))
+        self.assertTrue(s.stats.snapshot()['transactions'] > 0)
+
+    def test_serial(self):
+        self._check(self.sim.open())
+
+    def test_modbus_tcp(self):
+        self._check(self.sim.open_tcp())
+
+    def test_error(self):
+        s = self._open(self.sim.open())
+        self.sim.exception_rate = 1.0
+        self.assertRaises(cm1.ModbusException, self.loop.run_until_complete,
+                          s.read_block(200, 10))
+
+    def test_cache_is_shared(self):
+        s = self._open(self.sim.open(), cache_ttl=60)
+        run = self.loop.run_until_complete
+        run(s.get_system_parameters())
+        n = s.stats.snapshot()['transactions']
+        self.assertTrue(abs(run(s.get_clock()) - time.time()) < 5)
+        self.assertEqual(s.stats.snapshot()['transactions'], n)
+
+    def test_stopped(self):
+        s = self._open(self.sim.open())
+        self.station.stopped = threading.Event()
+        self.station.stopped.set()
+        self.assertRaises(cm1.weewx.WeeWxIOError,
+                          self.loop.run_until_complete, s.get_current())
+
+    def test_probe(self):
+        s = self._open(self.sim.open())
+        r = self.loop.run_until_complete(s.probe(3))
+        self.assertEqual((r['baud_rate'], r['errors']), (19200, 0))
+        # probe reads are not counted as transactions
+        self.assertEqual(s.stats.snapshot()['transactions'], 0)
+
+    def test_driver(self):
+        driver = self.make_driver(port=self.sim.open(), timeout=1.0,
+                                  poll_interval=1, async_core=True,
+                                  baud_probe='check', probe_count=3)
+        self.assertTrue(driver.loop is not None)
+        pkts = list(itertools.islice(driver.genLoopPackets(), 2))
+        self.assertTrue('outTemp' in pkts[0])
+        self.assertTrue(isinstance(driver.acquirer, cm1._EventLoopThread))
+
+
+class TransportTest(unittest.TestCase):
+
+    def test_read_registers_is_built_on_read_block(self):
+        class Fixed(cm1.Transport):
+            def read_block(self, reg, cnt):
+                return _pack(range(reg, reg + cnt))
+        self.assertEqual(Fixed().read_registers(10, 3), [10, 11, 12])
+        self.assertRaises(NotImplementedError,
+                          cm1.Transport().read_registers, 10, 3)
+
+
+class RTUFrameTest(unittest.TestCase):
+    # published modbus-rtu vectors.  the simulator uses the same crc16, so
+    # the round trips against it cannot catch a wrong crc or a bad frame.
+
+    class FakeSerial(object):
+        is_open = True
+        in_waiting = 0
+
+        def __init__(self, resp):
+            self.resp = resp
+            self.written = []
+
+        def write(self, data):
+            self.written.append(data)
+
+        def read(self, n):
+            data, self.resp = self.resp[:n], self.resp[n:]
+            return data
+
+    def test_crc16_check_value(self):
+        # CRC-16/MODBUS check value
+        self.assertEqual(cm1.crc16(bytearray('123456789')), 0x4B37)
+
+    def test_read_request_frame(self):
+        self.assertEqual(cm1._rtu_frame(1, cm1._read_pdu(0, 10)),
+                         bytearray('\x01\x03\x00\x00\x00\x0a\xc5\xcd'))
+
+    @unittest.skipIf(cm1.serial is None, "pyserial is not installed")
+    def test_read_block_on_the_wire(self):
+        # read holding registers 108-110 from address 17
+        t = cm1.RTUSerialTransport(None, 17, 19200, 0.3)
+        t.serial = self.FakeSerial(
+            '\x11\x03\x06\xae\x41\x56\x52\x43\x40\x49\xad')
+        data = t.read_block(0x6b, 3)
+        self.assertEqual(t.serial.written,
+                         ['\x11\x03\x00\x6b\x00\x03\x76\x87'])
+        self.assertEqual(str(data), '\xae\x41\x56\x52\x43\x40')
+        t.serial.resp = '\x11\x03\x06\xae\x41\x56\x52\x43\x40\x49\xae'
+        self.assertRaises(cm1.CRCError, t.read_block, 0x6b, 3)
+
+
+class TCPTransportTest(unittest.TestCase):
+    # modbus tcp and rtu over tcp, with the simulator as the gateway
+
+    def setUp(self):
+        self.sim = CM1Simulator(seed=1)
+        self.sim._update()
+        self.transports = []
+
+    def tearDown(self):
+        for t in self.transports:
+            t.conn.close()
+        self.sim.close()
+
+    def _open(self, rtu=False, pipeline=False):
+        t = cm1.Transport.create(self.sim.open_tcp(rtu=rtu), 1, None, 0.3,
+                                 pipeline)
+        self.transports.append(t)
+        return t
+
+    def _expected(self, reg, cnt):
+        return _pack(self.sim._read(reg, cnt))
+
+    def test_modbus_tcp(self):
+        t = self._open()
+        self.assertTrue(isinstance(t, cm1.ModbusTCPTransport))
+        self.assertEqual(t.read_block(221, 3), self._expected(221, 3))
+        t.write_registers(135, [60])
+        self.assertEqual(t.read_registers(135, 1), [60])
+
+    def test_pipelined_blocks(self):
+        t = self._open(pipeline=True)
+        blocks = [(108, 3), (221, 5), (244, 4)]
+        self.assertEqual(t.read_blocks(blocks),
+                         [self._expected(r, c) for r, c in blocks])
+
+    def test_stale_response_is_discarded(self):
+        t = self._open()
+        self.sim.stale_rate = 1.0
+        self.assertEqual(t.read_block(221, 3), self._expected(221, 3))
+        self.assertEqual(self.sim.stats['stale'], 1)
+
+    def test_short_response(self):
+        for rtu in [False, True]:
+            t = self._open(rtu=rtu)
+            self.sim.short_rate = 1.0
+            self.assertRaises(cm1.NoResponseError, t.read_block, 221, 3)
+            # the connection is dropped, so the rest of the response cannot
+            # be taken for the next one
+            self.assertEqual(t.conn.sock, None)
+            self.sim.short_rate = 0.0
+            self.assertEqual(t.read_block(221, 3), self._expected(221, 3))
+            self.assertEqual(t.conn.connects, 2)
+            self.sim.close()
+
+    def test_rtu_over_tcp(self):
+        t = self._open(rtu=True)
+        self.assertTrue(isinstance(t, cm1.RTUOverTCPTransport))
+        self.assertEqual(t.read_block(108, 3), self._expected(108, 3))
+        self.sim.exception_rate = 1.0
+        self.assertRaises(cm1.ModbusException, t.read_block, 221, 3)
+        self.sim.exception_rate = 0.0
+        self.sim.crc_error_rate = 1.0
+        self.assertRaises(cm1.CRCError, t.read_block, 221, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,10 +10,10 @@ def loader():
 class CM1Installer(ExtensionInstaller):
     def __init__(self):
         super(CM1Installer, self).__init__(
-            version="0.5",
+            version="0.6",
             name='cm1',
             description='Collect data from Dyacon weather station using CM1',
             author="Matthew Wall",
             author_email="mwall@users.sourceforge.net",
-            files=[('bin/user', ['bin/user/cm1.py'])]
+            files=[('bin/user', ['bin/user/cm1.py', 'bin/user/cm1sim.py'])]
             )